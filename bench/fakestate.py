@@ -0,0 +1,123 @@
+"""
+State shared by the fake backend commands.
+
+Fakes run as many processes at once (one shot commands and long lived
+sessions), so their state lives in a JSON file per backend, locked while a
+command reads and changes it. Every process start and command is appended to the
+FAKE_LOG file, as "start name pid", "cmd name verb pid" or, for the end of
+output markers of kglimits sessions, "sentinel name verb pid". Connections to
+fake servers are logged as "connect name pid".
+
+Environment:
+
+* FAKE_STATE: the directory of state files,
+* FAKE_LOG: the log file, optional,
+* FAKE_STARTUP: seconds to sleep when a process starts,
+* FAKE_LATENCY: seconds to sleep for each command.
+"""
+import os
+import sys
+import json
+import time
+import fcntl
+
+
+def _env_float(name):
+    return float(os.environ.get(name, "0") or "0")
+
+
+def startup(name):
+    log("start", name)
+    time.sleep(_env_float("FAKE_STARTUP"))
+
+
+def command(name, verb, words):
+    if [ w for w in words if "kglimits-end-of-output" in w ]:
+        log("sentinel", name, verb)
+    else:
+        log("cmd", name, verb)
+    time.sleep(_env_float("FAKE_LATENCY"))
+
+
+def log(*words):
+    path = os.environ.get("FAKE_LOG")
+    if not path:
+        return
+    line = "%s %d\n" % (" ".join(words), os.getpid())
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+class State(object):
+    """
+    with State(backend, empty) as state: read and change the state dict of
+    backend. empty makes the state for a new file. Nothing is written back
+    if write is False or the block raises.
+    """
+
+    def __init__(self, backend, empty, write=True):
+        self.path = os.path.join(os.environ["FAKE_STATE"], "%s.json" % backend)
+        self.empty = empty
+        self.write = write
+        self.data = None
+        self._lock = None
+
+    def __enter__(self):
+        self._lock = open(self.path + ".lock", "a")
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        if os.path.exists(self.path):
+            f = open(self.path)
+            try:
+                self.data = json.load(f)
+            finally:
+                f.close()
+        else:
+            self.data = self.empty()
+        return self.data
+
+    def __exit__(self, type, value, traceback):
+        try:
+            if type is None and self.write:
+                tmp = self.path + ".tmp"
+                f = open(tmp, "w")
+                try:
+                    json.dump(self.data, f)
+                finally:
+                    f.close()
+                os.rename(tmp, self.path)
+        finally:
+            fcntl.flock(self._lock, fcntl.LOCK_UN)
+            self._lock.close()
+        return False
+
+
+class Failed(Exception):
+    """ A command failed with a return code. """
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+def interactive(prompt, run):
+    """
+    Read commands from stdin, writing prompt before each one, like an
+    interactive sacctmgr or goldsh.
+    """
+    while True:
+        sys.stdout.write(prompt)
+        sys.stdout.flush()
+        line = sys.stdin.readline()
+        if not line:
+            return 0
+        line = line.strip()
+        if line in ("quit", "exit"):
+            return 0
+        if line == "":
+            continue
+        run(line)
+        sys.stdout.flush()
+        sys.stderr.flush()
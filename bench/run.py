@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+"""
+Benchmark kglimits against stand-in sacctmgr and Gold commands.
+
+The scenarios run in a Django test database, with SLURM_PATH and GOLD_PATH
+pointing at the fakes in this directory. For each scenario the report
+shows:
+
+* wall: seconds taken,
+* issued: commands kglimits signal handlers issued,
+* commands: commands the fakes ran,
+* sentinels: end of output markers written by kglimits sessions,
+* processes: fake processes started, or connections opened to the fake
+  slurmrestd.
+
+Usage:
+
+    DJANGO_SETTINGS_MODULE=... python bench/run.py --output now.json
+    python bench/run.py --baseline before.json
+
+With --rest, Slurm commands go to a stand-in slurmrestd instead of
+sacctmgr.
+
+With --baseline, more commands or processes than before, or a wall time
+more than --tolerance slower, is reported as a regression and the exit
+status is 1.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import argparse
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+
+GOLD_COMMANDS = [ "glsuser", "gmkuser", "gchuser", "grmuser", "glsproject",
+        "gmkproject", "gchproject", "grmproject", "gbalance", "goldsh" ]
+
+COUNTERS = [ "issued", "commands", "sentinels", "processes" ]
+
+
+def make_fakes(directory):
+    """ Link the fakes under the names kglimits runs. """
+    bin = os.path.join(directory, "bin")
+    os.mkdir(bin)
+    os.symlink(os.path.join(BENCH, "fake_sacctmgr"),
+            os.path.join(bin, "sacctmgr"))
+    for name in GOLD_COMMANDS:
+        os.symlink(os.path.join(BENCH, "fake_gold"), os.path.join(bin, name))
+    state = os.path.join(directory, "state")
+    os.mkdir(state)
+    return bin, state
+
+
+def start_slurmrestd():
+    """ Start the stand-in slurmrestd, returning it and its URL. """
+    server = subprocess.Popen([ os.path.join(BENCH, "fake_slurmrestd") ],
+            stdout=subprocess.PIPE)
+    port = int(server.stdout.readline())
+    return server, "http://127.0.0.1:%d" % port
+
+
+def configure(args, bin, rest_url=None):
+    """ Point kglimits at the fakes, before it reads its settings. """
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "karaage.conf.settings")
+    from django.conf import settings
+    settings.SLURM_PATH = os.path.join(bin, "sacctmgr")
+    settings.SLURM_PREFIX = []
+    settings.SLURM_QUEUE = None
+    if rest_url is not None:
+        settings.SLURM_REST_URL = rest_url
+        settings.SLURM_REST_CLUSTER = "bench"
+    settings.GOLD_PATH = bin
+    settings.GOLD_PREFIX = []
+    settings.GOLD_QUEUE = None
+    if args.sessions is not None:
+        settings.SLURM_SESSIONS = args.sessions
+        settings.GOLD_SESSIONS = args.sessions
+    if args.concurrency is not None:
+        settings.SLURM_CONCURRENCY = args.concurrency
+        settings.GOLD_CONCURRENCY = args.concurrency
+
+    import django
+    django.setup()
+    for backend in args.backends.split(","):
+        __import__("kglimits.%s" % backend)
+
+
+def read_log(path, offset):
+    """ Count the fake log entries after offset. """
+    counts = dict([ (c, 0) for c in COUNTERS if c != "issued" ])
+    if not os.path.exists(path):
+        return counts, offset
+    f = open(path)
+    try:
+        f.seek(offset)
+        for line in f:
+            kind = line.split(" ", 1)[0]
+            if kind in ("start", "connect"):
+                counts["processes"] = counts["processes"] + 1
+            elif kind == "cmd":
+                counts["commands"] = counts["commands"] + 1
+            elif kind == "sentinel":
+                counts["sentinels"] = counts["sentinels"] + 1
+        return counts, f.tell()
+    finally:
+        f.close()
+
+
+def issued():
+    from kglimits import metrics
+    return sum(metrics.registry.handler_commands.values())
+
+
+def run_scenarios(args, log):
+    from django.db import connection
+    import scenarios
+
+    results = {}
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        context = scenarios.Context(args.accounts, args.members)
+        scenarios.setup(context)
+        counts, offset = read_log(log, 0)
+
+        for name, scenario in scenarios.SCENARIOS:
+            before = issued()
+            start = time.time()
+            scenario(context)
+            wall = time.time() - start
+            counts, offset = read_log(log, offset)
+            counts["issued"] = issued() - before
+            counts["wall"] = wall
+            results[name] = counts
+            print_result(name, counts)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+    return results
+
+
+def print_result(name, counts):
+    print "%-16s %8.2fs %s" % (name, counts["wall"],
+        " ".join([ "%s=%d" % (c, counts[c]) for c in COUNTERS ]))
+    sys.stdout.flush()
+
+
+def compare(results, baseline, tolerance):
+    """ Returns the regressions against baseline, as text. """
+    regressions = []
+    for name, counts in sorted(results.items()):
+        before = baseline.get(name)
+        if before is None:
+            continue
+        for c in COUNTERS:
+            if counts[c] > before.get(c, 0):
+                regressions.append("%s: %s %d -> %d"
+                    % (name, c, before.get(c, 0), counts[c]))
+        if counts["wall"] > before["wall"] * (1 + tolerance):
+            regressions.append("%s: wall %.2fs -> %.2fs"
+                % (name, before["wall"], counts["wall"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark kglimits.")
+    parser.add_argument("--backends", default="slurm,gold",
+        help="comma separated kglimits backends to load")
+    parser.add_argument("--accounts", type=int, default=1000,
+        help="accounts to create")
+    parser.add_argument("--members", type=int, default=500,
+        help="people to add to one project at once")
+    parser.add_argument("--startup", type=float, default=0.1,
+        help="seconds a fake takes to start")
+    parser.add_argument("--latency", type=float, default=0.005,
+        help="seconds a fake takes for each command")
+    parser.add_argument("--sessions", type=int,
+        help="SLURM_SESSIONS and GOLD_SESSIONS")
+    parser.add_argument("--concurrency", type=int,
+        help="SLURM_CONCURRENCY and GOLD_CONCURRENCY")
+    parser.add_argument("--rest", action="store_true",
+        help="run Slurm commands through the stand-in slurmrestd")
+    parser.add_argument("--output", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare with earlier results")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+        help="fraction of extra wall time allowed over the baseline")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="kglimits-bench-")
+    server = None
+    try:
+        bin, state = make_fakes(directory)
+        log = os.path.join(directory, "fake.log")
+        os.environ["FAKE_STATE"] = state
+        os.environ["FAKE_LOG"] = log
+        os.environ["FAKE_STARTUP"] = "%f" % args.startup
+        os.environ["FAKE_LATENCY"] = "%f" % args.latency
+
+        rest_url = None
+        if args.rest:
+            server, rest_url = start_slurmrestd()
+
+        sys.path.insert(0, BENCH)
+        configure(args, bin, rest_url)
+        results = run_scenarios(args, log)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(directory)
+
+    if args.output:
+        f = open(args.output, "w")
+        try:
+            json.dump(results, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    if args.baseline:
+        f = open(args.baseline)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print "REGRESSION %s" % regression
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,95 @@
+"""
+Benchmark scenarios, driven through the Karaage models so every change goes
+through the same Django signals as an admin action would.
+
+Each scenario is a function of a Context, that holds what earlier
+scenarios created. Scenarios run in the order of SCENARIOS, and each may
+rely on the ones before it.
+"""
+import datetime
+
+from django.db import transaction
+from django.contrib.auth.models import User
+
+from karaage.people.models import Person, Institute
+from karaage.machines.models import UserAccount, MachineCategory
+from karaage.projects.models import Project
+
+
+class Context(object):
+
+    def __init__(self, accounts, members):
+        self.accounts = accounts
+        self.members = members
+        self.institute = None
+        self.category = None
+        self.projects = []
+        self.people = []
+
+
+def make_project(context, pid):
+    project = Project.objects.create(pid=pid, name="Benchmark %s" % pid,
+            institute=context.institute, is_active=True)
+    context.projects.append(project)
+    return project
+
+
+def make_person(context, username, project):
+    user = User.objects.create_user(username, "%s@example.com" % username)
+    user.first_name = "Bench"
+    user.last_name = username
+    user.save()
+    person = Person.objects.create(user=user, institute=context.institute)
+    UserAccount.objects.create(user=person, username=username,
+            machine_category=context.category, default_project=project,
+            date_created=datetime.date.today())
+    context.people.append(person)
+    return person
+
+
+def setup(context):
+    """ An institute and a project for the accounts to go in. """
+    with transaction.atomic():
+        context.institute = Institute.objects.create(name="Benchmark")
+        context.category = MachineCategory.objects.create(name="bench")
+        make_project(context, "bench0")
+
+
+def create_accounts(context):
+    """ Create people with accounts, one admin action each. """
+    project = context.projects[0]
+    for i in range(context.accounts):
+        with transaction.atomic():
+            person = make_person(context, "bench%04d" % i, project)
+            project.users.add(person)
+
+
+def add_members(context):
+    """ Add many people to a new project at once. """
+    with transaction.atomic():
+        project = make_project(context, "bench1")
+    with transaction.atomic():
+        project.users.add(*context.people[:context.members])
+
+
+def person_updates(context):
+    """ Change the email address of every person, one admin action each. """
+    for person in context.people:
+        with transaction.atomic():
+            person.user.email = "changed-%s" % person.user.email
+            person.user.save()
+            person.save()
+
+
+def clear_project(context):
+    """ Remove every member of a project at once. """
+    with transaction.atomic():
+        context.projects[1].users.clear()
+
+
+SCENARIOS = [
+    ("create_accounts", create_accounts),
+    ("add_members", add_members),
+    ("person_updates", person_updates),
+    ("clear_project", clear_project),
+]
@@ -0,0 +1,263 @@
+"""
+A broker that runs backend commands for every Karaage process on a host.
+
+Without it each web server worker starts its own sudo sacctmgr or Gold
+commands, paying for sudo and process start up in every worker, and
+nothing orders the changes different workers make to the same account. The
+broker runs as the backend's user (kg-manage slurm_broker, kg-manage
+gold_broker) and listens on a Unix socket. Clients send it requests of JSON
+encoded commands, one request per line, and get back one line with the
+return code and output of each:
+
+    {"commands": [{"args": ["list", "user", "where", "name=bob"], "timeout": 120}]}
+    {"results": [{"returncode": 0, "output": ["User|\\n", "bob|\\n"]}]}
+
+The broker keeps warm sessions, and runs commands one batch at a time:
+whatever arrived while the last batch ran, or within a short window. The
+backend merges the commands of a batch, so repeats run once and, for
+Slurm, association changes from many workers run as one sacctmgr command.
+Commands stood for by a merged command that failed are run again on their
+own, so every caller gets its own result.
+"""
+import os
+import json
+import time
+import socket
+import threading
+import SocketServer
+import Queue
+
+from kglimits.timeouts import CommandTimeout
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def merge_repeats(commands):
+    """
+    Merge commands that repeat the one before. Returns (command, indices of
+    the commands it stands for) in order.
+    """
+    groups = []
+    for i, command in enumerate(commands):
+        if groups and groups[-1][0] == command:
+            groups[-1][1].append(i)
+        else:
+            groups.append((command, [ i ]))
+    return groups
+
+
+def _timeout(timeouts):
+    """ The longest of timeouts, or None if any is None. """
+    if None in timeouts:
+        return None
+    return max(timeouts)
+
+
+class Request(object):
+    """ Commands from one client, waiting for their results. """
+
+    def __init__(self, commands):
+        self.commands = commands
+        self.results = None
+        self.done = threading.Event()
+
+
+class Broker(object):
+    """
+    Runs batches of requests with transport_for(args), which gives the
+    transport for a command or None if it isn't allowed, and
+    merge(commands), which says which commands can run as one.
+    """
+
+    def __init__(self, transport_for, merge=merge_repeats, window=0.005):
+        self.transport_for = transport_for
+        self.merge = merge
+        self.window = window
+        self.queue = Queue.Queue()
+
+    def submit(self, commands):
+        """ Run commands, a list of (args, timeout), returning the results. """
+        request = Request(commands)
+        self.queue.put(request)
+        request.done.wait()
+        return request.results
+
+    def next_batch(self):
+        batch = [ self.queue.get() ]
+        deadline = time.time() + self.window
+        while True:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    batch.append(self.queue.get(True, remaining))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                return batch
+
+    def run_forever(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                self.run_batch(batch)
+            except Exception, e:
+                logger.exception("Batch failed: %s" % e)
+                for request in batch:
+                    if request.results is None:
+                        request.results = [ { "returncode": -1, "output": [] }
+                            for command in request.commands ]
+            for request in batch:
+                request.done.set()
+
+    def run(self, args, timeout):
+        """ Run one command, returning its result. """
+        transport = self.transport_for(args)
+        if transport is None:
+            logger.error("Cmd %s not allowed" % args)
+            return { "returncode": 1, "output": [] }
+        logger.debug("Cmd %s" % args)
+        try:
+            p = transport.popen(args, timeout)
+            output = [ line.decode("utf-8", "replace") for line in p.stdout ]
+            returncode = p.wait()
+        except CommandTimeout:
+            return { "returncode": -1, "output": [], "timeout": True }
+        logger.debug("<-- Cmd %s returned %d" % (args, returncode))
+        return { "returncode": returncode, "output": output }
+
+    def run_batch(self, batch):
+        commands = []
+        for request in batch:
+            commands.extend(request.commands)
+        results = [ None ] * len(commands)
+
+        groups = self.merge([ args for args, timeout in commands ])
+        logger.debug("Running %d commands from %d requests as %d"
+            % (len(commands), len(batch), len(groups)))
+        for args, members in groups:
+            result = self.run(args, _timeout([ commands[i][1] for i in members ]))
+            for i in members:
+                if results[i] is not None:
+                    continue
+                if commands[i][0] == args or result.get("timeout"):
+                    results[i] = result
+                elif result["returncode"] != 0:
+                    # find out which of the merged commands failed
+                    results[i] = self.run(*commands[i])
+        # merged commands that all succeeded
+        for i in range(len(results)):
+            if results[i] is None:
+                results[i] = { "returncode": 0, "output": [] }
+
+        for request in batch:
+            request.results = results[:len(request.commands)]
+            results = results[len(request.commands):]
+
+
+class Handler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            try:
+                request = json.loads(line)
+                commands = [ ([ arg.encode("utf-8") for arg in c["args"] ],
+                    c.get("timeout")) for c in request["commands"] ]
+            except (ValueError, KeyError, TypeError, AttributeError), e:
+                logger.error("Bad request %r: %s" % (line, e))
+                return
+            results = self.server.broker.submit(commands)
+            self.wfile.write(json.dumps({ "results": results }) + "\n")
+            self.wfile.flush()
+
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+    # every worker of every web server may connect at once
+    request_queue_size = 128
+
+
+def serve(path, broker, mode=0660):
+    """ Listen on a Unix socket at path and run requests with broker. """
+    if os.path.exists(path):
+        os.unlink(path)
+    server = Server(path, Handler)
+    os.chmod(path, mode)
+    server.broker = broker
+    runner = threading.Thread(target=broker.run_forever)
+    runner.daemon = True
+    runner.start()
+    logger.info("Broker listening on %s" % path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+class BrokerTransport(object):
+    """ Run commands through a broker listening on the Unix socket at path. """
+
+    def __init__(self, path):
+        self.path = path
+
+    def popen(self, args, timeout=None):
+        return BrokerProcess(self.path, args, timeout)
+
+    def close(self):
+        pass
+
+
+class BrokerProcess(object):
+    """ Looks like subprocess.Popen for one command run by a broker. """
+
+    def __init__(self, path, args, timeout=None):
+        self.returncode = None
+        self.stdout = self._lines(path, args, timeout)
+
+    def _lines(self, path, args, timeout):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            # the broker may be busy with other workers' commands first
+            if timeout is not None:
+                s.settimeout(timeout * 2)
+            try:
+                s.connect(path)
+                s.sendall(json.dumps({ "commands": [
+                    { "args": args, "timeout": timeout } ] }) + "\n")
+                f = s.makefile("r")
+                line = f.readline()
+                f.close()
+            except socket.timeout:
+                logger.error("Cmd %s timed out waiting for the broker" % args)
+                self.returncode = -1
+                raise CommandTimeout(args, timeout * 2)
+            except socket.error, e:
+                logger.error("Cmd %s not run, broker %s: %s" % (args, path, e))
+                self.returncode = -1
+                return
+        finally:
+            s.close()
+
+        try:
+            result = json.loads(line)["results"][0]
+        except (ValueError, KeyError, IndexError), e:
+            logger.error("Cmd %s got a bad answer from the broker: %r"
+                % (args, line))
+            self.returncode = -1
+            return
+        if result.get("timeout"):
+            self.returncode = -1
+            raise CommandTimeout(args, timeout)
+        self.returncode = result["returncode"]
+        for line in result["output"]:
+            yield line.encode("utf-8")
+
+    def wait(self):
+        for line in self.stdout:
+            pass
+        return self.returncode
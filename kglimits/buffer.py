@@ -0,0 +1,331 @@
+"""
+Per transaction buffer of backend commands.
+
+While a database transaction is open, commands given to call() are parsed
+into operations on entities (users, accounts, projects, memberships) and
+kept until the transaction commits. Operations are coalesced as they
+arrive:
+
+* a command identical to the last one on the same entities is dropped,
+* modifications of one entity are merged into a single command,
+* deleting an entity drops earlier operations on it and on what it owns,
+  down to single items of a command on many items.
+
+The buffer is run when the transaction commits, and thrown away if it
+rolls back. Its hook belongs to the outermost atomic block, wherever the
+first command was buffered, so commands buffered inside a savepoint that
+rolls back are still run with the rest.
+
+The flush gets the time the handlers that buffered the commands had left
+of their deadlines (kglimits.timeouts), added together and counted from
+when it starts, so a transaction that ran many handlers gets the time of
+all of them. Each command still has its own timeout.
+
+While a plan (kglimits.plan) is active, commands go to the plan's buffers
+instead, in or out of a transaction, and are only run if the plan is.
+
+Each backend supplies an object with:
+
+* name: used to keep one buffer per backend,
+* parse(command, ignore_errors): returns an Operation,
+* owned(key, owner): True if deleting owner also deletes key,
+* execute(command, ignore_errors): runs a command now,
+* executor: an Executor, to run independent operations at the same time.
+"""
+import time
+import threading
+import subprocess
+
+from kglimits import timeouts
+from kglimits.timeouts import Unavailable
+
+from django.db import transaction
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CommandErrors(subprocess.CalledProcessError):
+    """ One or more commands failed. """
+
+    def __init__(self, errors):
+        subprocess.CalledProcessError.__init__(self, errors[0].returncode,
+            [ e.cmd for e in errors ])
+        self.errors = errors
+
+    def __str__(self):
+        return "%d commands failed: %s" % (len(self.errors),
+            "; ".join([ "%s" % e for e in self.errors ]))
+
+
+class Operation(object):
+    """
+    One command as a change to an entity.
+
+    key identifies the entity, such as ("user", "bob"), and entities is the
+    set of keys the command touches. Commands we don't understand have no
+    key and are kept in order with everything else. Modifications keep the
+    attributes they set as (name, args) pairs between prefix and suffix, so
+    they can be merged and written out again. Commands acting on many items
+    at once list the equivalent command for each item in parts.
+    """
+
+    def __init__(self, command, ignore_errors, key=None, action=None,
+            entities=None, prefix=None, attributes=None, suffix=None,
+            parts=None):
+        self.command = command
+        self.ignore_errors = list(ignore_errors)
+        self.key = key
+        self.action = action
+        self.entities = entities or set()
+        if key is not None:
+            self.entities.add(key)
+        self.prefix = prefix
+        self.attributes = attributes
+        self.suffix = suffix
+        self.parts = parts
+        # failures are ignored, as the entity may not exist
+        self.tolerant = False
+
+    def related(self, other):
+        if self.key is None or other.key is None:
+            return True
+        return bool(self.entities & other.entities)
+
+    def merge(self, other):
+        """ Add the attributes set by a later modification. """
+        attributes = [ a for a in self.attributes
+            if a[0] not in [ b[0] for b in other.attributes ] ]
+        attributes.extend(other.attributes)
+        self.attributes = attributes
+        for code in other.ignore_errors:
+            if code not in self.ignore_errors:
+                self.ignore_errors.append(code)
+        self.command = []
+        self.command.extend(self.prefix)
+        for name, args in self.attributes:
+            self.command.extend(args)
+        self.command.extend(self.suffix)
+
+
+class CommandBuffer(object):
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.operations = []
+        self.requested = 0
+        # deadline of each handler that buffered commands -> seconds it had
+        # left, or None if one had no deadline
+        self.budgets = {}
+
+    def add(self, command, ignore_errors=[]):
+        self.requested = self.requested + 1
+        deadline = timeouts.current_deadline()
+        if deadline is None:
+            self.budgets = None
+        elif self.budgets is not None:
+            self.budgets[deadline] = max(0, deadline - time.time())
+        op = self.backend.parse(command, ignore_errors)
+        if op.action == "delete":
+            self._supersede(op)
+
+        previous = None
+        for other in reversed(self.operations):
+            if op.related(other):
+                previous = other
+                break
+
+        if previous is not None:
+            if previous.command == op.command:
+                for code in op.ignore_errors:
+                    if code not in previous.ignore_errors:
+                        previous.ignore_errors.append(code)
+                return
+            if op.action == "modify" and previous.action == "modify" \
+                    and previous.key == op.key \
+                    and previous.prefix == op.prefix:
+                previous.merge(op)
+                return
+
+        self.operations.append(op)
+
+    def _supersede(self, op):
+        operations = []
+        for other in self.operations:
+            if other.key is not None and (other.key == op.key
+                    or self.backend.owned(other.key, op.key)):
+                if other.key == op.key and other.action == "add":
+                    op.tolerant = True
+                continue
+            if other.parts:
+                # keep the items of a command on many items that op doesn't
+                # delete, as a command each
+                parts = [ self.backend.parse(part, other.ignore_errors)
+                    for part in other.parts ]
+                kept = [ p for p in parts if p.key is None
+                    or not self.backend.owned(p.key, op.key) ]
+                if len(kept) < len(parts):
+                    operations.extend(kept)
+                    continue
+            operations.append(other)
+        self.operations = operations
+
+    def state(self, key):
+        """ The last add or delete of key waiting to be run, if any. """
+        for op in reversed(self.operations):
+            if op.key == key and op.action in ("add", "delete"):
+                return op.action
+        return None
+
+    def flush(self, bounded=True):
+        """
+        Run the buffered commands, within the time their handlers had left
+        unless bounded is False.
+        """
+        operations = self.operations
+        self.operations = []
+        logger.debug("Running %d commands for %d requested"
+            % (len(operations), self.requested))
+        self.requested = 0
+        budget = None
+        if bounded and self.budgets is not None:
+            budget = sum(self.budgets.values())
+        self.budgets = {}
+
+        def run_tolerant(op):
+            try:
+                run(self.backend, op)
+            except subprocess.CalledProcessError, e:
+                # a command that ran out of time may not have been run at all
+                if not op.tolerant or isinstance(e, Unavailable):
+                    raise
+                logger.debug("Cmd %s failed (ignored)" % op.command)
+
+        @timeouts.deadline(budget)
+        def run_all():
+            self.backend.executor.run(operations, run_tolerant)
+        run_all()
+
+
+# Run an operation now
+# If a command acting on many items fails, its parts are run one at a time
+# to find out which items failed, unless it ran out of time.
+def run(backend, op):
+    try:
+        backend.execute(op.command, op.ignore_errors)
+    except subprocess.CalledProcessError, e:
+        if not op.parts or isinstance(e, Unavailable):
+            raise
+        logger.debug("Cmd %s failed, trying %d parts one at a time"
+            % (op.command, len(op.parts)))
+        errors = []
+        for part in op.parts:
+            try:
+                backend.execute(part, op.ignore_errors)
+            except subprocess.CalledProcessError, e:
+                errors.append(e)
+        if errors:
+            raise CommandErrors(errors)
+
+
+_local = threading.local()
+
+
+def _buffers():
+    if not hasattr(_local, "buffers"):
+        _local.buffers = {}
+    return _local.buffers
+
+
+# Django keeps the hooks waiting for the transaction to commit in
+# connection.run_on_commit, as (savepoint ids, func) or, from Django 4.2,
+# (savepoint ids, func, robust). These two are all that look at it.
+
+# True if func is still waiting for the transaction to commit
+def on_commit_pending(connection, func):
+    for hook in connection.run_on_commit:
+        if hook[1] == func:
+            return True
+    return False
+
+
+# Run func when the transaction commits, like transaction.on_commit but as
+# if registered by the outermost atomic block, so rolling back a savepoint
+# doesn't discard it
+def on_outer_commit(connection, func):
+    transaction.on_commit(func, using=connection.alias)
+    hook = connection.run_on_commit[-1]
+    connection.run_on_commit[-1] = (set(),) + tuple(hook[1:])
+
+
+# Use buffers, a dict of backend name to CommandBuffer, for every command
+# until pop_buffers() is called
+def push_buffers(buffers):
+    if not hasattr(_local, "plans"):
+        _local.plans = []
+    _local.plans.append(buffers)
+
+def pop_buffers(buffers):
+    _local.plans.remove(buffers)
+
+# True if commands are going to buffers given to push_buffers()
+def planning():
+    return bool(getattr(_local, "plans", []))
+
+# Get the buffer of backend for the current plan or transaction
+# Returns None outside a plan and transaction (or if transactional is False),
+# or if create is False and nothing has been buffered yet.
+def get_buffer(backend, create=True, transactional=True):
+    plans = getattr(_local, "plans", [])
+    if plans:
+        buf = plans[-1].get(backend.name)
+        if buf is None and create:
+            buf = plans[-1][backend.name] = CommandBuffer(backend)
+        return buf
+    if not transactional:
+        return None
+
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        return None
+
+    buffers = _buffers()
+    buf, commit = buffers.get(backend.name, (None, None))
+    if buf is not None and not on_commit_pending(connection, commit):
+        # the transaction rolled back and took our on_commit hook with it
+        logger.debug("Discarding %d commands rolled back"
+            % len(buf.operations))
+        buf = None
+        del buffers[backend.name]
+
+    if buf is None and create:
+        buf = CommandBuffer(backend)
+
+        def commit():
+            del _buffers()[backend.name]
+            buf.flush()
+
+        buffers[backend.name] = (buf, commit)
+        on_outer_commit(connection, commit)
+
+    return buf
+
+
+# Buffer command if we are in a plan, or in a transaction and transactional
+# is True
+# Returns False if the caller should run the command now.
+def add(backend, command, ignore_errors=[], transactional=True):
+    buf = get_buffer(backend, transactional=transactional)
+    if buf is None:
+        return False
+    buf.add(command, ignore_errors)
+    return True
+
+
+# The last buffered add or delete of an entity, if any
+def pending_action(backend, key):
+    buf = get_buffer(backend, create=False)
+    if buf is None:
+        return None
+    return buf.state(key)
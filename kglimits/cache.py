@@ -0,0 +1,262 @@
+"""
+Cache of backend lookups.
+
+Results of the get_* readers are kept for the rest of the current scope: a
+web request (with LookupCacheMiddleware), a database transaction, or an
+explicit "with scope():" block. With a ttl they are also shared between
+threads and scopes for that many seconds.
+
+Threads asking the same question at the same time share one lookup. Every
+command given to call() forgets cached results about the entities it
+touches, in every open scope, as commands may be run by other threads.
+
+A cache with a partition function keeps results, and forgets them, apart
+for each value it returns, such as the Slurm cluster being looked at.
+"""
+import time
+import weakref
+import threading
+
+from django.db import transaction
+
+from kglimits.buffer import on_commit_pending
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+# every scope still in use, by any thread
+_scopes = weakref.WeakSet()
+
+
+class Scope(object):
+
+    def __init__(self):
+        self.results = {}
+        _scopes.add(self)
+
+    def __enter__(self):
+        if not hasattr(_local, "scopes"):
+            _local.scopes = []
+        _local.scopes.append(self)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        _local.scopes.remove(self)
+        return False
+
+
+def scope():
+    """ Cache lookups until the end of the with block. """
+    return Scope()
+
+
+def current_scope():
+    scopes = getattr(_local, "scopes", [])
+    if scopes:
+        return scopes[-1]
+
+    # otherwise the current transaction, if any
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        return None
+    current = getattr(_local, "transaction", None)
+    if current is not None and on_commit_pending(connection, current[1]):
+        return current[0]
+
+    s = Scope()
+
+    def end():
+        if getattr(_local, "transaction", None) is not None \
+                and _local.transaction[0] is s:
+            _local.transaction = None
+
+    _local.transaction = (s, end)
+    transaction.on_commit(end)
+    return s
+
+
+class LookupCacheMiddleware(object):
+    """ Cache lookups for the duration of each request. """
+
+    def __init__(self, get_response=None):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with scope():
+            return self.get_response(request)
+
+    def process_request(self, request):
+        scope().__enter__()
+
+    def process_response(self, request, response):
+        scopes = getattr(_local, "scopes", [])
+        if scopes:
+            scopes[-1].__exit__(None, None, None)
+        return response
+
+
+class Flight(object):
+    """ A lookup being run by one thread that others can wait for. """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class Entry(object):
+
+    def __init__(self, value, tags, expires):
+        self.value = value
+        self.tags = tags
+        self.expires = expires
+
+
+class LookupCache(object):
+
+    def __init__(self, ttl=0, partition=None):
+        self.ttl = ttl
+        self.partition = partition
+        self._lock = threading.Lock()
+        self._shared = {}
+        self._flights = {}
+        self._generation = 0
+
+    def _results(self, s):
+        return s.results.setdefault(id(self), {})
+
+    def cached(self, tags):
+        """
+        Decorator for lookups. tags is called with the same arguments as
+        the lookup, and returns the entity keys the result depends on.
+        """
+        def decorator(func):
+            def lookup(*args):
+                return self._lookup(self._key((func.__name__,) + args),
+                        self._tags(tags(*args)), func, args)
+            lookup.__name__ = func.__name__
+            lookup.__doc__ = func.__doc__
+            lookup.uncached = func
+            return lookup
+        return decorator
+
+    def _key(self, key):
+        if self.partition is None:
+            return key
+        return (self.partition(), key)
+
+    def _tags(self, tags):
+        if self.partition is None:
+            return set(tags)
+        part = self.partition()
+        return set([ (part, tag) for tag in tags ])
+
+    def get(self, key):
+        """ Returns the cached entry for key, or None. """
+        return self._get(self._key(key))
+
+    def _get(self, key):
+        s = current_scope()
+        if s is not None:
+            entry = self._results(s).get(key)
+            if entry is not None:
+                return entry
+        self._lock.acquire()
+        try:
+            entry = self._shared.get(key)
+            if entry is not None and entry.expires < time.time():
+                del self._shared[key]
+                entry = None
+            return entry
+        finally:
+            self._lock.release()
+
+    def put(self, key, value, tags):
+        """ Remember a value in the current scope, and for ttl seconds. """
+        self._put(self._key(key), value, self._tags(tags))
+
+    def _put(self, key, value, tags):
+        s = current_scope()
+        if s is not None:
+            self._results(s)[key] = Entry(value, tags, None)
+        if self.ttl > 0:
+            self._lock.acquire()
+            try:
+                self._shared[key] = Entry(value, tags, time.time() + self.ttl)
+            finally:
+                self._lock.release()
+
+    def _lookup(self, key, tags, func, args):
+        entry = self._get(key)
+        if entry is not None:
+            logger.debug("Cached %s" % (key,))
+            return entry.value
+
+        self._lock.acquire()
+        flight = self._flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = Flight()
+            self._flights[key] = flight
+        generation = self._generation
+        self._lock.release()
+
+        if not leader:
+            logger.debug("Waiting for %s" % (key,))
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            try:
+                flight.value = func(*args)
+            except Exception, e:
+                flight.error = e
+                raise
+        finally:
+            self._lock.acquire()
+            del self._flights[key]
+            # don't keep results a write may have made stale
+            fresh = generation == self._generation
+            self._lock.release()
+            flight.done.set()
+
+        if fresh:
+            self._put(key, flight.value, tags)
+        return flight.value
+
+    def invalidate(self, entities=None):
+        """
+        Forget results depending on any of entities, or all results (of the
+        current partition) if entities is None.
+        """
+        part = None
+        if self.partition is not None:
+            part = self.partition()
+            if entities is not None:
+                entities = self._tags(entities)
+
+        def keep(key, entry):
+            if entities is None:
+                # everything in this partition
+                return part is not None and key[0] != part
+            return not (entry.tags & entities)
+
+        self._lock.acquire()
+        try:
+            self._generation = self._generation + 1
+            for key, entry in self._shared.items():
+                if not keep(key, entry):
+                    del self._shared[key]
+        finally:
+            self._lock.release()
+
+        for s in list(_scopes):
+            results = s.results.get(id(self), {})
+            for key, entry in results.items():
+                if not keep(key, entry):
+                    results.pop(key, None)
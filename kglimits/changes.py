@@ -0,0 +1,133 @@
+"""
+Field level change detection for signal handlers.
+
+A save used to send every value of an object to the backend, even when it
+only touched a field the backend doesn't have, such as a last login time.
+A Tracker takes a snapshot of the values a backend gets from an object,
+read from the database at pre_save, and compares them with the saved
+object at post_save. The post_save handler is then given the names of the
+values that changed, or None if everything should be sent because the
+object is new or there was nothing to compare with.
+
+Values are compared after the same normalization (filter_string, truncate)
+as the commands use, so a change the backend can't see isn't sent either.
+
+    project_tracker = Tracker(Project, {
+        "description": lambda project: filter_string(project.name),
+    })
+
+    @project_tracker.watch
+    def project_saved(sender, instance, created, changed=None, **kwargs):
+        if changed is None or "description" in changed:
+            ...
+"""
+import threading
+
+from django.core.signals import request_finished
+from django.db import transaction
+from django.db.models import signals
+
+from kglimits.buffer import on_outer_commit
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Tracker(object):
+
+    def __init__(self, model, fields):
+        """
+        fields maps the name of each value to a function that gets it from
+        an instance of model.
+        """
+        self.model = model
+        self.fields = fields
+        self._local = threading.local()
+        signals.pre_save.connect(self.pre_save, sender=model, weak=False)
+        request_finished.connect(self.clear, weak=False)
+
+    def values(self, instance):
+        return dict([ (name, value(instance))
+            for name, value in self.fields.items() ])
+
+    def snapshots(self):
+        if not hasattr(self._local, "snapshots"):
+            self._local.snapshots = {}
+        return self._local.snapshots
+
+    def snapshot(self, pk):
+        """
+        Snapshot the stored values of an object, unless already taken.
+        Returns True if it was taken now.
+        """
+        snapshots = self.snapshots()
+        if pk is None or pk in snapshots:
+            return False
+        try:
+            stored = self.model._default_manager.get(pk=pk)
+        except self.model.DoesNotExist:
+            return False
+        snapshots[pk] = self.values(stored)
+        return True
+
+    def forget(self, pks):
+        snapshots = self.snapshots()
+        for pk in pks:
+            snapshots.pop(pk, None)
+
+    def clear(self, **kwargs):
+        """ Forget every snapshot of this thread, at the end of a request. """
+        self._local.snapshots = {}
+
+    def pre_save(self, sender, instance, raw=False, **kwargs):
+        if not raw:
+            self.snapshot(instance.pk)
+
+    def follow(self, model, lookup):
+        """
+        Also take snapshots before saving an instance of another model that
+        values are read from. lookup(instance) gives the primary keys of
+        the tracked objects that read from it.
+
+        A snapshot taken this way is kept until the tracked object itself is
+        saved, so the change is still seen then, but no longer than the
+        transaction or the request; if the tracked object is saved after
+        that, everything is sent.
+        """
+        def pre_save(sender, instance, raw=False, **kwargs):
+            if raw or instance.pk is None:
+                return
+            taken = [ pk for pk in lookup(instance) if self.snapshot(pk) ]
+            connection = transaction.get_connection()
+            if taken and connection.in_atomic_block:
+                on_outer_commit(connection, lambda: self.forget(taken))
+        signals.pre_save.connect(pre_save, sender=model, weak=False)
+
+    def changed(self, instance, created):
+        """
+        Names of the values that changed since the snapshot, or None if
+        there is nothing to compare with.
+        """
+        snapshot = self.snapshots().pop(instance.pk, None)
+        if created or snapshot is None:
+            return None
+        values = self.values(instance)
+        return sorted([ name for name in values
+            if values[name] != snapshot.get(name) ])
+
+    def watch(self, func):
+        """
+        Decorator for post_save handlers, that passes the names of the
+        changed values as changed. It goes above a deferred() decorator, so
+        queued signals keep what changed.
+        """
+        def handler(sender, instance, created=False, **kwargs):
+            changed = self.changed(instance, created)
+            logger.debug("%s changed %s" % (instance, changed))
+            return func(sender, instance, created=created, changed=changed,
+                **kwargs)
+        handler.__name__ = func.__name__
+        handler.__doc__ = func.__doc__
+        handler.handler = getattr(func, "handler", func)
+        return handler
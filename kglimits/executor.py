@@ -0,0 +1,155 @@
+"""
+Bounded parallel execution of independent backend commands.
+
+Operations are split into lanes: an operation joins the lane of every
+earlier operation it conflicts with (one writes an entity the other
+touches, or either isn't understood), and lanes it joins are merged.
+Operations in a lane run in order, one after another; lanes run at the same
+time on up to concurrency threads.
+
+A failure doesn't stop later operations, even in the same lane, just as a
+buffer flush carries on after one. Failures are collected and raised
+together as one CommandErrors.
+"""
+import sys
+import threading
+import subprocess
+
+from kglimits import metrics
+from kglimits import plan
+from kglimits import timeouts
+from kglimits.buffer import CommandErrors
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def conflicts(op, other):
+    """ True if op and other must run in the order they were given. """
+    if op.key is None or other.key is None:
+        return True
+    return op.key == other.key or op.key in other.entities \
+        or other.key in op.entities
+
+
+def lanes(operations):
+    """ Split operations into lists that can run at the same time. """
+    result = []
+    for i, op in enumerate(operations):
+        joined = [ lane for lane in result
+            if [ other for j, other in lane if conflicts(op, other) ] ]
+        lane = [ (i, op) ]
+        for other in joined:
+            result.remove(other)
+            lane.extend(other)
+        lane.sort()
+        result.append(lane)
+    return [ [ op for i, op in lane ] for lane in result ]
+
+
+class Executor(object):
+
+    def __init__(self, concurrency=1, context=None):
+        self.concurrency = concurrency
+        # called in the calling thread, returns a function that makes a
+        # worker act for it too
+        self.context = context
+
+    def _work(self, tasks):
+        """
+        Call each task on up to concurrency threads. Returns a list of
+        exc_info, or None, for each task.
+        """
+        failures = [ None ] * len(tasks)
+        if self.concurrency <= 1 or len(tasks) <= 1:
+            for i, task in enumerate(tasks):
+                try:
+                    task()
+                except Exception:
+                    failures[i] = sys.exc_info()
+            return failures
+
+        lock = threading.Lock()
+        pending = list(enumerate(tasks))
+        pending.reverse()
+        # workers act for the calling thread
+        handler = metrics.current_handler()
+        current = plan.current_plan()
+        deadline = timeouts.current_deadline()
+        adopt = None
+        if self.context is not None:
+            adopt = self.context()
+
+        def worker():
+            metrics.set_handler(handler)
+            timeouts.set_deadline(deadline)
+            if adopt is not None:
+                adopt()
+            if current is not None:
+                current.adopt()
+            while True:
+                lock.acquire()
+                try:
+                    if not pending:
+                        return
+                    i, task = pending.pop()
+                finally:
+                    lock.release()
+                try:
+                    task()
+                except Exception:
+                    failures[i] = sys.exc_info()
+
+        threads = []
+        for n in range(min(self.concurrency, len(tasks))):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return failures
+
+    def run(self, operations, func):
+        """
+        Call func on each operation, keeping the order of conflicting
+        operations. Raises CommandErrors if any commands failed.
+        """
+        errors = []
+
+        def task(lane):
+            def run_lane():
+                for op in lane:
+                    try:
+                        func(op)
+                    except CommandErrors, e:
+                        errors.extend(e.errors)
+                    except subprocess.CalledProcessError, e:
+                        errors.append(e)
+            return run_lane
+
+        parallel = lanes(operations)
+        if len(parallel) > 1:
+            logger.debug("Running %d commands in %d lanes"
+                % (len(operations), len(parallel)))
+        for failure in self._work([ task(lane) for lane in parallel ]):
+            if failure is not None:
+                raise failure[0], failure[1], failure[2]
+        if errors:
+            raise CommandErrors(errors)
+
+    def map(self, func, items):
+        """ Call func on each item at the same time, returning the results. """
+        results = [ None ] * len(items)
+
+        def task(i, item):
+            def call():
+                results[i] = func(item)
+            return call
+
+        for failure in self._work([ task(i, item)
+                for i, item in enumerate(items) ]):
+            if failure is not None:
+                raise failure[0], failure[1], failure[2]
+        return results
@@ -1,4 +1,4 @@
-from django.db.models import signals
+from django.db.models import signals, Q
 from karaage.people.models import Person, Institute
 from karaage.machines.models import UserAccount
 from karaage.projects.models import Project
@@ -6,6 +6,20 @@ from datetime import datetime
 import subprocess
 import csv
 
+from kglimits import buffer
+from kglimits import cache
+from kglimits import workqueue
+from kglimits import executor
+from kglimits import rows
+from kglimits import metrics
+from kglimits import plan
+from kglimits import changes
+from kglimits import timeouts
+from kglimits.broker import BrokerTransport
+from kglimits.gold.session import GoldTransport
+from kglimits.gold.balances import BalanceStore
+from kglimits.gold.commands import GoldCommands, user_key, project_key
+
 from django.conf import settings
 
 import logging
@@ -16,13 +30,55 @@ if not hasattr(settings, 'GOLD_PATH'):
     settings.GOLD_PATH = "/usr/local/gold/bin"
 if not hasattr(settings, 'GOLD_NULL_PROJECT'):
     settings.GOLD_NULL_PROJECT = "default"
+if not hasattr(settings, 'GOLD_SESSIONS'):
+    settings.GOLD_SESSIONS = 2
+if not hasattr(settings, 'GOLD_BUFFER'):
+    settings.GOLD_BUFFER = True
+if not hasattr(settings, 'GOLD_QUEUE'):
+    settings.GOLD_QUEUE = None
+if not hasattr(settings, 'GOLD_CACHE_TTL'):
+    settings.GOLD_CACHE_TTL = 0
+if not hasattr(settings, 'GOLD_CONCURRENCY'):
+    settings.GOLD_CONCURRENCY = 2
+if not hasattr(settings, 'GOLD_BALANCES'):
+    settings.GOLD_BALANCES = None
+if not hasattr(settings, 'GOLD_BALANCES_MAX_AGE'):
+    settings.GOLD_BALANCES_MAX_AGE = 900
+if not hasattr(settings, 'GOLD_TIMEOUT'):
+    settings.GOLD_TIMEOUT = 120
+if not hasattr(settings, 'GOLD_TIMEOUTS'):
+    settings.GOLD_TIMEOUTS = {}
+if not hasattr(settings, 'GOLD_DEADLINE'):
+    settings.GOLD_DEADLINE = 300
+if not hasattr(settings, 'GOLD_BREAKER_THRESHOLD'):
+    settings.GOLD_BREAKER_THRESHOLD = 3
+if not hasattr(settings, 'GOLD_BREAKER_COOLDOWN'):
+    settings.GOLD_BREAKER_COOLDOWN = 60
+if not hasattr(settings, 'GOLD_BROKER'):
+    settings.GOLD_BROKER = None
 
 gold_prefix = settings.GOLD_PREFIX
 gold_path = settings.GOLD_PATH
 gold_null_project = settings.GOLD_NULL_PROJECT
+gold_sessions = settings.GOLD_SESSIONS
+gold_buffer = settings.GOLD_BUFFER
+gold_timeout = settings.GOLD_TIMEOUT
+gold_timeouts = settings.GOLD_TIMEOUTS
+gold_deadline = settings.GOLD_DEADLINE
+gold_broker = settings.GOLD_BROKER
 
 logger = logging.getLogger(__name__)
 
+gold_queue = workqueue.WorkQueue("gold", settings.GOLD_QUEUE)
+gold_cache = cache.LookupCache(settings.GOLD_CACHE_TTL)
+gold_executor = executor.Executor(settings.GOLD_CONCURRENCY)
+gold_breaker = timeouts.CircuitBreaker("gold",
+        settings.GOLD_BREAKER_THRESHOLD, settings.GOLD_BREAKER_COOLDOWN)
+gold_balances = None
+if settings.GOLD_BALANCES is not None:
+    gold_balances = BalanceStore(settings.GOLD_BALANCES,
+            settings.GOLD_BALANCES_MAX_AGE)
+
 
 # used for filtering description containing \n and \r
 def filter_string(value):
@@ -60,18 +116,66 @@ def truncate(value, arg):
     else:
         return value
 
-# Call remote command with logging
-def call(command, ignore_errors=[]):
-    c = []
-    c.extend(gold_prefix)
-    c.append("%s/%s"%(gold_path,command[0]))
-    c.extend(command[1:])
-    command = c
+# Make a transport that runs Gold commands in this process
+def make_transport(prefix=gold_prefix):
+    return GoldTransport(prefix, gold_path, gold_sessions)
 
+_transport = None
+
+# Get the transport used to run Gold commands
+def get_transport():
+    global _transport
+    if _transport is None and gold_broker is not None:
+        _transport = BrokerTransport(gold_broker)
+    if _transport is None:
+        _transport = make_transport()
+    return _transport
+
+# Call remote command, or buffer it until the transaction commits or for a
+# plan
+def call(command, ignore_errors=[]):
+    metrics.issued("gold")
+    if buffer.add(gold_commands, command, ignore_errors, gold_buffer):
+        logger.debug("Buffered %s"%command)
+        forget(command)
+        return
+    execute(command, ignore_errors)
+
+# Call many remote commands, running independent ones at the same time, or
+# buffer them until the transaction commits or for a plan
+def call_many(commands, ignore_errors=[]):
+    if buffer.get_buffer(gold_commands, transactional=gold_buffer) is not None:
+        for command in commands:
+            call(command, ignore_errors)
+        return
+    for command in commands:
+        metrics.issued("gold")
+    operations = [ gold_commands.parse(command, ignore_errors) for command in commands ]
+    gold_executor.run(operations, lambda op: buffer.run(gold_commands, op))
+
+# Start a command, from the plan's snapshot if there is one, within its
+# timeout and the deadline of the signal handler, unless the circuit breaker
+# is open
+def popen(command):
+    timeout = timeouts.timeout(gold_timeouts.get(metrics.verb(command), gold_timeout), command)
+    gold_breaker.check(command)
+    return gold_breaker.watch(plan.popen("gold", get_transport(), command, timeout))
+
+# Call remote command now with logging
+def execute(command, ignore_errors=[]):
     logger.debug("Cmd %s"%command)
-    null = open('/dev/null', 'w')
-    retcode = subprocess.call(command,stdout=null,stderr=null)
-    null.close()
+    timer = metrics.Timer("gold", command)
+    try:
+        p = popen(command)
+        for line in p.stdout:
+            pass
+        retcode = p.wait()
+    except timeouts.Unavailable, e:
+        timer.stop(e.returncode)
+        forget(command)
+        raise
+    timer.stop(retcode)
+    forget(command)
 
     if retcode in ignore_errors:
         logger.debug("<-- Cmd %s returned %d (ignored)"%(command,retcode))
@@ -84,42 +188,53 @@ def call(command, ignore_errors=[]):
     logger.debug("<-- Returned %d (good)"%(retcode))
     return
 
-# Read CSV delimited input from Gold
-def read_gold_output(command):
-    c = []
-    c.extend(gold_prefix)
-    c.append("%s/%s"%(gold_path,command[0]))
-    c.extend(command[1:])
-    command = c
+gold_commands = GoldCommands(execute, gold_executor)
 
-    logger.debug("Cmd %s"%command)
-    null = open('/dev/null', 'w')
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=null)
-    null.close()
+# Forget cached lookups that command makes stale
+def forget(command):
+    op = gold_commands.parse(command)
+    if op.key is None:
+        gold_cache.invalidate()
+    else:
+        gold_cache.invalidate(op.entities)
 
-    results = []
-    reader = csv.reader(p.stdout,delimiter="|")
+# Read CSV delimited input from Gold a row at a time
+# Rows are yielded as they arrive; a failed command raises an error after
+# the last of them.
+def iter_gold_output(command):
+    logger.debug("Cmd %s"%command)
+    debug = logger.isEnabledFor(logging.DEBUG)
+    metrics.issued("gold")
+    timer = metrics.Timer("gold", command)
+    p = popen(command)
+    finished = False
 
     try:
-        headers = reader.next()
-        logger.debug("<-- headers %s"%headers)
-    except StopIteration, e:
-        logger.debug("Cmd %s headers not found"%command)
-        headers = []
-
-    for row in reader:
-        logger.debug("<-- row %s"%row)
-        this_row = {}
-
-        i = 0
-        for i in range(0,len(headers)):
-            key = headers[i]
-            value = row[i]
-            this_row[key] = value
-
-        results.append(this_row)
+        reader = csv.reader(p.stdout,delimiter="|")
+
+        try:
+            headers = reader.next()
+            if debug:
+                logger.debug("<-- headers %s"%headers)
+        except StopIteration, e:
+            logger.debug("Cmd %s headers not found"%command)
+            headers = []
+
+        row_type = rows.row_class(headers)
+        for row in reader:
+            if debug:
+                logger.debug("<-- row %s"%row)
+            yield rows.make_row(row_type, row)
+        finished = True
+    finally:
+        if not finished:
+            # leave the transport ready for the next command
+            for line in p.stdout:
+                pass
+            timer.stop(p.wait())
 
     retcode = p.wait()
+    timer.stop(retcode)
     if retcode != 0:
         logger.error("<-- Cmd %s returned %d (error)"%(command,retcode))
         raise subprocess.CalledProcessError(retcode, command)
@@ -128,10 +243,21 @@ def read_gold_output(command):
         logger.debug("Cmd %s didn't return any headers."%command)
 
     logger.debug("<-- Returned: %d (good)"%(retcode))
-    return results
+
+# Read CSV delimited input from Gold
+def read_gold_output(command):
+    return list(iter_gold_output(command))
 
 # Get the user details from Gold
+@gold_cache.cached(lambda username: [ user_key(username) ])
 def get_gold_user(username):
+    # commands waiting for the transaction to commit
+    pending = buffer.pending_action(gold_commands, user_key(username))
+    if pending == "add":
+        return { "Name": username }
+    elif pending == "delete":
+        return None
+
     cmd = [ "glsuser", "-u", username, "--raw" ]
     results = read_gold_output(cmd)
 
@@ -149,18 +275,118 @@ def get_gold_user(username):
 
     return the_result
 
-# Get the user balance details from Gold
-def get_gold_user_balance(username):
+# Get the user balance details from Gold, without the balance snapshot
+@gold_cache.cached(lambda username: [ user_key(username) ])
+def get_gold_user_live_balance(username):
     cmd = [ "gbalance", "-u", username, "--raw" ]
-    results = read_gold_output(cmd)
+    return read_gold_output(cmd)
+
+# Get the user balance details, from the balance snapshot if it has them
+# from the last max_age seconds (GOLD_BALANCES_MAX_AGE by default), or from
+# Gold. refresh always asks Gold.
+def get_gold_user_balance(username, refresh=False, max_age=None):
+    results = None
+    if gold_balances is not None and not refresh:
+        results = gold_balances.get(username, max_age)
+
+    if results is None:
+        if refresh:
+            results = get_gold_user_live_balance.uncached(username)
+        else:
+            results = get_gold_user_live_balance(username)
+        if gold_balances is not None:
+            gold_balances.put(username, results)
 
     if len(results) == 0:
         return None
 
     return results
 
+# Get the balances of every Gold user, with one query each for accounts,
+# their projects, their users and project members
+# Returns a dict of lower case username to balance rows, of the accounts the
+# user may use: as Gold does, an account's users are the members of its
+# projects if MEMBERS is one of them, everyone if ANY is, and those named,
+# less those it denies access to.
+def get_gold_balances():
+    accounts = []
+    projects = {}
+    account_users = {}
+    members = {}
+
+    def read_accounts():
+        for v in iter_gold_output([ "gbalance", "--raw" ]):
+            accounts.append(v)
+
+    def read_projects():
+        cmd = [ "goldsh", "AccountProject", "Query", "Show:=Account,Name", "--raw" ]
+        for v in iter_gold_output(cmd):
+            projects.setdefault(v["Account"], set()).add(v["Name"].lower())
+
+    def read_account_users():
+        cmd = [ "goldsh", "AccountUser", "Query", "Show:=Account,Name,Access", "--raw" ]
+        for v in iter_gold_output(cmd):
+            name = v["Name"]
+            if name not in (MEMBERS, ANY):
+                name = name.lower()
+            account_users.setdefault(v["Account"], {})[name] = \
+                v.get("Access", "True") != "False"
+
+    def read_members():
+        cmd = [ "goldsh", "ProjectUser", "Query", "Show:=Project,Name", "--raw" ]
+        for v in iter_gold_output(cmd):
+            # MEMBERS stands for the members of the project, it isn't a user
+            if v["Name"] != MEMBERS:
+                members.setdefault(v["Project"].lower(), set()).add(v["Name"].lower())
+
+    # the queries are independent, so run them at the same time
+    gold_executor.map(lambda read: read(),
+        [ read_accounts, read_projects, read_account_users, read_members ])
+
+    everyone = set()
+    for usernames in members.values():
+        everyone.update(usernames)
+    for access in account_users.values():
+        everyone.update([ name for name in access if name not in (MEMBERS, ANY) ])
+
+    # every project member has an answer, if only that they have no accounts
+    balances = dict([ (username, []) for username in everyone ])
+    for v in accounts:
+        access = account_users.get(v["Id"], {})
+        usernames = set()
+        if access.get(ANY):
+            usernames.update(everyone)
+        if access.get(MEMBERS):
+            for pid in projects.get(v["Id"], ()):
+                usernames.update(members.get(pid, ()))
+        for name, allowed in access.items():
+            if name in (MEMBERS, ANY):
+                continue
+            if allowed:
+                usernames.add(name)
+            else:
+                usernames.discard(name)
+        for username in usernames:
+            balances.setdefault(username, []).append(v)
+    return balances
+
+# Replace the balance snapshot with the balances of every Gold user
+# Returns the number of users stored.
+def snapshot_gold_balances():
+    balances = get_gold_balances()
+    gold_balances.replace(balances)
+    return len(balances)
+
 # Get the project details from Gold
+@gold_cache.cached(lambda projectname: [ project_key(projectname) ])
 def get_gold_project(projectname):
+    # commands waiting for the transaction to commit
+    pending = buffer.pending_action(gold_commands, project_key(projectname))
+    if pending == "add":
+        return { "Name": projectname }
+    elif pending == "delete":
+        return None
+
     cmd = [ "glsproject", "-p", projectname, "--raw" ]
     results = read_gold_output(cmd)
 
@@ -178,29 +404,78 @@ def get_gold_project(projectname):
 
     return the_result
 
+# Gold reports this pseudo user as a member of projects created with
+# "gmkproject -u MEMBERS", and as a user of accounts their members may use
+MEMBERS = "MEMBERS"
+
+# The pseudo user of accounts anyone may use
+ANY = "ANY"
+
+@gold_cache.cached(lambda projectname: [ project_key(projectname) ])
 def get_gold_users_in_project(projectname):
-    gold_project = get_gold_project(projectname)
-    if gold_project is None:
-        logger.error("Project '%s' does not exist in Gold"%(projectname))
-        raise RuntimeError("Project '%s' does not exist in Gold"%(projectname))
+    cmd = [ "goldsh", "ProjectUser", "Query", "Project==%s"%projectname, "Show:=Name", "--raw" ]
 
-    if gold_project["Users"] == "":
-        return []
-    else:
-        return gold_project["Users"].lower().split(",")
+    user_list = []
+    for v in iter_gold_output(cmd):
+        if v["Name"] != MEMBERS:
+            user_list.append(v["Name"].lower())
+    return user_list
 
+@gold_cache.cached(lambda username: [ user_key(username) ])
 def get_gold_projects_in_user(username):
-    gold_balance = get_gold_user_balance(username)
-    if gold_balance is None:
-        logger.error("User '%s' does not exist in Gold"%(username))
-        raise RuntimeError("User '%s' does not exist in Gold"%(username))
+    cmd = [ "goldsh", "ProjectUser", "Query", "Name==%s"%username, "Show:=Project", "--raw" ]
 
     projects = []
-    for v in gold_balance:
-        projects.append(v["Name"])
+    for v in iter_gold_output(cmd):
+        projects.append(v["Project"])
     return projects
 
+# Users get_gold_users asks Gold about in one request
+USER_QUERY_CHUNK = 50
+
+# Get the details of many users from Gold
+# Returns a dict of lower case username to details, for users that exist.
+def get_gold_users(usernames):
+    found = {}
+    missing = []
+    for username in usernames:
+        # commands waiting for the transaction to commit
+        pending = buffer.pending_action(gold_commands, user_key(username))
+        if pending == "add":
+            found[username.lower()] = { "Name": username }
+            continue
+        elif pending == "delete":
+            continue
+
+        cached = gold_cache.get(("get_gold_user", username))
+        if cached is not None:
+            if cached.value is not None:
+                found[username.lower()] = cached.value
+            continue
+        missing.append(username)
+
+    # glsuser takes one user, so ask goldsh for up to USER_QUERY_CHUNK at a
+    # time, their names joined by Gold's "|" (or) conjunction
+    for i in range(0, len(missing), USER_QUERY_CHUNK):
+        chunk = missing[i:i+USER_QUERY_CHUNK]
+        cmd = [ "goldsh", "User", "Query", "Name==%s" % chunk[0] ]
+        cmd.extend([ "|Name==%s" % username for username in chunk[1:] ])
+        cmd.append("--raw")
+        rows = {}
+        for v in iter_gold_output(cmd):
+            rows[v["Name"].lower()] = v
+        for username in chunk:
+            gold_user = rows.get(username.lower())
+            gold_cache.put(("get_gold_user", username), gold_user, set([ user_key(username) ]))
+            if gold_user is not None:
+                found[username.lower()] = gold_user
+
+    return found
+
 # Called when institute is created/updated
+@gold_queue.deferred(fields=["name"], coalesce=True)
+@metrics.handler("gold")
+@timeouts.deadline(gold_deadline)
 def institute_saved(sender, instance, created, **kwargs):
     name = instance.name
     logger.debug("institute_saved '%s','%s'"%(name,created))
@@ -223,6 +498,9 @@ def institute_saved(sender, instance, created, **kwargs):
     return
 
 # Called when institute is deleted
+@gold_queue.deferred(deleted=True, fields=["name"])
+@metrics.handler("gold")
+@timeouts.deadline(gold_deadline)
 def institute_deleted(sender, instance, **kwargs):
     name = instance.name
     logger.debug("institute_deleted '%s'"%(name))
@@ -238,56 +516,130 @@ signals.post_save.connect(institute_saved, sender=Institute)
 signals.post_delete.connect(institute_deleted, sender=Institute)
 
 
+# Values of a person that Gold gets
+person_tracker = changes.Tracker(Person, {
+    "name": lambda person: filter_string(person.get_full_name()),
+    "email": lambda person: filter_string(person.email),
+    "is_active": lambda person: person.is_active,
+})
+
+# Karaage 2 keeps names and email addresses on the django User, which is
+# saved before the person
+if "user" in [ f.name for f in Person._meta.fields ]:
+    from django.contrib.auth.models import User
+    person_tracker.follow(User, lambda user:
+        Person.objects.filter(user=user).values_list("pk", flat=True))
+
 # Called when person is created/updated
-def person_saved(sender, instance, created, **kwargs):
+@person_tracker.watch
+@gold_queue.deferred(coalesce=True)
+@metrics.handler("gold")
+@timeouts.deadline(gold_deadline)
+def person_saved(sender, instance, created, changed=None, **kwargs):
     logger.debug("person_saved '%s','%s'"%(instance.username,created))
 
-    # update user meta information
-    if instance.is_active:
+    # update user meta information that changed, all of it if the person
+    # was inactive
+    if changed is not None and "is_active" in changed:
+        changed = None
+    if instance.is_active and changed != []:
+        values = person_tracker.values(instance)
+        commands = []
         for ua in instance.useraccount_set.filter(date_deleted__isnull=True):
-            call(["gchuser","-n",filter_string(instance.get_full_name()),"-u",ua.username])
-            call(["gchuser","-E",filter_string(instance.email),"-u",ua.username])
+            if changed is None or "name" in changed:
+                commands.append(["gchuser","-n",values["name"],"-u",ua.username])
+            if changed is None or "email" in changed:
+                commands.append(["gchuser","-E",values["email"],"-u",ua.username])
+        call_many(commands)
 
     logger.debug("returning")
     return
 
 signals.post_save.connect(person_saved, sender=Person)
 
+# Does a user exist, given the projects Gold has it in
+# Only users without any projects are looked up.
+def gold_user_exists(username, projects):
+    if projects and buffer.pending_action(gold_commands, user_key(username)) != "delete":
+        return True
+    return get_gold_user(username) is not None
+
+# Get the lower case pids of the active Karaage projects among names
+def active_projects(names):
+    if not names:
+        return set()
+    q = Q()
+    for name in names:
+        q = q | Q(pid__iexact=name)
+    return set([ pid.lower() for pid in Project.objects
+        .filter(q, is_active=True).values_list('pid', flat=True) ])
+
+# Get the name of the default Gold project of an account
+def default_project_name(account):
+    if account.default_project is None:
+        return gold_null_project
+    return account.default_project.pid
+
+# Values of an account that Gold gets
+account_tracker = changes.Tracker(UserAccount, {
+    "default_project": default_project_name,
+    "name": lambda account: filter_string(account.user.get_full_name()),
+    "email": lambda account: filter_string(account.user.email),
+})
+
 # Called when account is created/updated
-def account_saved(sender, instance, created, **kwargs):
+@account_tracker.watch
+@gold_queue.deferred(fields=["username"], coalesce=True)
+@metrics.handler("gold")
+@timeouts.deadline(gold_deadline)
+def account_saved(sender, instance, created, changed=None, **kwargs):
     username = instance.username
     logger.debug("account_saved '%s','%s'"%(username,created))
 
     # retrieve default project, or use null project if none
-    default_project_name = gold_null_project
-    if instance.default_project is not None:
-        default_project_name = instance.default_project.pid
+    default_project = default_project_name(instance)
 
     # account created
     # account updated
 
-    gold_user = get_gold_user(username)
     if instance.date_deleted is None:
         # date_deleted is not set, user should exist
         logger.debug("account is active")
 
-        if gold_user is None:
-            # create user if doesn't exist
-            call(["gmkuser","-A","-p",default_project_name,"-u",username])
-        else:
-            # or just set default project
-            call(["gchuser","-p",default_project_name,"-u",username])
+        # what Gold has now, in one read
+        current = set([ p.lower() for p in get_gold_projects_in_user(username) ])
+        desired = set([ p.lower() for p in instance.user.project_set
+            .filter(is_active=True).values_list('pid', flat=True) ])
 
-        # update user meta information
-        call(["gchuser","-n",filter_string(instance.user.get_full_name()),"-u",username])
-        call(["gchuser","-E",filter_string(instance.user.email),"-u",username])
-
-        # add rest of projects user belongs to
-        for project in instance.user.project_set.all():
-            call(["gchproject","--add-user",username,"-p",project.pid],ignore_errors=[74])
+        if not gold_user_exists(username, current):
+            # create user if doesn't exist
+            call(["gmkuser","-A","-p",default_project,"-u",username])
+            current = set()
+            changed = None
+        elif changed is None or "default_project" in changed:
+            # or just set default project, if it changed
+            call(["gchuser","-p",default_project,"-u",username])
+
+        # update user meta information that changed
+        values = account_tracker.values(instance)
+        if changed is None or "name" in changed:
+            call(["gchuser","-n",values["name"],"-u",username])
+        if changed is None or "email" in changed:
+            call(["gchuser","-E",values["email"],"-u",username])
+
+        # add the projects user belongs to that Gold doesn't have; another
+        # process may have just added them
+        call_many([ ["gchproject","--add-user",username,"-p",pid]
+            for pid in sorted(desired - current) ], ignore_errors=[74])
+
+        # and remove the projects user left; projects Karaage doesn't manage
+        # are left alone
+        call_many([ ["gchproject","--del-users",username,"-p",pid]
+            for pid in sorted(active_projects(current - desired)) ])
     else:
         # date_deleted is not set, user should not exist
         logger.debug("account is not active")
+        gold_user = get_gold_user(username)
         if gold_user is not None:
             # delete Gold user if account marked as deleted
             call(["grmuser","-u",username],ignore_errors=[8])
@@ -296,6 +648,9 @@ def account_saved(sender, instance, created, **kwargs):
     return
 
 # Called when account is deleted
+@gold_queue.deferred(deleted=True, fields=["username"])
+@metrics.handler("gold")
+@timeouts.deadline(gold_deadline)
 def account_deleted(sender, instance, **kwargs):
     username = instance.username
     logger.debug("account_deleted '%s'"%(username))
@@ -313,8 +668,18 @@ def account_deleted(sender, instance, **kwargs):
 signals.post_save.connect(account_saved, sender=UserAccount)
 signals.post_delete.connect(account_deleted, sender=UserAccount)
 
+# Values of a project that Gold gets
+project_tracker = changes.Tracker(Project, {
+    "description": lambda project: filter_string(truncate(project.name, 40)),
+    "organization": lambda project: filter_string(project.institute.name),
+})
+
 # Called when project is saved/updated
-def project_saved(sender, instance, created, **kwargs):
+@project_tracker.watch
+@gold_queue.deferred(fields=["pid"], coalesce=True)
+@metrics.handler("gold")
+@timeouts.deadline(gold_deadline)
+def project_saved(sender, instance, created, changed=None, **kwargs):
     pid = instance.pid
     logger.debug("project_saved '%s','%s'"%(instance,created))
 
@@ -327,11 +692,14 @@ def project_saved(sender, instance, created, **kwargs):
         gold_project = get_gold_project(pid)
         if gold_project is None:
             call(["gmkproject","-p",pid,"-u","MEMBERS"])
-
-        # update project meta information
-        name = truncate(instance.name, 40)
-        call(["gchproject","-d",filter_string(name),"-p",pid])
-        call(["gchproject","-X","Organization=%s"%filter_string(instance.institute.name),"-p",pid])
+            changed = None
+
+        # update project meta information that changed
+        values = project_tracker.values(instance)
+        if changed is None or "description" in changed:
+            call(["gchproject","-d",values["description"],"-p",pid])
+        if changed is None or "organization" in changed:
+            call(["gchproject","-X","Organization=%s"%values["organization"],"-p",pid])
     else:
         # project is deleted
         logger.debug("project is not active")
@@ -343,6 +711,9 @@ def project_saved(sender, instance, created, **kwargs):
     return
 
 # Called when project is deleted
+@gold_queue.deferred(deleted=True, fields=["pid"])
+@metrics.handler("gold")
+@timeouts.deadline(gold_deadline)
 def project_deleted(sender, instance, **kwargs):
     pid = instance.pid
     logger.debug("project_deleted '%s'"%(instance))
@@ -357,10 +728,17 @@ def project_deleted(sender, instance, **kwargs):
     return
 
 # Called when m2m changed between user and project
+@gold_queue.deferred()
+@metrics.handler("gold")
+@timeouts.deadline(gold_deadline)
 def user_project_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
     logger.debug("user_project_changed '%s','%s','%s','%s','%s'"%(instance, action, reverse, model, pk_set))
 
+    commands = []
+    ignore_errors = []
     if action == "post_add":
+        # already a member
+        ignore_errors = [74]
         if reverse:
             username = instance.username
             # If Gold user does not exist, there is nothing for us to do.
@@ -371,17 +749,18 @@ def user_project_changed(sender, instance, action, reverse, model, pk_set, **kwa
                 for project in model.objects.filter(pk__in=pk_set):
                     projectname = project.pid
                     logger.debug("add user '%s' to project '%s'"%(username,projectname))
-                    call(["gchproject","--add-user",username,"-p",projectname],ignore_errors=[74])
+                    commands.append(["gchproject","--add-user",username,"-p",projectname])
         else:
             projectname = instance.pid
-            for user in model.objects.filter(pk__in=pk_set):
+            users = list(model.objects.filter(pk__in=pk_set))
+            gold_users = get_gold_users([ user.username for user in users ])
+            for user in users:
                 username = user.username
                 # If Gold user does not exist, there is nothing for us to do.
                 # Gold account may not be created yet or it may have been deleted.
-                gold_user = get_gold_user(username)
-                if gold_user is not None:
+                if username.lower() in gold_users:
                     logger.debug("add user '%s' to project '%s'"%(username,projectname))
-                    call(["gchproject","--add-user",username,"-p",projectname],ignore_errors=[74])
+                    commands.append(["gchproject","--add-user",username,"-p",projectname])
 
     elif action == "post_remove":
         if reverse:
@@ -393,35 +772,35 @@ def user_project_changed(sender, instance, action, reverse, model, pk_set, **kwa
                 for project in model.objects.filter(pk__in=pk_set):
                     projectname = project.pid
                     logger.debug("delete user '%s' to project '%s'"%(username,projectname))
-                    call(["gchproject","--del-users",username,"-p",projectname])
+                    commands.append(["gchproject","--del-users",username,"-p",projectname])
         else:
             projectname = instance.pid
-            for user in model.objects.filter(pk__in=pk_set):
+            users = list(model.objects.filter(pk__in=pk_set))
+            gold_users = get_gold_users([ user.username for user in users ])
+            for user in users:
                 username = user.username
                 # If Gold user does not exist, there is nothing for us to do.
                 # Gold account may not be created yet or it may have been deleted.
-                gold_user = get_gold_user(username)
-                if gold_user is not None:
+                if username.lower() in gold_users:
                     logger.debug("delete user '%s' to project '%s'"%(username,projectname))
-                    call(["gchproject","--del-users",username,"-p",projectname])
+                    commands.append(["gchproject","--del-users",username,"-p",projectname])
 
     elif action == "post_clear":
         if reverse:
             username = instance.username
-            # FIXME! This will list projects with global membership, which
-            # can't be deleted.
             # FIXME! What happens to default project?
             projects = get_gold_projects_in_user(username)
             for projectname in projects:
                 logger.debug("remove user '%s' all projects - now processing project '%s'"%(username,projectname))
-                call(["gchproject","--del-users",username,"-p",projectname])
+                commands.append(["gchproject","--del-users",username,"-p",projectname])
         else:
-            # FIXME! get_gold_users_in_project doesn't return all users in project
             projectname = instance.pid
             users = get_gold_users_in_project(projectname)
             for username in users:
                 logger.debug("remove project '%s' all users - now processing user '%s'"%(username, projectname))
-                call(["gchproject","--del-users",username,"-p",projectname])
+                commands.append(["gchproject","--del-users",username,"-p",projectname])
+
+    call_many(commands, ignore_errors)
 
     logger.debug("returning")
     return
@@ -0,0 +1,127 @@
+"""
+Local snapshot of Gold balances.
+
+Showing balances in the portal used to run gbalance for every lookup. A
+periodic job (kg-manage gold_balances) reads every balance from Gold at
+once and stores it in a local SQLite table, indexed by username, and
+get_gold_user_balance() reads from the table while the snapshot is recent
+enough. A lookup that misses, or is too old, goes to Gold and keeps the
+result.
+"""
+import os
+import time
+import json
+import sqlite3
+
+from kglimits import rows
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS balance (
+    username TEXT PRIMARY KEY,
+    headers TEXT NOT NULL,
+    rows TEXT NOT NULL,
+    fetched REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS balance_fetched ON balance (fetched);
+"""
+
+
+def _encode(results):
+    headers = []
+    if results:
+        headers = list(results[0].headers)
+    return json.dumps(headers), json.dumps([ list(row) for row in results ])
+
+
+class BalanceStore(object):
+
+    def __init__(self, path, max_age):
+        self.path = path
+        self.max_age = max_age
+
+    def connect(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        db = sqlite3.connect(self.path, timeout=60)
+        db.executescript(SCHEMA)
+        return db
+
+    def get(self, username, max_age=None):
+        """
+        The stored balance rows of a user, if fetched in the last max_age
+        seconds, or None.
+        """
+        if max_age is None:
+            max_age = self.max_age
+        db = self.connect()
+        try:
+            row = db.execute("SELECT headers, rows FROM balance "
+                "WHERE username = ? AND fetched >= ?",
+                (username.lower(), time.time() - max_age)).fetchone()
+        finally:
+            db.close()
+        if row is None:
+            return None
+        # Gold output is read as byte strings
+        row_type = rows.row_class([ h.encode("utf-8")
+            for h in json.loads(row[0]) ])
+        return [ rows.make_row(row_type, [ v.encode("utf-8") for v in values ])
+            for values in json.loads(row[1]) ]
+
+    def put(self, username, results):
+        """ Store the balance rows of one user. """
+        headers, values = _encode(results)
+        db = self.connect()
+        try:
+            db.execute("INSERT OR REPLACE INTO balance "
+                "(username, headers, rows, fetched) VALUES (?, ?, ?, ?)",
+                (username.lower(), headers, values, time.time()))
+            db.commit()
+        finally:
+            db.close()
+
+    def replace(self, balances):
+        """
+        Replace the whole snapshot with balances, a dict of username to
+        balance rows, in one transaction.
+        """
+        now = time.time()
+        db = self.connect()
+        try:
+            db.executemany("INSERT OR REPLACE INTO balance "
+                "(username, headers, rows, fetched) VALUES (?, ?, ?, ?)",
+                [ (username.lower(),) + _encode(results) + (now,)
+                for username, results in balances.items() ])
+            # users Gold no longer has
+            db.execute("DELETE FROM balance WHERE fetched < ?", (now,))
+            db.commit()
+        finally:
+            db.close()
+        logger.debug("Stored %d balances" % len(balances))
+
+    def stats(self):
+        """ Size and age of the snapshot. """
+        now = time.time()
+        db = self.connect()
+        try:
+            users, oldest, newest = db.execute(
+                "SELECT COUNT(*), MIN(fetched), MAX(fetched) FROM balance"
+                ).fetchone()
+        finally:
+            db.close()
+        age = 0
+        if newest is not None:
+            age = now - newest
+        oldest_age = 0
+        if oldest is not None:
+            oldest_age = now - oldest
+        return {
+            "users": users,
+            "age": age,
+            "oldest": oldest_age,
+        }
@@ -0,0 +1,147 @@
+"""
+Understanding Gold commands as operations on users, projects, project
+members and organizations, so they can be buffered and coalesced.
+"""
+from kglimits.buffer import Operation
+
+# options of the g* commands that take a value
+VALUE_OPTIONS = [ "-u", "-p", "-n", "-E", "-d", "-X",
+        "--add-user", "--add-users", "--del-users" ]
+
+
+def parse_args(args):
+    """ Split g* command arguments into a list of (option, value). """
+    result = []
+    i = 0
+    while i < len(args):
+        if args[i] in VALUE_OPTIONS and i + 1 < len(args):
+            result.append((args[i], args[i+1]))
+            i = i + 2
+        else:
+            result.append((args[i], None))
+            i = i + 1
+    return result
+
+
+def user_key(name):
+    return ("user", name.lower())
+
+
+def project_key(name):
+    return ("project", name.lower())
+
+
+def member_key(user, project):
+    return ("member", user.lower(), project.lower())
+
+
+def organization_key(name):
+    return ("organization", name)
+
+
+class GoldCommands(object):
+    name = "gold"
+
+    def __init__(self, execute, executor):
+        self.execute = execute
+        self.executor = executor
+
+    def parse(self, command, ignore_errors=[]):
+        op = Operation(command, ignore_errors)
+        name = command[0]
+
+        if name == "goldsh":
+            if len(command) == 4 and command[1] == "Organization":
+                if command[2] == "Create" and command[3].startswith("Name="):
+                    return Operation(command, ignore_errors, action="add",
+                        key=organization_key(command[3][len("Name="):]))
+                if command[2] == "Delete" and command[3].startswith("Name=="):
+                    return Operation(command, ignore_errors, action="delete",
+                        key=organization_key(command[3][len("Name=="):]))
+            return op
+
+        args = parse_args(command[1:])
+        options = dict(args)
+        if len(options) != len(args):
+            return op
+
+        if name in ("gmkuser", "gchuser", "grmuser"):
+            if options.get("-u") is None or "," in options["-u"]:
+                return op
+            key = user_key(options["-u"])
+            if name == "gmkuser":
+                entities = set()
+                if options.get("-p") is not None:
+                    entities.add(project_key(options["-p"]))
+                return Operation(command, ignore_errors, key=key,
+                        action="add", entities=entities)
+            if name == "grmuser":
+                if len(options) != 1:
+                    return op
+                return Operation(command, ignore_errors, key=key,
+                        action="delete")
+            attributes = []
+            for option, value in args:
+                if option == "-u":
+                    continue
+                if value is None:
+                    attributes.append((option, [ option ]))
+                else:
+                    attributes.append((option, [ option, value ]))
+            return Operation(command, ignore_errors, key=key, action="modify",
+                    prefix=[ name ], attributes=attributes,
+                    suffix=[ "-u", options["-u"] ])
+
+        if name in ("gmkproject", "gchproject", "grmproject"):
+            if options.get("-p") is None or "," in options["-p"]:
+                return op
+            project = options["-p"]
+            key = project_key(project)
+            if name == "gmkproject":
+                return Operation(command, ignore_errors, key=key, action="add")
+            if name == "grmproject":
+                if len(options) != 1:
+                    return op
+                return Operation(command, ignore_errors, key=key,
+                        action="delete")
+
+            others = [ o for o in options.keys() if o != "-p" ]
+            for option, action in (("--add-user", "add"),
+                    ("--add-users", "add"), ("--del-users", "delete")):
+                if others == [ option ]:
+                    users = options[option]
+                    entities = set([ key ])
+                    for user in users.split(","):
+                        entities.add(user_key(user))
+                    if "," in users:
+                        return Operation(command, ignore_errors,
+                            key=("members", users.lower(), project.lower()),
+                            entities=entities)
+                    return Operation(command, ignore_errors, action=action,
+                            key=member_key(users, project), entities=entities)
+
+            attributes = []
+            for option, value in args:
+                if option == "-p":
+                    continue
+                if option == "-d":
+                    attributes.append((option, [ option, value ]))
+                elif option == "-X" and "=" in value:
+                    attributes.append(((option, value.split("=", 1)[0]),
+                        [ option, value ]))
+                else:
+                    return op
+            return Operation(command, ignore_errors, key=key, action="modify",
+                    prefix=[ name ], attributes=attributes,
+                    suffix=[ "-p", project ])
+
+        return op
+
+    def owned(self, key, owner):
+        if key[0] != "member":
+            return False
+        if owner[0] == "user":
+            return key[1] == owner[1]
+        if owner[0] == "project":
+            return key[2] == owner[1]
+        return False
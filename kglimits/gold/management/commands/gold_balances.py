@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from kglimits import gold
+
+
+class Command(BaseCommand):
+    help = "Store a snapshot of every Gold balance, for showing balances in Karaage"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stats', action='store_true', default=False,
+            help="Show the size and age of the snapshot and stop")
+
+    def handle(self, *args, **options):
+        if gold.gold_balances is None:
+            raise CommandError("GOLD_BALANCES is not set")
+
+        if options['stats']:
+            stats = gold.gold_balances.stats()
+            for key in sorted(stats.keys()):
+                self.stdout.write("%s %s\n" % (key, stats[key]))
+            return
+
+        users = gold.snapshot_gold_balances()
+        self.stdout.write("%d balances stored\n" % users)
@@ -0,0 +1,41 @@
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+
+from kglimits import broker
+from kglimits.gold import make_transport, gold_broker, gold_prefix
+
+# Only Gold's own commands, in GOLD_PATH
+COMMAND = re.compile(r"^g[a-z]+$")
+
+
+class Command(BaseCommand):
+    help = "Run Gold commands for the Karaage processes on this host"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', default=gold_broker,
+            help="Unix socket to listen on, GOLD_BROKER by default")
+        parser.add_argument('--mode', default="0660",
+            help="Permissions of the socket, in octal")
+        parser.add_argument('--window', type=float, default=0.005,
+            help="Seconds to wait for more commands to run with the first")
+        parser.add_argument('--keep-prefix', action='store_true', default=False,
+            help="Run commands with GOLD_PREFIX, if not run as the gold user")
+
+    def handle(self, *args, **options):
+        if options['socket'] is None:
+            raise CommandError("GOLD_BROKER is not set")
+
+        prefix = []
+        if options['keep_prefix']:
+            prefix = gold_prefix
+        transport = make_transport(prefix)
+
+        def transport_for(args):
+            if args and COMMAND.match(args[0]):
+                return transport
+            return None
+
+        broker.serve(options['socket'],
+                broker.Broker(transport_for, window=options['window']),
+                int(options['mode'], 8))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from kglimits.gold import sync
+
+
+class Command(BaseCommand):
+    help = "Bring Gold users, projects, members and organizations into line with Karaage"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', default=False,
+            help="Show the changes without making them")
+        parser.add_argument('--delete-unmanaged', action='store_true',
+            default=False,
+            help="Also delete users, projects and organizations that Karaage doesn't know about")
+
+    def handle(self, *args, **options):
+        report = sync.sync(dry_run=options['dry_run'],
+                delete_unmanaged=options['delete_unmanaged'])
+        self.stdout.write("%s\n" % report)
@@ -0,0 +1,222 @@
+"""
+Interactive goldsh sessions.
+
+The g* commands are Perl scripts that each start an interpreter and a Gold
+client. goldsh understands the same requests as Object Action conditions,
+so the common commands are rewritten into goldsh requests and written to a
+pool of long lived goldsh processes. Commands without a goldsh equivalent
+still run their own binary; gmkproject does more than create the project
+(it makes the project's account, with its AccountProject and AccountUser
+entries), so it is one of them.
+
+goldsh is started with --raw so results come back in the same pipe
+delimited shape as the g* commands. Failures are reported on stderr with
+the Gold status code in brackets, e.g. "Failed (74): ...", which becomes
+the return code. The g* commands exit with that same code, so the
+ignore_errors callers have always given them (74 for a user already in a
+project, 185 for an organization that already exists, 8 for a user that
+doesn't exist) apply to requests written to a session too.
+"""
+import re
+
+from kglimits.session import Session, SessionPool, CommandTransport
+
+
+def quote(arg):
+    """
+    Quote the value of a Name<op>Value argument so goldsh reads one word.
+    A value with double quotes goes in single ones. Raises ValueError for
+    values it can't be given: with a line break, which would end the
+    request early, or with both kinds of quote.
+    """
+    if "\n" in arg or "\r" in arg:
+        raise ValueError("Can't give goldsh a line break in %r" % arg)
+    if arg != "" and not [c for c in arg if c in " \t'\""]:
+        return arg
+    m = re.match(r"^([|&!]*\w*[=!<>~:]+)(.*)$", arg)
+    if m is None:
+        condition, value = "", arg
+    else:
+        condition, value = m.group(1), m.group(2)
+    if '"' not in value:
+        return '%s"%s"' % (condition, value)
+    if "'" not in value:
+        return "%s'%s'" % (condition, value)
+    raise ValueError("Can't give goldsh both kinds of quote in %r" % arg)
+
+
+def parse_options(args, flags, options):
+    """
+    Parse g* command options into a dict, or None if there are any we don't
+    know about.
+    """
+    result = {}
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg in flags:
+            result[arg] = True
+            i = i + 1
+        elif arg in options and i + 1 < len(args):
+            result.setdefault(arg, []).append(args[i+1])
+            i = i + 2
+        else:
+            return None
+    return result
+
+
+def translate(command):
+    """
+    Turn a g* command into a goldsh request, or None if there is no simple
+    equivalent.
+    """
+    name = command[0]
+    args = command[1:]
+
+    if name == "goldsh":
+        # sessions are already started with --raw
+        return [ arg for arg in args if arg != "--raw" ]
+
+    if name == "glsuser":
+        o = parse_options(args, [ "--raw" ], [ "-u" ])
+        if o is None or "--raw" not in o:
+            return None
+        request = [ "User", "Query" ]
+        if "-u" in o:
+            if len(o["-u"]) > 1:
+                return None
+            request.append("Name==%s" % o["-u"][0])
+        return request
+
+    if name == "gmkuser":
+        o = parse_options(args, [ "-A" ], [ "-n", "-E", "-p", "-u" ])
+        if o is None or "-u" not in o or len(o["-u"]) > 1:
+            return None
+        request = [ "User", "Create", "Name=%s" % o["-u"][0] ]
+        if "-A" in o:
+            request.append("Active=True")
+        if "-n" in o:
+            request.append("CommonName=%s" % o["-n"][-1])
+        if "-E" in o:
+            request.append("EmailAddress=%s" % o["-E"][-1])
+        if "-p" in o:
+            request.append("DefaultProject=%s" % o["-p"][-1])
+        return request
+
+    if name == "gchuser":
+        o = parse_options(args, [], [ "-n", "-E", "-p", "-u" ])
+        if o is None or "-u" not in o or len(o) == 1:
+            return None
+        request = [ "User", "Modify", "Name==%s" % o["-u"][-1] ]
+        if "-n" in o:
+            request.append("CommonName=%s" % o["-n"][-1])
+        if "-E" in o:
+            request.append("EmailAddress=%s" % o["-E"][-1])
+        if "-p" in o:
+            request.append("DefaultProject=%s" % o["-p"][-1])
+        return request
+
+    if name == "grmuser":
+        o = parse_options(args, [], [ "-u" ])
+        if o is None or "-u" not in o or len(o["-u"]) > 1:
+            return None
+        return [ "User", "Delete", "Name==%s" % o["-u"][0] ]
+
+    if name == "gchproject":
+        o = parse_options(args, [],
+                [ "-p", "-d", "-X", "--add-user", "--del-users" ])
+        if o is None or "-p" not in o or len(o["-p"]) > 1:
+            return None
+        project = o["-p"][0]
+        del o["-p"]
+        if o.keys() == [ "--add-user" ] and len(o["--add-user"]) == 1:
+            return [ "ProjectUser", "Create",
+                    "Project=%s" % project, "Name=%s" % o["--add-user"][0] ]
+        if o.keys() == [ "--del-users" ] and len(o["--del-users"]) == 1:
+            return [ "ProjectUser", "Delete",
+                    "Project==%s" % project, "Name==%s" % o["--del-users"][0] ]
+        if o and not [ k for k in o.keys() if k not in ("-d", "-X") ]:
+            request = [ "Project", "Modify", "Name==%s" % project ]
+            if "-d" in o:
+                request.append("Description=%s" % o["-d"][-1])
+            for extra in o.get("-X", []):
+                if "=" not in extra:
+                    return None
+                request.append(extra)
+            return request
+        return None
+
+    if name == "glsproject":
+        # a Project Query has the project's own columns, not the Users and
+        # Machines glsproject adds
+        o = parse_options(args, [ "--raw" ], [ "-p" ])
+        if o is None or "--raw" not in o:
+            return None
+        request = [ "Project", "Query" ]
+        if "-p" in o:
+            if len(o["-p"]) > 1:
+                return None
+            request.append("Name==%s" % o["-p"][0])
+        return request
+
+    if name == "grmproject":
+        o = parse_options(args, [], [ "-p" ])
+        if o is None or "-p" not in o or len(o["-p"]) > 1:
+            return None
+        return [ "Project", "Delete", "Name==%s" % o["-p"][0] ]
+
+    return None
+
+
+class GoldshSession(Session):
+    prompt = "gold> "
+    # Nothing else asks for these columns in this order.
+    sentinel_command = "Organization Query Name==kglimits-end-of-output Show:=Description,Name"
+    sentinel_line = "Description|Name"
+
+    def format_command(self, args):
+        return " ".join([ quote(arg) for arg in args ])
+
+    def parse_errors(self, text):
+        """
+        The Gold status code of a failure, as the g* commands would exit
+        with. Failures in any other shape return 1, which nothing ignores,
+        so they are never mistaken for an error a caller expects.
+        """
+        if text.strip() == "":
+            return 0
+        m = re.search(r"\((\d+)\)", text)
+        if m is not None:
+            return int(m.group(1))
+        return 1
+
+
+class GoldTransport(object):
+    """
+    Run g* commands, through goldsh sessions where possible.
+
+    With size 0 every command runs its own binary.
+    """
+
+    def __init__(self, prefix, path, size):
+        self.path = path
+        self.fallback = CommandTransport(prefix)
+        self.pool = None
+        if size > 0:
+            command = []
+            command.extend(prefix)
+            command.extend([ "%s/goldsh" % path, "--raw" ])
+            self.pool = SessionPool(GoldshSession, command, size)
+
+    def popen(self, command, timeout=None):
+        if self.pool is not None:
+            request = translate(command)
+            if request is not None:
+                return self.pool.popen(request, timeout)
+        c = [ "%s/%s" % (self.path, command[0]) ]
+        c.extend(command[1:])
+        return self.fallback.popen(c, timeout)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
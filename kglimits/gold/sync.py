@@ -0,0 +1,254 @@
+"""
+Bring Gold into line with Karaage in bulk.
+
+Users, projects, project memberships and organizations are each read with
+one --raw query and indexed in memory, the Karaage state is read with a few
+ORM queries, and only the differences are written back to Gold.
+"""
+import time
+
+from karaage.people.models import Institute
+from karaage.machines.models import UserAccount
+from karaage.projects.models import Project
+
+from kglimits.gold import call, iter_gold_output, filter_string, truncate
+from kglimits.gold import gold_null_project, gold_executor, MEMBERS
+from kglimits.sync import SyncReport, apply_changes
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class GoldState(object):
+    """ Users, projects, memberships and organizations. """
+
+    def __init__(self):
+        # user -> (default project, common name, email address)
+        self.users = {}
+        # project -> (description, organization)
+        self.projects = {}
+        # set of (user, project)
+        self.members = set()
+        # set of organization names
+        self.organizations = set()
+
+
+def group_by_project(members):
+    """ Index (user, project) pairs by project. """
+    result = {}
+    for user, project in members:
+        result.setdefault(project, set()).add(user)
+    return result
+
+
+# Read the current state from Gold
+def get_gold_state():
+    state = GoldState()
+
+    def read_users():
+        for v in iter_gold_output([ "glsuser", "--raw" ]):
+            state.users[v["Name"].lower()] = (
+                v["DefaultProject"].lower(), v["CommonName"], v["EmailAddress"])
+
+    def read_projects():
+        cmd = [ "goldsh", "Project", "Query",
+                "Show:=Name,Description,Organization", "--raw" ]
+        for v in iter_gold_output(cmd):
+            state.projects[v["Name"].lower()] = (v["Description"], v["Organization"])
+
+    def read_members():
+        cmd = [ "goldsh", "ProjectUser", "Query", "Show:=Project,Name", "--raw" ]
+        for v in iter_gold_output(cmd):
+            if v["Name"] != MEMBERS:
+                state.members.add((v["Name"].lower(), v["Project"].lower()))
+
+    def read_organizations():
+        cmd = [ "goldsh", "Organization", "Query", "Show:=Name", "--raw" ]
+        for v in iter_gold_output(cmd):
+            state.organizations.add(v["Name"])
+
+    # the lists are independent, so read them at the same time
+    gold_executor.map(lambda read: read(),
+        [ read_users, read_projects, read_members, read_organizations ])
+
+    return state
+
+
+# Work out what Gold should look like from Karaage
+# Returns the desired state, and the projects, accounts and institutes
+# Karaage knows about but that shouldn't exist.
+def get_karaage_state():
+    state = GoldState()
+
+    for pid, name, institute in Project.objects.filter(is_active=True) \
+            .values_list('pid', 'name', 'institute__name'):
+        state.projects[pid.lower()] = (
+                filter_string(truncate(name, 40)), filter_string(institute))
+
+    members = {}
+    for person_id, pid in Project.users.through.objects \
+            .filter(project__is_active=True) \
+            .values_list('person_id', 'project__pid'):
+        members.setdefault(person_id, []).append(pid.lower())
+
+    for ua in UserAccount.objects.filter(date_deleted__isnull=True) \
+            .select_related('user', 'default_project'):
+        username = ua.username.lower()
+        default_project = gold_null_project
+        if ua.default_project is not None:
+            default_project = ua.default_project.pid
+        state.users[username] = (default_project.lower(),
+                filter_string(ua.user.get_full_name()),
+                filter_string(ua.user.email))
+        for pid in members.get(ua.user_id, []):
+            state.members.add((username, pid))
+
+    for name in Institute.objects.filter(is_active=True) \
+            .values_list('name', flat=True):
+        state.organizations.add(name)
+
+    retired_projects = set([ pid.lower() for pid in
+            Project.objects.filter(is_active=False)
+            .values_list('pid', flat=True) ])
+    retired_users = set([ username.lower() for username in
+            UserAccount.objects.filter(date_deleted__isnull=False)
+            .values_list('username', flat=True) ])
+    retired_users = retired_users - set(state.users.keys())
+    retired_organizations = set(Institute.objects.filter(is_active=False)
+            .values_list('name', flat=True))
+
+    return state, retired_projects, retired_users, retired_organizations
+
+
+# Work out the commands needed to turn current into desired
+# Returns a list of (description, command) in the order they must be run.
+def diff_state(current, desired, retired_projects, retired_users,
+        retired_organizations, report, delete_unmanaged=False):
+
+    def deletable(kind, name, wanted, retired):
+        if name in wanted:
+            return False
+        if name in retired or delete_unmanaged:
+            return True
+        report.unmanaged.append("%s %s" % (kind, name))
+        return False
+
+    add_organizations = []
+    for name in sorted(desired.organizations - current.organizations):
+        add_organizations.append(("add organization %s" % name,
+            [ "goldsh", "Organization", "Create", "Name=%s" % name ]))
+
+    delete_organizations = []
+    for name in sorted(current.organizations):
+        if deletable("organization", name, desired.organizations,
+                retired_organizations):
+            delete_organizations.append(("delete organization %s" % name,
+                [ "goldsh", "Organization", "Delete", "Name==%s" % name ]))
+
+    add_projects = []
+    modify_projects = []
+    for name, (description, organization) in sorted(desired.projects.items()):
+        if name not in current.projects:
+            add_projects.append(("add project %s" % name,
+                [ "gmkproject", "-p", name, "-u", MEMBERS ]))
+            old_description, old_organization = None, None
+        else:
+            old_description, old_organization = current.projects[name]
+        command = [ "gchproject" ]
+        if old_description != description:
+            command.extend([ "-d", description ])
+        if old_organization != organization:
+            command.extend([ "-X", "Organization=%s" % organization ])
+        if len(command) > 1:
+            command.extend([ "-p", name ])
+            modify_projects.append(("modify project %s" % name, command))
+
+    delete_projects = []
+    for name in sorted(current.projects.keys()):
+        if name != gold_null_project.lower() and deletable("project", name,
+                desired.projects, retired_projects):
+            delete_projects.append(("delete project %s" % name,
+                [ "grmproject", "-p", name ]))
+
+    add_users = []
+    modify_users = []
+    for name, (default, common_name, email) in sorted(desired.users.items()):
+        if name not in current.users:
+            add_users.append(("add user %s" % name,
+                [ "gmkuser", "-A", "-p", default, "-u", name ]))
+            old_default, old_common_name, old_email = default, None, None
+        else:
+            old_default, old_common_name, old_email = current.users[name]
+        command = [ "gchuser" ]
+        if old_default != default:
+            command.extend([ "-p", default ])
+        if old_common_name != common_name:
+            command.extend([ "-n", common_name ])
+        if old_email != email:
+            command.extend([ "-E", email ])
+        if len(command) > 1:
+            command.extend([ "-u", name ])
+            modify_users.append(("modify user %s" % name, command))
+
+    delete_users = []
+    for name in sorted(current.users.keys()):
+        if deletable("user", name, desired.users, retired_users):
+            delete_users.append(("delete user %s" % name,
+                [ "grmuser", "-u", name ]))
+
+    add_members = []
+    missing = desired.members - current.members
+    for project, users in sorted(group_by_project(missing).items()):
+        users = ",".join(sorted(users))
+        add_members.append(("add %s to project %s" % (users, project),
+            [ "gchproject", "--add-users", users, "-p", project ]))
+
+    # memberships of deleted users and projects go with them, and unmanaged
+    # users and projects are left alone
+    delete_members = []
+    extra = set([ (user, project)
+        for user, project in current.members - desired.members
+        if user in desired.users and project in desired.projects ])
+    for project, users in sorted(group_by_project(extra).items()):
+        users = ",".join(sorted(users))
+        delete_members.append(("delete %s from project %s" % (users, project),
+            [ "gchproject", "--del-users", users, "-p", project ]))
+
+    # the order matters: organizations before their projects, projects
+    # before their members, and memberships before they become a default
+    changes = []
+    changes.extend(add_organizations)
+    changes.extend(add_projects)
+    changes.extend(modify_projects)
+    changes.extend(add_users)
+    changes.extend(add_members)
+    changes.extend(modify_users)
+    changes.extend(delete_members)
+    changes.extend(delete_users)
+    changes.extend(delete_projects)
+    changes.extend(delete_organizations)
+    return changes
+
+
+# Bring Gold into line with Karaage
+def sync(dry_run=False, delete_unmanaged=False):
+    report = SyncReport()
+
+    start = time.time()
+    current = get_gold_state()
+    report.time("read gold", start)
+
+    start = time.time()
+    desired, retired_projects, retired_users, retired_organizations = \
+            get_karaage_state()
+    report.time("read karaage", start)
+
+    start = time.time()
+    changes = diff_state(current, desired, retired_projects, retired_users,
+            retired_organizations, report, delete_unmanaged=delete_unmanaged)
+    report.time("diff", start)
+
+    apply_changes(changes, call, report, dry_run=dry_run)
+
+    return report
@@ -0,0 +1,252 @@
+"""
+Counts and latency of backend commands, in Prometheus text format.
+
+Every command run by Slurm or Gold is counted by backend, verb (the
+sacctmgr action or Gold program) and return code, and its latency goes in
+a histogram. Signal handlers count how often they run and how many
+commands they issue, whether the commands run straight away or are
+buffered.
+
+The numbers are per process. They are served by the view() Django view,
+and written after each signal handler, if KGLIMITS_METRICS_FILE is set, to
+a file of the process's own next to it (kglimits.<pid>.prom for
+kglimits.prom) with a process label, for the node exporter's textfile
+collector to pick up from the web and queue workers. Files of processes
+that have exited are removed.
+"""
+import os
+import glob
+import time
+import errno
+import threading
+
+from django.conf import settings
+
+if not hasattr(settings, 'KGLIMITS_METRICS_FILE'):
+    settings.KGLIMITS_METRICS_FILE = None
+
+metrics_file = settings.KGLIMITS_METRICS_FILE
+
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_local = threading.local()
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [ 0 ] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] = self.counts[i] + 1
+        self.count = self.count + 1
+        self.sum = self.sum + value
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.commands = {}
+        self.latency = {}
+        self.handler_calls = {}
+        self.handler_commands = {}
+        self.handler_failures = {}
+
+    def record(self, backend, verb, code, seconds):
+        self._lock.acquire()
+        try:
+            key = (backend, verb, code)
+            self.commands[key] = self.commands.get(key, 0) + 1
+            histogram = self.latency.get((backend, verb))
+            if histogram is None:
+                histogram = self.latency[(backend, verb)] = Histogram()
+            histogram.observe(seconds)
+        finally:
+            self._lock.release()
+
+    def issued(self, backend):
+        handler = current_handler()
+        if handler is None:
+            return
+        self._lock.acquire()
+        try:
+            key = (backend, handler)
+            self.handler_commands[key] = self.handler_commands.get(key, 0) + 1
+        finally:
+            self._lock.release()
+
+    def called(self, backend, handler):
+        self._lock.acquire()
+        try:
+            key = (backend, handler)
+            self.handler_calls[key] = self.handler_calls.get(key, 0) + 1
+        finally:
+            self._lock.release()
+
+    def failed(self, backend, handler):
+        self._lock.acquire()
+        try:
+            key = (backend, handler)
+            self.handler_failures[key] = self.handler_failures.get(key, 0) + 1
+        finally:
+            self._lock.release()
+
+    def render(self, process=None):
+        """ The metrics, labelled with process if given. """
+        extra = ""
+        if process is not None:
+            extra = 'process="%s",' % process
+        lines = []
+        self._lock.acquire()
+        try:
+            lines.append("# HELP kglimits_commands_total Backend commands run.")
+            lines.append("# TYPE kglimits_commands_total counter")
+            for (backend, verb, code), n in sorted(self.commands.items()):
+                lines.append('kglimits_commands_total{%sbackend="%s",verb="%s",code="%s"} %d'
+                    % (extra, backend, verb, code, n))
+
+            lines.append("# HELP kglimits_command_seconds Latency of backend commands.")
+            lines.append("# TYPE kglimits_command_seconds histogram")
+            for (backend, verb), h in sorted(self.latency.items()):
+                labels = extra + 'backend="%s",verb="%s"' % (backend, verb)
+                for bound, n in zip(BUCKETS, h.counts):
+                    lines.append('kglimits_command_seconds_bucket{%s,le="%s"} %d'
+                        % (labels, bound, n))
+                lines.append('kglimits_command_seconds_bucket{%s,le="+Inf"} %d'
+                    % (labels, h.count))
+                lines.append('kglimits_command_seconds_sum{%s} %f' % (labels, h.sum))
+                lines.append('kglimits_command_seconds_count{%s} %d' % (labels, h.count))
+
+            lines.append("# HELP kglimits_handler_calls_total Signal handler calls.")
+            lines.append("# TYPE kglimits_handler_calls_total counter")
+            for (backend, handler), n in sorted(self.handler_calls.items()):
+                lines.append('kglimits_handler_calls_total{%sbackend="%s",handler="%s"} %d'
+                    % (extra, backend, handler, n))
+
+            lines.append("# HELP kglimits_handler_commands_total Commands issued by signal handlers.")
+            lines.append("# TYPE kglimits_handler_commands_total counter")
+            for (backend, handler), n in sorted(self.handler_commands.items()):
+                lines.append('kglimits_handler_commands_total{%sbackend="%s",handler="%s"} %d'
+                    % (extra, backend, handler, n))
+
+            lines.append("# HELP kglimits_handler_failures_total Signal handlers that failed after their transaction committed.")
+            lines.append("# TYPE kglimits_handler_failures_total counter")
+            for (backend, handler), n in sorted(self.handler_failures.items()):
+                lines.append('kglimits_handler_failures_total{%sbackend="%s",handler="%s"} %d'
+                    % (extra, backend, handler, n))
+        finally:
+            self._lock.release()
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def current_handler():
+    """ The signal handler running in this thread, if any. """
+    return getattr(_local, "handler", None)
+
+
+def set_handler(handler):
+    _local.handler = handler
+
+
+def verb(command):
+    """ The verb of a command, for labels. """
+    if len(command) == 0:
+        return ""
+    return command[0].lower()
+
+
+class Timer(object):
+    """ Records one command when stopped. """
+
+    def __init__(self, backend, command):
+        self.backend = backend
+        self.verb = verb(command)
+        self.start = time.time()
+
+    def stop(self, code):
+        registry.record(self.backend, self.verb, code,
+            time.time() - self.start)
+
+
+def issued(backend):
+    """ Count a command against the signal handler running, if any. """
+    registry.issued(backend)
+
+
+def failed(backend, handler):
+    """ Count a signal handler that failed where it couldn't raise. """
+    registry.failed(backend, handler)
+
+
+def handler(backend):
+    """ Decorator for signal handlers, counting the commands they issue. """
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            previous = current_handler()
+            set_handler(func.__name__)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                set_handler(previous)
+                registry.called(backend, func.__name__)
+                if metrics_file is not None:
+                    write(metrics_file)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+
+def process_path(path, pid):
+    """ The file of process pid for path: kglimits.<pid>.prom for kglimits.prom """
+    root, ext = os.path.splitext(path)
+    return "%s.%d%s" % (root, pid, ext)
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def write(path):
+    """
+    Write the metrics of this process to its own file for path, replacing
+    it in one go, and remove the files of processes that have exited.
+    """
+    pid = os.getpid()
+    mine = process_path(path, pid)
+    # not named like the files, so a half written one isn't read
+    tmp = "%s.tmp" % mine
+    f = open(tmp, "w")
+    try:
+        f.write(registry.render(process=pid))
+    finally:
+        f.close()
+    os.rename(tmp, mine)
+
+    root, ext = os.path.splitext(path)
+    for other in glob.glob("%s.*%s" % (root, ext)):
+        number = other[len(root) + 1:len(other) - len(ext)]
+        if number.isdigit() and not alive(int(number)):
+            try:
+                os.unlink(other)
+            except OSError:
+                pass
+
+
+def view(request):
+    """ Django view serving the metrics. """
+    from django.http import HttpResponse
+    return HttpResponse(registry.render(),
+        content_type="text/plain; version=0.0.4")
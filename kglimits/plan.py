@@ -0,0 +1,218 @@
+"""
+Plans of backend commands, for seeing what a bulk change would do.
+
+Inside "with plan:" the commands Slurm and Gold signal handlers give
+call() are recorded instead of run, coalesced the same way as the
+transaction buffer, and handlers run straight away even if a work queue is
+configured. Lookups see the planned adds and deletes.
+
+Readers can be served from a Snapshot: output recorded from earlier runs of
+the same commands, kept in a JSON file. Commands the snapshot doesn't have
+are run and added to it.
+
+    snapshot = Snapshot("/tmp/snapshot.json")
+    p = Plan(snapshot)
+    with p:
+        import_students()
+    print p.to_json()
+    p.execute()
+"""
+import os
+import json
+import threading
+
+from kglimits import buffer
+from kglimits import metrics
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+# seconds per command assumed until metrics have been recorded
+DEFAULT_SECONDS = {
+    "slurm": 0.5,
+    "gold": 1.0,
+}
+
+
+class Plan(object):
+
+    def __init__(self, snapshot=None):
+        self.snapshot = snapshot
+        self.buffers = {}
+
+    def __enter__(self):
+        self.adopt()
+        return self
+
+    def adopt(self):
+        """ Make this the current plan of the calling thread. """
+        if not hasattr(_local, "plans"):
+            _local.plans = []
+        _local.plans.append(self)
+        buffer.push_buffers(self.buffers)
+
+    def __exit__(self, type, value, traceback):
+        buffer.pop_buffers(self.buffers)
+        _local.plans.remove(self)
+        if self.snapshot is not None:
+            self.snapshot.save()
+        return False
+
+    def seconds(self, backend, command):
+        """ Expected time of one command, from the metrics so far. """
+        histogram = metrics.registry.latency.get(
+            (backend, metrics.verb(command)))
+        if histogram is not None and histogram.count > 0:
+            return histogram.sum / histogram.count
+        return DEFAULT_SECONDS.get(backend, 1.0)
+
+    def summary(self):
+        # the executor uses plans too
+        from kglimits.executor import lanes
+
+        result = {}
+        total = 0
+        for name, buf in sorted(self.buffers.items()):
+            commands = []
+            counts = {}
+            for op in buf.operations:
+                commands.append(op.command)
+                verb = metrics.verb(op.command)
+                counts[verb] = counts.get(verb, 0) + 1
+
+            # independent commands run at the same time, up to the
+            # concurrency of the backend
+            serial = 0.0
+            longest = 0.0
+            for lane in lanes(buf.operations):
+                t = sum([ self.seconds(name, op.command) for op in lane ])
+                serial = serial + t
+                longest = max(longest, t)
+            concurrency = max(buf.backend.executor.concurrency, 1)
+            estimate = max(longest, serial / concurrency)
+
+            result[name] = {
+                "commands": commands,
+                "counts": counts,
+                "requested": buf.requested,
+                "serial_seconds": serial,
+                "seconds": estimate,
+            }
+            total = total + len(commands)
+        return {
+            "backends": result,
+            "commands": total,
+            # backends are run one after another
+            "seconds": sum([ b["seconds"] for b in result.values() ]),
+        }
+
+    def to_json(self):
+        return json.dumps(self.summary(), indent=2, sort_keys=True)
+
+    def execute(self):
+        """
+        Run the planned commands, as a buffer would when its transaction
+        commits but with no deadline, as they aren't run by the handlers
+        that planned them; each command still has its own timeout. Raises
+        CommandErrors with the failures of every backend.
+        """
+        errors = []
+        for name, buf in sorted(self.buffers.items()):
+            try:
+                buf.flush(bounded=False)
+            except buffer.CommandErrors, e:
+                errors.extend(e.errors)
+        if errors:
+            raise buffer.CommandErrors(errors)
+
+
+class Snapshot(object):
+    """ Recorded output of reader commands. """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.outputs = {}
+        self.changed = False
+        if path is not None and os.path.exists(path):
+            f = open(path)
+            try:
+                self.outputs = json.load(f)
+            finally:
+                f.close()
+
+    def save(self):
+        if self.path is None or not self.changed:
+            return
+        tmp = "%s.tmp" % self.path
+        f = open(tmp, "w")
+        try:
+            json.dump(self.outputs, f)
+        finally:
+            f.close()
+        os.rename(tmp, self.path)
+        self.changed = False
+
+    def popen(self, backend, transport, command, timeout=None):
+        key = "%s %s" % (backend, json.dumps(command))
+        output = self.outputs.get(key)
+        if output is not None:
+            logger.debug("Snapshot %s" % command)
+            return Recorded(output["lines"], output["returncode"])
+        return Recording(self, key, transport.popen(command, timeout))
+
+
+class Recorded(object):
+    """ Looks like subprocess.Popen, for output from a snapshot. """
+
+    def __init__(self, lines, returncode):
+        self.stdout = iter(lines)
+        self.returncode = returncode
+
+    def wait(self):
+        for line in self.stdout:
+            pass
+        return self.returncode
+
+
+class Recording(object):
+    """ Passes through the output of a command, adding it to a snapshot. """
+
+    def __init__(self, snapshot, key, process):
+        self.snapshot = snapshot
+        self.key = key
+        self.process = process
+        self.lines = []
+        self.stdout = self._lines()
+
+    def _lines(self):
+        for line in self.process.stdout:
+            self.lines.append(line)
+            yield line
+
+    def wait(self):
+        for line in self.stdout:
+            pass
+        returncode = self.process.wait()
+        self.snapshot.outputs[self.key] = {
+            "lines": self.lines, "returncode": returncode }
+        self.snapshot.changed = True
+        return returncode
+
+
+def current_plan():
+    """ The plan commands are going to in this thread, if any. """
+    plans = getattr(_local, "plans", [])
+    if plans:
+        return plans[-1]
+    return None
+
+
+# Start a reader command, from the snapshot of the current plan if any
+def popen(backend, transport, command, timeout=None):
+    p = current_plan()
+    if p is None or p.snapshot is None:
+        return transport.popen(command, timeout)
+    return p.snapshot.popen(backend, transport, command, timeout)
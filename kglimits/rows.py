@@ -0,0 +1,67 @@
+"""
+Compact rows of backend output.
+
+A row is a tuple of the values in one line of output, that can also be
+indexed by column header like the dicts it replaces. The headers and their
+positions are kept once, on a class shared by every row with the same
+headers.
+"""
+import threading
+
+_classes = {}
+_lock = threading.Lock()
+
+
+class Row(tuple):
+    __slots__ = ()
+    headers = ()
+    index = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return tuple.__getitem__(self, self.index[key])
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        i = self.index.get(key)
+        if i is None or i >= len(self):
+            return default
+        return tuple.__getitem__(self, i)
+
+    def keys(self):
+        return list(self.headers)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def as_dict(self):
+        return dict(zip(self.headers, self))
+
+    def __repr__(self):
+        return "Row(%r)" % self.as_dict()
+
+
+def row_class(headers):
+    """ The Row class for output with these headers. """
+    headers = tuple([ intern(h) for h in headers ])
+    _lock.acquire()
+    try:
+        cls = _classes.get(headers)
+        if cls is None:
+            index = {}
+            for i, h in enumerate(headers):
+                index.setdefault(h, i)
+            cls = type("Row", (Row,), {
+                "__slots__": (), "headers": headers, "index": index })
+            _classes[headers] = cls
+        return cls
+    finally:
+        _lock.release()
+
+
+def make_row(cls, values):
+    """ A row of cls, padded with "" if the line was short. """
+    missing = len(cls.headers) - len(values)
+    if missing > 0:
+        values = values + [ "" ] * missing
+    return cls(values)
@@ -0,0 +1,396 @@
+"""
+Transports for running backend commands.
+
+A transport turns a list of command arguments into an object that looks
+like subprocess.Popen: it has a stdout that iterates over output lines and
+a wait() method returning the exit code.
+
+CommandTransport forks a new process for every command. SessionPool keeps
+a few long lived interactive processes (such as sacctmgr or goldsh) open and
+writes commands to their stdin, avoiding process startup and sudo for every
+command.
+
+popen() takes an optional timeout in seconds. A command that runs longer
+is killed, with its process group, and raises CommandTimeout.
+"""
+import os
+import pty
+import time
+import errno
+import signal
+import select
+import atexit
+import threading
+import subprocess
+import Queue
+
+from kglimits.timeouts import CommandTimeout
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SessionError(Exception):
+    pass
+
+
+class SessionWriteError(SessionError):
+    """ The session was gone before the command could be written to it. """
+    pass
+
+
+def kill_group(process):
+    """
+    Kill a process started in a process group of its own, and everything
+    it started. sudo passes on SIGTERM to commands we can't signal
+    ourselves, so that is tried before SIGKILL.
+    """
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(process.pid, sig)
+        except OSError, e:
+            if e.errno == errno.EPERM:
+                process.send_signal(sig)
+            elif e.errno != errno.ESRCH:
+                raise
+        for i in range(10):
+            if process.poll() is not None:
+                return
+            time.sleep(0.1)
+
+
+class TimedProcess(object):
+    """ Looks like subprocess.Popen, for a process with a timeout. """
+
+    def __init__(self, process, args, timeout):
+        self.process = process
+        self.args = args
+        self.timeout = timeout
+        self.deadline = time.time() + timeout
+        self.returncode = None
+        self.stdout = self._lines()
+
+    def _expire(self):
+        logger.error("Cmd %s timed out after %.1fs" % (self.args, self.timeout))
+        kill_group(self.process)
+        self.returncode = self.process.wait()
+        raise CommandTimeout(self.args, self.timeout)
+
+    def _lines(self):
+        fd = self.process.stdout.fileno()
+        data = ""
+        while True:
+            remaining = self.deadline - time.time()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                self._expire()
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            data += chunk
+            while "\n" in data:
+                line, data = data.split("\n", 1)
+                yield line + "\n"
+        if data:
+            yield data
+
+    def wait(self):
+        for line in self.stdout:
+            pass
+        while self.process.poll() is None:
+            if time.time() > self.deadline:
+                self._expire()
+            time.sleep(0.01)
+        self.returncode = self.process.returncode
+        return self.returncode
+
+
+class CommandTransport(object):
+    """ Run every command in a new process. """
+
+    def __init__(self, command):
+        self.command = command
+
+    def popen(self, args, timeout=None):
+        c = []
+        c.extend(self.command)
+        c.extend(args)
+
+        null = open('/dev/null', 'w')
+        if timeout is None:
+            p = subprocess.Popen(c, stdout=subprocess.PIPE, stderr=null)
+        else:
+            # a group of its own, so it can be killed with what it starts
+            p = subprocess.Popen(c, stdout=subprocess.PIPE, stderr=null,
+                preexec_fn=os.setsid)
+        null.close()
+        if timeout is not None:
+            return TimedProcess(p, args, timeout)
+        return p
+
+    def close(self):
+        pass
+
+
+class Session(object):
+    """
+    One long lived interactive process.
+
+    Subclasses say how commands are written to stdin and how the end of each
+    command's output is found. After every command a sentinel command is
+    written; its output is a line that real commands never produce. Anything
+    written to stderr while a command runs is treated as a failure.
+    """
+    prompt = ""
+    sentinel_command = None
+    sentinel_line = None
+
+    def __init__(self, command):
+        self.command = command
+        self.process = None
+        self.returncode = None
+        self._master = None
+        self._buffer = ""
+
+    def format_command(self, args):
+        raise NotImplementedError()
+
+    def parse_errors(self, text):
+        """ Turn stderr output of a command into a return code. """
+        if text.strip() == "":
+            return 0
+        return 1
+
+    def start(self):
+        self.close()
+        logger.debug("Starting session %s" % self.command)
+
+        # stdout is a pty so the backend flushes its output after every line
+        # and a process group of its own so it can be killed if it hangs
+        master, slave = pty.openpty()
+        try:
+            self.process = subprocess.Popen(self.command,
+                stdin=subprocess.PIPE, stdout=slave, stderr=subprocess.PIPE,
+                close_fds=True, preexec_fn=os.setsid)
+        finally:
+            os.close(slave)
+        self._master = master
+        self._buffer = ""
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def close(self):
+        if self.process is None:
+            return
+        logger.debug("Closing session %s" % self.command)
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        if self.process.poll() is None:
+            try:
+                self.process.terminate()
+            except OSError:
+                pass
+            self.process.wait()
+        self.process.stderr.close()
+        os.close(self._master)
+        self.process = None
+        self._master = None
+        self._buffer = ""
+
+    def _read(self, fd):
+        try:
+            return os.read(fd, 65536)
+        except OSError, e:
+            # reading a pty after the child has gone returns EIO
+            if e.errno == errno.EIO:
+                return ""
+            raise
+
+    def _read_available(self, fd):
+        data = []
+        while select.select([fd], [], [], 0)[0]:
+            chunk = self._read(fd)
+            if not chunk:
+                break
+            data.append(chunk)
+        return "".join(data)
+
+    def _strip_prompt(self, line):
+        line = line.rstrip("\r")
+        if self.prompt:
+            while line.startswith(self.prompt):
+                line = line[len(self.prompt):]
+        return line
+
+    def kill(self):
+        """ Kill a hung session. """
+        if self.process is not None and self.process.poll() is None:
+            kill_group(self.process)
+        self.close()
+
+    def execute(self, args, timeout=None):
+        """ Run one command, yielding lines of output. """
+        if not self.alive():
+            self.start()
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        try:
+            self.process.stdin.write("%s\n%s\n"
+                % (self.format_command(args), self.sentinel_command))
+            self.process.stdin.flush()
+        except IOError, e:
+            raise SessionWriteError("Session %s closed: %s" % (self.command, e))
+
+        stdout = self._master
+        stderr = self.process.stderr.fileno()
+        errors = []
+        while True:
+            while "\n" in self._buffer:
+                line, self._buffer = self._buffer.split("\n", 1)
+                line = self._strip_prompt(line)
+                if line == self.sentinel_line:
+                    errors.append(self._read_available(stderr))
+                    errors = "".join(errors)
+                    if errors.strip() != "":
+                        logger.debug("<-- stderr %s" % errors.strip())
+                    self.returncode = self.parse_errors(errors)
+                    return
+                if line != "":
+                    yield line
+
+            if deadline is None:
+                ready = select.select([stdout, stderr], [], [])[0]
+            else:
+                remaining = deadline - time.time()
+                ready = []
+                if remaining > 0:
+                    ready = select.select([stdout, stderr], [], [], remaining)[0]
+                if not ready:
+                    logger.error("Cmd %s timed out after %.1fs, killing session %s"
+                        % (args, timeout, self.command))
+                    self.kill()
+                    raise CommandTimeout(args, timeout)
+            for fd in ready:
+                data = self._read(fd)
+                if not data:
+                    raise SessionError("Session %s closed unexpectedly"
+                        % self.command)
+                if fd == stdout:
+                    self._buffer += data
+                else:
+                    errors.append(data)
+
+
+class SessionProcess(object):
+    """ Looks like subprocess.Popen for one command run in a pooled session. """
+
+    def __init__(self, pool, args, timeout=None):
+        self.returncode = None
+        self.stdout = self._lines(pool, args, timeout)
+
+    def _lines(self, pool, args, timeout):
+        started = time.time()
+        session = pool.acquire(args, timeout)
+        if timeout is not None:
+            # waiting for the session came out of the command's time
+            remaining = timeout - (time.time() - started)
+            if remaining <= 0:
+                pool.release(session)
+                raise CommandTimeout(args, timeout)
+            timeout = remaining
+        finished = False
+        try:
+            for attempt in (1, 2):
+                try:
+                    for line in session.execute(args, timeout):
+                        yield line + "\n"
+                    self.returncode = session.returncode
+                    finished = True
+                    return
+                except SessionError, e:
+                    logger.warning("%s" % e)
+                    session.close()
+                    # only retry when the command never reached the
+                    # session: one that did may have run already
+                    if not isinstance(e, SessionWriteError) or attempt == 2:
+                        self.returncode = -1
+                        finished = True
+                        return
+        finally:
+            if not finished:
+                # the rest of the output is still waiting to be read
+                session.close()
+            pool.release(session)
+
+    def wait(self):
+        for line in self.stdout:
+            pass
+        return self.returncode
+
+
+class SessionPool(object):
+    """ Up to size sessions shared between threads. """
+
+    def __init__(self, session_class, command, size):
+        self.session_class = session_class
+        self.command = command
+        self.size = size
+        self._lock = threading.Lock()
+        self._reset()
+        atexit.register(self.close)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = Queue.Queue()
+        self._sessions = []
+
+    def acquire(self, args=None, timeout=None):
+        """
+        A session to run args in, waiting at most timeout seconds for one
+        to be free. Raises CommandTimeout if none is.
+        """
+        self._lock.acquire()
+        try:
+            if self._pid != os.getpid():
+                # sessions of our parent process are not ours to use
+                self._reset()
+            try:
+                return self._idle.get_nowait()
+            except Queue.Empty:
+                pass
+            if len(self._sessions) < self.size:
+                session = self.session_class(self.command)
+                self._sessions.append(session)
+                return session
+            idle = self._idle
+        finally:
+            self._lock.release()
+        if timeout is None:
+            return idle.get()
+        try:
+            return idle.get(True, timeout)
+        except Queue.Empty:
+            logger.error("Cmd %s timed out after %.1fs waiting for a session %s"
+                % (args, timeout, self.command))
+            raise CommandTimeout(args, timeout)
+
+    def release(self, session):
+        self._idle.put(session)
+
+    def popen(self, args, timeout=None):
+        return SessionProcess(self, args, timeout)
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            if self._pid == os.getpid():
+                for session in self._sessions:
+                    session.close()
+            self._reset()
+        finally:
+            self._lock.release()
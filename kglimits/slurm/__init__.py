@@ -1,10 +1,30 @@
-from django.db.models import signals
+from django.db.models import signals, Q
 from karaage import people
 from karaage import machines
 from karaage import projects
 from datetime import datetime
 import subprocess
 import csv
+import os
+
+from kglimits.session import SessionPool, CommandTransport
+from kglimits.broker import BrokerTransport
+from kglimits import buffer
+from kglimits import cache
+from kglimits import workqueue
+from kglimits import executor
+from kglimits import rows
+from kglimits import metrics
+from kglimits import plan
+from kglimits import changes
+from kglimits import timeouts
+from kglimits.slurm.session import SacctmgrSession, SacctTransport
+from kglimits.slurm.rest import RestTransport
+from kglimits.slurm.database import AccountingDatabase
+from kglimits.slurm.clusters import Clusters
+from kglimits.slurm import clusters
+from kglimits.slurm.commands import SlurmCommands, user_key, account_key
+from kglimits.slurm.commands import association_command, group_associations
 
 from django.conf import settings
 
@@ -16,13 +36,91 @@ if not hasattr(settings, 'SLURM_PATH'):
     settings.SLURM_PATH = "/usr/local/slurm/latest/bin/sacctmgr"
 if not hasattr(settings, 'SLURM_NULL_PROJECT'):
     settings.SLURM_NULL_PROJECT = "default"
+if not hasattr(settings, 'SLURM_SESSIONS'):
+    settings.SLURM_SESSIONS = 2
+if not hasattr(settings, 'SLURM_BUFFER'):
+    settings.SLURM_BUFFER = True
+if not hasattr(settings, 'SLURM_QUEUE'):
+    settings.SLURM_QUEUE = None
+if not hasattr(settings, 'SLURM_CACHE_TTL'):
+    settings.SLURM_CACHE_TTL = 0
+if not hasattr(settings, 'SLURM_BATCH_SIZE'):
+    settings.SLURM_BATCH_SIZE = 100
+if not hasattr(settings, 'SLURM_CONCURRENCY'):
+    settings.SLURM_CONCURRENCY = 2
+if not hasattr(settings, 'SLURM_SACCT_PATH'):
+    settings.SLURM_SACCT_PATH = os.path.join(
+            os.path.dirname(settings.SLURM_PATH), "sacct")
+if not hasattr(settings, 'SLURM_USAGE'):
+    settings.SLURM_USAGE = None
+if not hasattr(settings, 'SLURM_USAGE_WINDOW'):
+    settings.SLURM_USAGE_WINDOW = 86400
+if not hasattr(settings, 'SLURM_USAGE_LAG'):
+    settings.SLURM_USAGE_LAG = 300
+if not hasattr(settings, 'SLURM_USAGE_OVERLAP'):
+    settings.SLURM_USAGE_OVERLAP = 3600
+if not hasattr(settings, 'SLURM_TIMEOUT'):
+    settings.SLURM_TIMEOUT = 120
+if not hasattr(settings, 'SLURM_TIMEOUTS'):
+    settings.SLURM_TIMEOUTS = { "load": 3600, "sacct": 900 }
+if not hasattr(settings, 'SLURM_DEADLINE'):
+    settings.SLURM_DEADLINE = 300
+if not hasattr(settings, 'SLURM_BREAKER_THRESHOLD'):
+    settings.SLURM_BREAKER_THRESHOLD = 3
+if not hasattr(settings, 'SLURM_BREAKER_COOLDOWN'):
+    settings.SLURM_BREAKER_COOLDOWN = 60
+if not hasattr(settings, 'SLURM_REST_URL'):
+    settings.SLURM_REST_URL = None
+if not hasattr(settings, 'SLURM_REST_CLUSTER'):
+    settings.SLURM_REST_CLUSTER = None
+if not hasattr(settings, 'SLURM_REST_USER'):
+    settings.SLURM_REST_USER = None
+if not hasattr(settings, 'SLURM_REST_TOKEN'):
+    settings.SLURM_REST_TOKEN = None
+if not hasattr(settings, 'SLURM_REST_VERSION'):
+    settings.SLURM_REST_VERSION = "v0.0.39"
+if not hasattr(settings, 'SLURM_REST_CONNECTIONS'):
+    settings.SLURM_REST_CONNECTIONS = 4
+if not hasattr(settings, 'SLURM_BROKER'):
+    settings.SLURM_BROKER = None
+if not hasattr(settings, 'SLURM_DB'):
+    settings.SLURM_DB = None
+if not hasattr(settings, 'SLURM_DB_MODULE'):
+    settings.SLURM_DB_MODULE = "MySQLdb"
+if not hasattr(settings, 'SLURM_DB_CLUSTERS'):
+    settings.SLURM_DB_CLUSTERS = None
+if not hasattr(settings, 'SLURM_DB_CONNECTIONS'):
+    settings.SLURM_DB_CONNECTIONS = 2
+if not hasattr(settings, 'SLURM_CLUSTERS'):
+    settings.SLURM_CLUSTERS = None
 
 slurm_prefix = settings.SLURM_PREFIX
 slurm_path = settings.SLURM_PATH
 slurm_null_project = settings.SLURM_NULL_PROJECT
+slurm_sessions = settings.SLURM_SESSIONS
+slurm_buffer = settings.SLURM_BUFFER
+slurm_batch_size = settings.SLURM_BATCH_SIZE
+slurm_sacct_path = settings.SLURM_SACCT_PATH
+slurm_usage = settings.SLURM_USAGE
+slurm_usage_window = settings.SLURM_USAGE_WINDOW
+slurm_usage_lag = settings.SLURM_USAGE_LAG
+slurm_usage_overlap = settings.SLURM_USAGE_OVERLAP
+slurm_timeout = settings.SLURM_TIMEOUT
+slurm_timeouts = settings.SLURM_TIMEOUTS
+slurm_deadline = settings.SLURM_DEADLINE
+slurm_rest_url = settings.SLURM_REST_URL
+slurm_rest_cluster = settings.SLURM_REST_CLUSTER
+slurm_db = settings.SLURM_DB
+slurm_broker = settings.SLURM_BROKER
+slurm_clusters = Clusters(settings.SLURM_CLUSTERS, settings)
 
 logger = logging.getLogger(__name__)
 
+slurm_queue = workqueue.WorkQueue("slurm", settings.SLURM_QUEUE)
+slurm_cache = cache.LookupCache(settings.SLURM_CACHE_TTL,
+        lambda: slurm_clusters.current().backend)
+slurm_executor = executor.Executor(settings.SLURM_CONCURRENCY, clusters.context)
+
 
 # used for filtering description containing \n and \r
 def filter_string(value):
@@ -57,18 +155,129 @@ def truncate(value, arg):
     else:
         return value
 
-# Call remote command with logging
+# Make a transport that runs sacctmgr commands for the current cluster in
+# this process
+def make_transport(prefix=None):
+    cluster = slurm_clusters.current()
+    if prefix is None:
+        prefix = cluster.setting("PREFIX")
+    command = []
+    command.extend(prefix)
+    command.extend([ cluster.setting("PATH"), "-ip" ])
+    sessions = cluster.setting("SESSIONS")
+    if sessions > 0:
+        return SessionPool(SacctmgrSession, command, sessions)
+    return CommandTransport(command)
+
+# Make a transport that runs sacct commands for the current cluster in this
+# process
+# sacct reads and prints times in UTC, so they mean the same wherever it runs
+# and whatever the time of year.
+def make_sacct_transport(prefix=None):
+    cluster = slurm_clusters.current()
+    if prefix is None:
+        prefix = cluster.setting("PREFIX")
+    path = cluster.setting("SACCT_PATH")
+    if "PATH" in cluster.options and "SACCT_PATH" not in cluster.options:
+        # sacct is next to the cluster's sacctmgr
+        path = os.path.join(os.path.dirname(cluster.options["PATH"]), "sacct")
+    command = []
+    command.extend(prefix)
+    command.extend([ "env", "TZ=UTC", path, "-p" ])
+    return SacctTransport(command)
+
+# Get the transport used to run sacctmgr commands for the current cluster
+def get_transport():
+    cluster = slurm_clusters.current()
+    broker = cluster.setting("BROKER")
+    url = cluster.setting("REST_URL")
+    if cluster.transport is None and broker is not None:
+        cluster.transport = BrokerTransport(broker)
+    if cluster.transport is None and url is not None:
+        if cluster.setting("REST_CLUSTER") is None:
+            logger.error("SLURM_REST_CLUSTER is needed to use slurmrestd")
+            raise RuntimeError("SLURM_REST_CLUSTER is needed to use slurmrestd")
+        cluster.transport = RestTransport(url, cluster.setting("REST_CLUSTER"),
+                cluster.setting("REST_USER"), cluster.setting("REST_TOKEN"),
+                cluster.setting("REST_VERSION"), cluster.setting("REST_CONNECTIONS"))
+    if cluster.transport is None:
+        cluster.transport = make_transport()
+    return cluster.transport
+
+# Get the transport used to run sacct commands for the current cluster
+def get_sacct_transport():
+    cluster = slurm_clusters.current()
+    broker = cluster.setting("BROKER")
+    if cluster.sacct_transport is None and broker is not None:
+        cluster.sacct_transport = BrokerTransport(broker)
+    if cluster.sacct_transport is None:
+        cluster.sacct_transport = make_sacct_transport()
+    return cluster.sacct_transport
+
+# Get the slurmdbd database lookups for the current cluster are read from, if
+# SLURM_DB is set
+def get_database():
+    cluster = slurm_clusters.current()
+    db = cluster.setting("DB")
+    if cluster.database is None and db is not None:
+        cluster.database = AccountingDatabase(cluster.setting("DB_MODULE"), db,
+                cluster.setting("DB_CLUSTERS"), cluster.setting("DB_CONNECTIONS"))
+    return cluster.database
+
+# Get the commands of the current cluster, which keep its buffers apart
+def get_commands():
+    return slurm_clusters.current().commands
+
+# Call remote command, or buffer it until the transaction commits or for a
+# plan
 def call(command, ignore_errors=[]):
-    c = []
-    c.extend(slurm_prefix)
-    c.extend([ slurm_path, "-ip" ])
-    c.extend(command)
-    command = c
-
+    metrics.issued("slurm")
+    commands = get_commands()
+    if buffer.add(commands, command, ignore_errors, slurm_buffer):
+        logger.debug("Buffered %s"%command)
+        forget(command)
+        return
+    buffer.run(commands, commands.parse(command, ignore_errors))
+
+# Call many remote commands, running independent ones at the same time, or
+# buffer them until the transaction commits or for a plan
+def call_many(commands, ignore_errors=[]):
+    backend = get_commands()
+    if buffer.get_buffer(backend, transactional=slurm_buffer) is not None:
+        for command in commands:
+            call(command, ignore_errors)
+        return
+    for command in commands:
+        metrics.issued("slurm")
+    operations = [ backend.parse(command, ignore_errors) for command in commands ]
+    slurm_executor.run(operations, lambda op: buffer.run(backend, op))
+
+# Start a command, from the plan's snapshot if there is one, within its
+# timeout and the deadline of the signal handler, unless the circuit breaker
+# is open
+def popen(command, transport=None):
+    cluster = slurm_clusters.current()
+    if transport is None:
+        transport = get_transport()
+    timeout = timeouts.timeout(slurm_timeouts.get(metrics.verb(command), slurm_timeout), command)
+    cluster.breaker.check(command)
+    return cluster.breaker.watch(plan.popen(cluster.backend, transport, command, timeout))
+
+# Call remote command now with logging
+def execute(command, ignore_errors=[]):
     logger.debug("Cmd %s"%command)
-    null = open('/dev/null', 'w')
-    retcode = subprocess.call(command,stdout=null,stderr=null)
-    null.close()
+    timer = metrics.Timer(slurm_clusters.current().backend, command)
+    try:
+        p = popen(command)
+        for line in p.stdout:
+            pass
+        retcode = p.wait()
+    except timeouts.Unavailable, e:
+        timer.stop(e.returncode)
+        forget(command)
+        raise
+    timer.stop(retcode)
+    forget(command)
 
     if retcode in ignore_errors:
         logger.debug("<-- Cmd %s returned %d (ignored)"%(command,retcode))
@@ -81,42 +290,81 @@ def call(command, ignore_errors=[]):
     logger.debug("<-- Returned %d (good)"%(retcode))
     return
 
-# Read CSV delimited input from Slurm
-def read_slurm_output(command):
-    c = []
-    c.extend(slurm_prefix)
-    c.extend([ slurm_path, "-ip" ])
-    c.extend(command)
-    command = c
-
+# every cluster's commands run with it as the current cluster, even when a
+# transaction commits
+for cluster in slurm_clusters.clusters:
+    cluster.commands = SlurmCommands(cluster.bind(execute), slurm_executor,
+            cluster.backend)
+
+# Forget cached lookups that command makes stale
+def forget(command):
+    op = get_commands().parse(command)
+    if op.key is None:
+        slurm_cache.invalidate()
+    else:
+        slurm_cache.invalidate(op.entities)
+
+# Headers sacctmgr prints for format= fields, where they differ
+HEADERS = {
+    "DefaultAccount": "Def Acct",
+    "Description": "Descr",
+    "Organization": "Org",
+}
+
+# Read CSV delimited input from Slurm a row at a time
+# Rows are yielded as they arrive; a failed command raises an error after
+# the last of them. If fields are given, only those columns are asked for,
+# and rows are indexed by the field names. sacct commands need the sacct
+# transport.
+def iter_slurm_output(command, fields=None, transport=None):
+    if fields is not None:
+        if command[0] == "sacct":
+            command = command + [ "--format=%s"%",".join(fields) ]
+        else:
+            command = command + [ "format=%s"%",".join(fields) ]
     logger.debug("Cmd %s"%command)
-    null = open('/dev/null', 'w')
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=null)
-    null.close()
-
-    results = []
-    reader = csv.reader(p.stdout,delimiter="|")
+    debug = logger.isEnabledFor(logging.DEBUG)
+    metrics.issued("slurm")
+    timer = metrics.Timer(slurm_clusters.current().backend, command)
+    p = popen(command, transport)
+    finished = False
 
     try:
-        headers = reader.next()
-        logger.debug("<-- headers %s"%headers)
-    except StopIteration, e:
-        logger.debug("Cmd %s headers not found"%command)
-        headers = []
-
-    for row in reader:
-        logger.debug("<-- row %s"%row)
-        this_row = {}
-
-        i = 0
-        for i in range(0,len(headers)):
-            key = headers[i]
-            value = row[i]
-            this_row[key] = value
-
-        results.append(this_row)
+        reader = csv.reader(p.stdout,delimiter="|")
+
+        try:
+            headers = reader.next()
+            if debug:
+                logger.debug("<-- headers %s"%headers)
+        except StopIteration, e:
+            logger.debug("Cmd %s headers not found"%command)
+            headers = []
+
+        if fields is not None and headers:
+            # parsable output ends each line with a separator
+            if headers[-1] == "":
+                headers = headers[:-1]
+            expected = [ HEADERS.get(field, field) for field in fields ]
+            if [ h.lower() for h in headers ] != [ h.lower() for h in expected ]:
+                logger.error("Cmd %s returned headers %s, expected %s"%(command,headers,expected))
+                raise RuntimeError("Cmd %s returned headers %s, expected %s"%(command,headers,expected))
+            headers = fields
+
+        row_type = rows.row_class(headers)
+        for row in reader:
+            if debug:
+                logger.debug("<-- row %s"%row)
+            yield rows.make_row(row_type, row)
+        finished = True
+    finally:
+        if not finished:
+            # leave the transport ready for the next command
+            for line in p.stdout:
+                pass
+            timer.stop(p.wait())
 
     retcode = p.wait()
+    timer.stop(retcode)
     if retcode != 0:
         logger.error("<-- Cmd %s returned %d (error)"%(command,retcode))
         raise subprocess.CalledProcessError(retcode, command)
@@ -126,12 +374,30 @@ def read_slurm_output(command):
         raise RuntimeError("Cmd %s didn't return any headers."%command)
 
     logger.debug("<-- Returned: %d (good)"%(retcode))
-    return results
+
+# Read CSV delimited input from Slurm
+def read_slurm_output(command, fields=None):
+    return list(iter_slurm_output(command, fields))
 
 # Get the user details from Slurm
+@slurm_cache.cached(lambda username: [ user_key(username) ])
 def get_slurm_user(username):
+    # commands waiting for the transaction to commit
+    pending = buffer.pending_action(get_commands(), user_key(username))
+    if pending == "add":
+        return { "User": username }
+    elif pending == "delete":
+        return None
+
+    database = get_database()
+    if database is not None:
+        results = database.get_named("User", [ username ])
+        if len(results) == 0:
+            return None
+        return results[0]
+
     cmd = [ "list", "user", "where", "name=%s"%username ]
-    results = read_slurm_output(cmd)
+    results = read_slurm_output(cmd, [ "User" ])
 
     if len(results) == 0:
         return None
@@ -148,9 +414,24 @@ def get_slurm_user(username):
     return the_result
 
 # Get the project details from Slurm
+@slurm_cache.cached(lambda projectname: [ account_key(projectname) ])
 def get_slurm_project(projectname):
+    # commands waiting for the transaction to commit
+    pending = buffer.pending_action(get_commands(), account_key(projectname))
+    if pending == "add":
+        return { "Account": projectname }
+    elif pending == "delete":
+        return None
+
+    database = get_database()
+    if database is not None:
+        results = database.get_named("Account", [ projectname ])
+        if len(results) == 0:
+            return None
+        return results[0]
+
     cmd = [ "list", "accounts", "where", "name=%s"%projectname ]
-    results = read_slurm_output(cmd)
+    results = read_slurm_output(cmd, [ "Account" ])
 
     if len(results) == 0:
         return None
@@ -166,26 +447,99 @@ def get_slurm_project(projectname):
 
     return the_result
 
+@slurm_cache.cached(lambda projectname: [ account_key(projectname) ])
 def get_slurm_users_in_project(projectname):
+    database = get_database()
+    if database is not None:
+        return database.get_users_of_account(projectname)
+
     cmd = [ "list", "assoc", "where", "account=%s"%projectname ]
-    results = read_slurm_output(cmd)
 
     user_list = []
-    for v in results:
+    for v in iter_slurm_output(cmd, [ "User" ]):
         if v["User"] != "":
             user_list.append(v["User"])
     return user_list
 
+@slurm_cache.cached(lambda username: [ user_key(username) ])
 def get_slurm_projects_in_user(username):
+    database = get_database()
+    if database is not None:
+        return database.get_accounts_of_user(username)
+
     cmd = [ "list", "assoc", "where", "user=%s"%username ]
-    results = read_slurm_output(cmd)
 
     project_list = []
-    for v in results:
+    for v in iter_slurm_output(cmd, [ "Account" ]):
         project_list.append(v["Account"])
     return project_list
 
+# Add every (username, projectname) association in pairs, in as few commands
+# as possible
+def add_associations(pairs):
+    call_many([ association_command("add", users, accounts)
+        for users, accounts in group_associations(pairs, slurm_batch_size) ])
+
+# Delete every (username, projectname) association in pairs, in as few
+# commands as possible
+def delete_associations(pairs):
+    call_many([ association_command("delete", users, accounts)
+        for users, accounts in group_associations(pairs, slurm_batch_size) ])
+
+# Split a list into lists of at most size items
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+def _get_slurm_many(names, lookup, key, entity, column):
+    found = {}
+    missing = []
+    for name in names:
+        # commands waiting for the transaction to commit
+        pending = buffer.pending_action(get_commands(), key(name))
+        if pending == "add":
+            found[name.lower()] = { column: name }
+            continue
+        elif pending == "delete":
+            continue
+
+        cached = slurm_cache.get((lookup, name))
+        if cached is not None:
+            if cached.value is not None:
+                found[name.lower()] = cached.value
+            continue
+        missing.append(name)
+
+    batches = list(chunks(missing, slurm_batch_size))
+    database = get_database()
+    if database is not None:
+        read = lambda chunk: database.get_named(column, chunk)
+    else:
+        read = lambda chunk: read_slurm_output([ "list", entity, "where",
+                "name=%s"%",".join(chunk) ], [ column ])
+    for chunk, results in zip(batches, slurm_executor.map(read, batches)):
+        for v in results:
+            found[v[column].lower()] = v
+        for name in chunk:
+            slurm_cache.put((lookup, name), found.get(name.lower()), set([ key(name) ]))
+
+    return found
+
+# Get the details of many users from Slurm, a batch at a time
+# Returns a dict of lower case username to details, for users that exist.
+def get_slurm_users(usernames):
+    return _get_slurm_many(usernames, "get_slurm_user", user_key, "user", "User")
+
+# Get the details of many projects from Slurm, a batch at a time
+# Returns a dict of lower case projectname to details, for projects that exist.
+def get_slurm_projects(projectnames):
+    return _get_slurm_many(projectnames, "get_slurm_project", account_key, "accounts", "Account")
+
 # Called when person is created/updated
+@slurm_queue.deferred(coalesce=True)
+@metrics.handler("slurm")
+@slurm_clusters.each
+@timeouts.deadline(slurm_deadline)
 def person_saved(sender, instance, created, **kwargs):
     logger.debug("person_saved '%s','%s'"%(instance.username,created))
 
@@ -199,39 +553,85 @@ def person_saved(sender, instance, created, **kwargs):
 
 signals.post_save.connect(person_saved, sender=people.models.Person)
 
+# Does a user exist, given the accounts Slurm has it in
+# Slurm users always have an association, so only users without any are
+# looked up.
+def slurm_user_exists(username, accounts):
+    if accounts and buffer.pending_action(get_commands(), user_key(username)) != "delete":
+        return True
+    return get_slurm_user(username) is not None
+
+# Get the lower case pids of the active Karaage projects among names
+def active_projects(names):
+    if not names:
+        return set()
+    q = Q()
+    for name in names:
+        q = q | Q(pid__iexact=name)
+    return set([ pid.lower() for pid in projects.models.Project.objects
+        .filter(q, is_active=True).values_list('pid', flat=True) ])
+
+# Get the name of the default Slurm account of an account
+def default_project_name(account):
+    if account.default_project is None:
+        return slurm_null_project
+    return account.default_project.pid
+
+# Values of an account that Slurm gets
+account_tracker = changes.Tracker(machines.models.UserAccount, {
+    "default_project": default_project_name,
+})
+
 # Called when account is created/updated
-def account_saved(sender, instance, created, **kwargs):
+@account_tracker.watch
+@slurm_queue.deferred(fields=["username"], coalesce=True)
+@metrics.handler("slurm")
+@slurm_clusters.each
+@timeouts.deadline(slurm_deadline)
+def account_saved(sender, instance, created, changed=None, **kwargs):
     username = instance.username
     logger.debug("account_saved '%s','%s'"%(username,created))
 
     # retrieve default project, or use null project if none
-    default_project_name = slurm_null_project
-    if instance.default_project is not None:
-        default_project_name = instance.default_project.pid
+    default_project = default_project_name(instance)
 
     # account created
     # account updated
 
-    slurm_user = get_slurm_user(username)
     if instance.date_deleted is None:
         # date_deleted is not set, user should exist
         logger.debug("account is active")
 
-        if slurm_user is None:
+        # what Slurm has now, in one read
+        current = set([ p.lower() for p in get_slurm_projects_in_user(username) ])
+        desired = set([ p.lower() for p in instance.user.project_set
+            .filter(is_active=True).values_list('pid', flat=True) ])
+        desired.add(default_project.lower())
+
+        slurm_user = slurm_user_exists(username, current)
+        if not slurm_user:
             # create user if doesn't exist
-            call(["add","user","accounts=%s"%default_project_name,"defaultaccount=%s"%default_project_name,"name=%s"%username])
-        else:
-            # or just set default project
-            call(["modify","user","set","defaultaccount=%s"%default_project_name,"where","name=%s"%username])
+            call(["add","user","accounts=%s"%default_project,"defaultaccount=%s"%default_project,"name=%s"%username])
+            current = set([ default_project.lower() ])
 
         # update user meta information
 
-        # add rest of projects user belongs to
-        for project in instance.user.project_set.all():
-            call(["add","user","name=%s"%username,"accounts=%s"%project.pid])
+        # add the projects user belongs to that Slurm doesn't have, before
+        # one becomes the default
+        add_associations([ (username, pid) for pid in sorted(desired - current) ])
+
+        if slurm_user and (changed is None or "default_project" in changed):
+            # set default project, if it changed
+            call(["modify","user","set","defaultaccount=%s"%default_project,"where","name=%s"%username])
+
+        # and remove the projects user left; accounts Karaage doesn't manage
+        # are left alone
+        delete_associations([ (username, pid)
+            for pid in sorted(active_projects(current - desired)) ])
     else:
         # date_deleted is not set, user should not exist
         logger.debug("account is not active")
+        slurm_user = get_slurm_user(username)
         if slurm_user is not None:
             # delete Slurm user if account marked as deleted
             call(["delete","user","name=%s"%username])
@@ -240,6 +640,10 @@ def account_saved(sender, instance, created, **kwargs):
     return
 
 # Called when account is deleted
+@slurm_queue.deferred(deleted=True, fields=["username"])
+@metrics.handler("slurm")
+@slurm_clusters.each
+@timeouts.deadline(slurm_deadline)
 def account_deleted(sender, instance, **kwargs):
     username = instance.username
     logger.debug("account_deleted '%s'"%(username))
@@ -257,8 +661,19 @@ def account_deleted(sender, instance, **kwargs):
 signals.post_save.connect(account_saved, sender=machines.models.UserAccount)
 signals.post_delete.connect(account_deleted, sender=machines.models.UserAccount)
 
+# Values of a project that Slurm gets
+project_tracker = changes.Tracker(projects.models.Project, {
+    "description": lambda project: filter_string(truncate(project.name, 40)),
+    "organization": lambda project: filter_string(project.institute.name),
+})
+
 # Called when project is saved/updated
-def project_saved(sender, instance, created, **kwargs):
+@project_tracker.watch
+@slurm_queue.deferred(fields=["pid"], coalesce=True)
+@metrics.handler("slurm")
+@slurm_clusters.each
+@timeouts.deadline(slurm_deadline)
+def project_saved(sender, instance, created, changed=None, **kwargs):
     pid = instance.pid
     logger.debug("project_saved '%s','%s'"%(instance,created))
 
@@ -271,11 +686,14 @@ def project_saved(sender, instance, created, **kwargs):
         slurm_project = get_slurm_project(pid)
         if slurm_project is None:
             call(["add","account","name=%s"%pid,"grpcpumins=0"])
-
-        # update project meta information
-        name = truncate(instance.name, 40)
-        call(["modify","account","set","Description=%s"%filter_string(name),"where","name=%s"%pid])
-        call(["modify","account","set","Organization=%s"%filter_string(instance.institute.name),"where","name=%s"%pid])
+            changed = None
+
+        # update project meta information that changed
+        values = project_tracker.values(instance)
+        if changed is None or "description" in changed:
+            call(["modify","account","set","Description=%s"%values["description"],"where","name=%s"%pid])
+        if changed is None or "organization" in changed:
+            call(["modify","account","set","Organization=%s"%values["organization"],"where","name=%s"%pid])
     else:
         # project is deleted
         logger.debug("project is not active")
@@ -287,6 +705,10 @@ def project_saved(sender, instance, created, **kwargs):
     return
 
 # Called when project is deleted
+@slurm_queue.deferred(deleted=True, fields=["pid"])
+@metrics.handler("slurm")
+@slurm_clusters.each
+@timeouts.deadline(slurm_deadline)
 def project_deleted(sender, instance, **kwargs):
     pid = instance.pid
     logger.debug("project_deleted '%s'"%(instance))
@@ -301,33 +723,41 @@ def project_deleted(sender, instance, **kwargs):
     return
 
 # Called when m2m changed between user and project
+@slurm_queue.deferred()
+@metrics.handler("slurm")
+@slurm_clusters.each
+@timeouts.deadline(slurm_deadline)
 def user_project_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
     logger.debug("user_project_changed '%s','%s','%s','%s','%s'"%(instance, action, reverse, model, pk_set))
 
     if action == "post_add":
+        pairs = []
         if reverse:
             username = instance.username
             # If Slurm user does not exist, there is nothing for us to do.
             # Slurm account may not be created yet or it may have been deleted.
             slurm_user = get_slurm_user(username)
             if slurm_user is not None:
-                username = slurm_user["Name"]
+                username = slurm_user["User"]
                 for project in model.objects.filter(pk__in=pk_set):
                     projectname = project.pid
                     logger.debug("add user '%s' to project '%s'"%(username,projectname))
-                    call(["add","user","accounts=%s"%projectname,"name=%s"%username])
+                    pairs.append((username, projectname))
         else:
             projectname = instance.pid
-            for user in model.objects.filter(pk__in=pk_set):
+            users = list(model.objects.filter(pk__in=pk_set))
+            slurm_users = get_slurm_users([ user.username for user in users ])
+            for user in users:
                 username = user.username
                 # If Slurm user does not exist, there is nothing for us to do.
                 # Slurm account may not be created yet or it may have been deleted.
-                slurm_user = get_slurm_user(username)
-                if slurm_user is not None:
+                if username.lower() in slurm_users:
                     logger.debug("add user '%s' to project '%s'"%(username,projectname))
-                    call(["add","user","accounts=%s"%projectname,"name=%s"%username])
+                    pairs.append((username, projectname))
+        add_associations(pairs)
 
     elif action == "post_remove":
+        pairs = []
         if reverse:
             username = instance.username
             # If Slurm user does not exist, there is nothing for us to do.
@@ -337,31 +767,35 @@ def user_project_changed(sender, instance, action, reverse, model, pk_set, **kwa
                 for project in model.objects.filter(pk__in=pk_set):
                     projectname = project.pid
                     logger.debug("delete user '%s' to project '%s'"%(username,projectname))
-                    call(["delete","user","name=%s"%username,"account=%s"%projectname])
+                    pairs.append((username, projectname))
         else:
             projectname = instance.pid
-            for user in model.objects.filter(pk__in=pk_set):
+            users = list(model.objects.filter(pk__in=pk_set))
+            slurm_users = get_slurm_users([ user.username for user in users ])
+            for user in users:
                 username = user.username
                 # If Slurm user does not exist, there is nothing for us to do.
                 # Slurm account may not be created yet or it may have been deleted.
-                slurm_user = get_slurm_user(username)
-                if slurm_user is not None:
+                if username.lower() in slurm_users:
                     logger.debug("delete user '%s' to project '%s'"%(username,projectname))
-                    call(["delete","user","name=%s"%username,"account=%s"%projectname])
+                    pairs.append((username, projectname))
+        delete_associations(pairs)
 
     elif action == "post_clear":
+        pairs = []
         if reverse:
             username = instance.username
             projects = get_slurm_projects_in_user(username)
             for projectname in projects:
                 logger.debug("remove user '%s' all projects - now processing project '%s'"%(username,projectname))
-                call(["delete","user","name=%s"%username,"account=%s"%projectname])
+                pairs.append((username, projectname))
         else:
             projectname = instance.pid
             users = get_slurm_users_in_project(projectname)
             for username in users:
                 logger.debug("remove project '%s' all users - now processing user '%s'"%(username, projectname))
-                call(["delete","user","name=%s"%username,"account=%s"%projectname])
+                pairs.append((username, projectname))
+        delete_associations(pairs)
 
     logger.debug("returning")
     return
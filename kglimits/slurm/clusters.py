@@ -0,0 +1,277 @@
+"""
+Several Slurm clusters managed by one Karaage.
+
+SLURM_CLUSTERS lists the clusters, each a dict with a name and the Slurm
+settings that differ for it, without their SLURM_ prefix. Settings a
+cluster doesn't give come from the SLURM_ settings:
+
+    SLURM_CLUSTERS = [
+        { "name": "alpha" },
+        { "name": "beta", "PREFIX": [ "ssh", "slurm@beta-head" ] },
+        { "name": "gamma", "REST_URL": "https://gamma-rest:6820",
+          "REST_CLUSTER": "gamma" },
+    ]
+
+Settings naming something that holds one cluster's state can't fall back
+like that: each cluster needs its own BROKER, as a broker runs commands for
+one cluster, and clusters sharing USAGE keep their usage apart in it.
+
+Each cluster has its own transports, database, circuit breaker, cached
+lookups and command buffer, and its commands are recorded in the metrics
+under backend "slurm:<name>". Without SLURM_CLUSTERS there is one cluster,
+with no name, recorded as "slurm".
+
+Signal handlers run once for every cluster, each cluster in its own thread
+with its own deadline and its own transaction, so its commands are buffered
+and coalesced and run when the handler is done. They return when all of
+the clusters are done. A cluster that fails doesn't stop the others, and
+its failure is raised afterwards as part of ClusterErrors. Inside a
+transaction the threads wait for it to commit, so they see what it
+changed, and a rollback leaves every cluster alone; failures are then
+logged and counted in the metrics, as raising them would stop the rest of
+the transaction's on_commit hooks. Plans run the handlers for one cluster
+after another, in the calling thread.
+"""
+import sys
+import time
+import threading
+
+from django.db import connection, transaction
+
+from kglimits import buffer
+from kglimits import metrics
+from kglimits import timeouts
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class ClusterErrors(Exception):
+    """ Something failed on one or more clusters. """
+
+    def __init__(self, errors):
+        Exception.__init__(self, errors)
+        # cluster name -> exception
+        self.errors = errors
+
+    def __str__(self):
+        return "%d clusters failed: %s" % (len(self.errors),
+            "; ".join([ "%s: %s" % (name, e)
+                for name, e in sorted(self.errors.items()) ]))
+
+
+class Cluster(object):
+
+    def __init__(self, name, options, defaults):
+        self.name = name
+        self.options = options
+        self.defaults = defaults
+        if name is None:
+            self.backend = "slurm"
+        else:
+            self.backend = "slurm:%s" % name
+        # made when first needed, by kglimits.slurm
+        self.transport = None
+        self.sacct_transport = None
+        self.database = None
+        self.commands = None
+        self.breaker = timeouts.CircuitBreaker(self.backend,
+            self.setting("BREAKER_THRESHOLD"), self.setting("BREAKER_COOLDOWN"))
+
+    def __repr__(self):
+        return "<Cluster %s>" % self.backend
+
+    def setting(self, key):
+        """ The cluster's value of SLURM_<key>. """
+        if key in self.options:
+            return self.options[key]
+        return getattr(self.defaults, "SLURM_%s" % key)
+
+    def bind(self, func):
+        """ func, run with this as the current cluster. """
+        def bound(*args, **kwargs):
+            previous = current_cluster()
+            set_cluster(self)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                set_cluster(previous)
+        return bound
+
+
+def current_cluster():
+    """ The cluster commands of this thread are for, if one is chosen. """
+    return getattr(_local, "cluster", None)
+
+
+def set_cluster(cluster):
+    _local.cluster = cluster
+
+
+def context():
+    """ For executors: makes their workers act for the caller's cluster. """
+    cluster = current_cluster()
+    return lambda: set_cluster(cluster)
+
+
+class Outcome(object):
+    """ What running something on one cluster came to. """
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.result = None
+        self.error = None
+        self.seconds = 0.0
+
+
+class Clusters(object):
+
+    def __init__(self, clusters, defaults):
+        if clusters is None:
+            self.clusters = [ Cluster(None, {}, defaults) ]
+        else:
+            self.clusters = [ Cluster(c["name"],
+                dict([ (k, v) for k, v in c.items() if k != "name" ]),
+                defaults) for c in clusters ]
+        names = [ c.name for c in self.clusters ]
+        if not names or len(set(names)) != len(names):
+            raise RuntimeError("SLURM_CLUSTERS needs clusters with different names")
+        brokers = [ c.setting("BROKER") for c in self.clusters
+            if c.setting("BROKER") is not None ]
+        if len(set(brokers)) != len(brokers):
+            raise RuntimeError("SLURM_CLUSTERS needs a different BROKER for each cluster")
+
+    def get(self, name=None):
+        """ The cluster called name, or the only one if name is None. """
+        if name is None:
+            if len(self.clusters) > 1:
+                raise RuntimeError("There are %d Slurm clusters, choose one of %s"
+                    % (len(self.clusters), ", ".join(self.names())))
+            return self.clusters[0]
+        for cluster in self.clusters:
+            if cluster.name == name:
+                return cluster
+        raise RuntimeError("Slurm cluster %s is not in SLURM_CLUSTERS" % name)
+
+    def names(self):
+        return [ c.name for c in self.clusters if c.name is not None ]
+
+    def current(self):
+        """ The cluster commands of this thread are for. """
+        cluster = current_cluster()
+        if cluster is None:
+            cluster = self.get()
+        return cluster
+
+    def run(self, cluster, func, *args, **kwargs):
+        """ Call func for cluster, returning an Outcome. """
+        outcome = Outcome(cluster)
+        start = time.time()
+        try:
+            outcome.result = cluster.bind(func)(*args, **kwargs)
+        except Exception, e:
+            outcome.error = sys.exc_info()
+            logger.error("%s failed on %s after %.2fs: %s"
+                % (getattr(func, "__name__", func), cluster.backend,
+                time.time() - start, e))
+        outcome.seconds = time.time() - start
+        logger.debug("%s on %s took %.2fs" % (getattr(func, "__name__", func),
+            cluster.backend, outcome.seconds))
+        return outcome
+
+    def map(self, func, *args, **kwargs):
+        """
+        Call func for every cluster at the same time, each in its own thread.
+        Returns an Outcome for each cluster, in the order of SLURM_CLUSTERS.
+        """
+        if len(self.clusters) == 1:
+            return [ self.run(self.clusters[0], func, *args, **kwargs) ]
+
+        outcomes = [ None ] * len(self.clusters)
+        # threads act for the calling thread
+        handler = metrics.current_handler()
+        deadline = timeouts.current_deadline()
+
+        def work(i, cluster):
+            metrics.set_handler(handler)
+            timeouts.set_deadline(deadline)
+            try:
+                outcomes[i] = self.run(cluster, func, *args, **kwargs)
+            finally:
+                # threads each get their own database connection
+                connection.close()
+
+        threads = []
+        for i, cluster in enumerate(self.clusters):
+            thread = threading.Thread(target=work, args=(i, cluster))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    def each(self, func):
+        """
+        Decorator for signal handlers, running them for every cluster.
+        Raises ClusterErrors if any cluster failed.
+        """
+        def handler(*args, **kwargs):
+            if len(self.clusters) == 1 or current_cluster() is not None:
+                return self.current().bind(func)(*args, **kwargs)
+
+            if buffer.planning():
+                # plans record the commands of this thread
+                outcomes = [ self.run(cluster, func, *args, **kwargs)
+                    for cluster in self.clusters ]
+                self.check(outcomes)
+                return
+
+            name = metrics.current_handler()
+
+            def in_transaction(*args, **kwargs):
+                # the threads are outside the caller's transaction, and
+                # without one of their own nothing would be buffered
+                with transaction.atomic():
+                    return func(*args, **kwargs)
+            in_transaction.__name__ = func.__name__
+
+            def fan_out():
+                previous = metrics.current_handler()
+                metrics.set_handler(name)
+                try:
+                    self.check(self.map(in_transaction, *args, **kwargs))
+                finally:
+                    metrics.set_handler(previous)
+
+            if not transaction.get_connection().in_atomic_block:
+                return fan_out()
+
+            def after_commit():
+                try:
+                    fan_out()
+                except ClusterErrors, e:
+                    # raising would stop the on_commit hooks after this one
+                    logger.error("%s failed after commit: %s"
+                        % (func.__name__, e))
+                    for cluster_name in e.errors:
+                        metrics.failed(self.get(cluster_name).backend,
+                            func.__name__)
+            transaction.on_commit(after_commit)
+        handler.__name__ = func.__name__
+        handler.__doc__ = func.__doc__
+        return handler
+
+    def check(self, outcomes):
+        """ Raise the failures of outcomes, if any. """
+        failed = [ o for o in outcomes if o.error is not None ]
+        if not failed:
+            return
+        if len(self.clusters) == 1:
+            error = failed[0].error
+            raise error[0], error[1], error[2]
+        raise ClusterErrors(dict([ (o.cluster.name, o.error[1])
+            for o in failed ]))
@@ -0,0 +1,225 @@
+"""
+Understanding sacctmgr commands as operations on accounts, users and
+associations, so they can be buffered and coalesced.
+"""
+from kglimits.buffer import Operation
+
+
+def _values(args):
+    """ Lower case keys of key=value arguments. """
+    result = {}
+    for arg in args:
+        if "=" in arg:
+            key, value = arg.split("=", 1)
+            result[key.lower()] = value
+    return result
+
+
+def user_key(name):
+    return ("user", name.lower())
+
+
+def account_key(name):
+    return ("account", name.lower())
+
+
+def association_key(user, account):
+    return ("association", user.lower(), account.lower())
+
+
+def association_command(verb, users, accounts):
+    """ Command to add or delete associations of every user with every account. """
+    if verb == "add":
+        return [ "add", "user", "name=%s" % ",".join(users),
+                "accounts=%s" % ",".join(accounts) ]
+    return [ "delete", "user", "where", "name=%s" % ",".join(users),
+            "account=%s" % ",".join(accounts) ]
+
+
+def group_associations(pairs, size):
+    """
+    Group (user, account) pairs into as few (users, accounts) products as
+    possible, with at most size names in each list.
+    """
+    by_user = {}
+    for user, account in pairs:
+        by_user.setdefault(user, set()).add(account)
+    by_accounts = {}
+    for user, accounts in by_user.items():
+        by_accounts.setdefault(tuple(sorted(accounts)), []).append(user)
+
+    groups = []
+    for accounts, users in sorted(by_accounts.items()):
+        users.sort()
+        for i in range(0, len(users), size):
+            for j in range(0, len(accounts), size):
+                groups.append((users[i:i+size], list(accounts[j:j+size])))
+    return groups
+
+
+class SlurmCommands(object):
+
+    def __init__(self, execute, executor, name="slurm"):
+        self.execute = execute
+        self.executor = executor
+        self.name = name
+
+    def parse(self, command, ignore_errors=[]):
+        op = Operation(command, ignore_errors)
+        if len(command) < 3:
+            return op
+
+        verb = command[0].lower()
+        entity = command[1].lower()
+        if entity in ("accounts", "users"):
+            entity = entity[:-1]
+        if entity not in ("account", "user"):
+            return op
+
+        if verb == "modify":
+            if "where" not in command:
+                return op
+            where = command.index("where")
+            if command[2] != "set":
+                return op
+            conditions = _values(command[where+1:])
+            if conditions.keys() != [ "name" ] or "," in conditions["name"]:
+                return op
+            name = conditions["name"]
+            attributes = []
+            for arg in command[3:where]:
+                if "=" not in arg:
+                    return op
+                attributes.append((arg.split("=", 1)[0].lower(), [ arg ]))
+            if entity == "account":
+                key = account_key(name)
+            else:
+                key = user_key(name)
+            return Operation(command, ignore_errors, key=key, action="modify",
+                    prefix=command[:3], attributes=attributes,
+                    suffix=command[where:])
+
+        args = [ arg for arg in command[2:] if arg.lower() != "where" ]
+        values = _values(args)
+        if "name" not in values:
+            return op
+        name = values["name"]
+
+        # add user with a default account creates the user, without one it
+        # only adds associations
+        if entity == "user" and (verb == "add" and "defaultaccount" not in values
+                or verb == "delete" and "account" in values):
+            accounts = values.get("accounts", values.get("account", ""))
+            if sorted(values.keys()) not in ([ "accounts", "name" ],
+                    [ "account", "name" ]) or accounts == "":
+                return op
+            return self._associations(command, ignore_errors, verb,
+                    name.split(","), accounts.split(","))
+
+        if "," in name:
+            return op
+
+        if entity == "account":
+            if verb not in ("add", "delete"):
+                return op
+            if verb == "delete" and values.keys() != [ "name" ]:
+                return op
+            return Operation(command, ignore_errors,
+                    key=account_key(name), action=verb)
+
+        if verb == "add":
+            entities = set([ user_key(name) ])
+            for account in values.get("accounts", "").split(","):
+                if account != "":
+                    entities.add(account_key(account))
+            return Operation(command, ignore_errors, key=user_key(name),
+                    action="add", entities=entities)
+
+        if verb == "delete" and values.keys() == [ "name" ]:
+            return Operation(command, ignore_errors, key=user_key(name),
+                    action="delete")
+
+        return op
+
+    def _associations(self, command, ignore_errors, verb, users, accounts):
+        entities = set()
+        for user in users:
+            entities.add(user_key(user))
+        for account in accounts:
+            entities.add(account_key(account))
+
+        if len(users) == 1 and len(accounts) == 1:
+            return Operation(command, ignore_errors, action=verb,
+                    key=association_key(users[0], accounts[0]),
+                    entities=entities)
+
+        parts = []
+        for user in users:
+            for account in accounts:
+                parts.append(association_command(verb, [ user ], [ account ]))
+        return Operation(command, ignore_errors, entities=entities,
+                key=("associations", ",".join(users).lower(),
+                ",".join(accounts).lower()), parts=parts)
+
+    def associations(self, command):
+        """
+        The verb and set of (user, account) pairs of a command that adds or
+        deletes associations, or None.
+        """
+        op = self.parse(command)
+        if op.key is None:
+            return None
+        if op.key[0] == "association":
+            return op.action, set([ op.key[1:] ])
+        if op.key[0] == "associations":
+            return command[0].lower(), set([ self.parse(part).key[1:]
+                for part in op.parts ])
+        return None
+
+    def merge(self, commands, size):
+        """
+        Merge commands for a broker: repeats of the command before run once,
+        and consecutive association adds, or deletes, run as few commands as
+        possible. Returns (command, indices of the commands it stands for)
+        in order.
+        """
+        groups = []
+        verb = None
+        members = {}
+
+        def flush():
+            pairs = set()
+            for p in members.values():
+                pairs.update(p)
+            for users, accounts in group_associations(pairs, size):
+                covered = set([ (user, account)
+                    for user in users for account in accounts ])
+                groups.append((association_command(verb, users, accounts),
+                    sorted([ i for i, p in members.items() if p & covered ])))
+
+        for i, command in enumerate(commands):
+            associations = self.associations(command)
+            if associations is not None and associations[0] == verb:
+                members[i] = associations[1]
+                continue
+            flush()
+            verb = None
+            members = {}
+            if associations is not None:
+                verb = associations[0]
+                members[i] = associations[1]
+            elif groups and groups[-1][0] == command:
+                groups[-1][1].append(i)
+            else:
+                groups.append((command, [ i ]))
+        flush()
+        return groups
+
+    def owned(self, key, owner):
+        if key[0] != "association":
+            return False
+        if owner[0] == "user":
+            return key[1] == owner[1]
+        if owner[0] == "account":
+            return key[2] == owner[1]
+        return False
@@ -0,0 +1,206 @@
+"""
+Read only lookups straight from the slurmdbd accounting database.
+
+Lookups through sacctmgr wait on slurmdbd, which is slowest when it is busy
+recording finished jobs. With SLURM_DB set, get_slurm_user(),
+get_slurm_project(), get_slurm_users_in_project(),
+get_slurm_projects_in_user() and their batch versions read the user,
+account and association tables of the accounting database instead. Changes
+still go through sacctmgr.
+
+Queries are fixed statements with parameters, looking names up by the keys
+of the tables, over a small pool of read only connections shared
+between threads. Connections use autocommit so every query sees the latest
+changes. The DB-API module (MySQLdb by default) is only imported when the
+first connection is made.
+
+Associations are read from the association table of every cluster in the
+database, like sacctmgr does, unless SLURM_DB_CLUSTERS lists some.
+"""
+import os
+import re
+import atexit
+import threading
+import Queue
+
+from kglimits import rows
+from kglimits import metrics
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+CLUSTERS = "SELECT name FROM cluster_table WHERE deleted = 0 ORDER BY name"
+
+# Table of users and of accounts, by the column listings name them in
+TABLES = {
+    "User": "user_table",
+    "Account": "acct_table",
+}
+
+NAMED = "SELECT name FROM %s WHERE name IN (%s) AND deleted = 0"
+
+USERS_OF_ACCOUNT = "SELECT user FROM `%s_assoc_table` " \
+    "WHERE acct = %%s AND user != '' AND deleted = 0"
+
+ACCOUNTS_OF_USER = "SELECT acct FROM `%s_assoc_table` " \
+    "WHERE user = %%s AND deleted = 0"
+
+# Cluster names go in table names, so only plain ones are used
+CLUSTER_NAME = re.compile(r"^[A-Za-z0-9_]+$")
+
+
+class AccountingDatabase(object):
+    """ Up to size read only connections to the slurmdbd database. """
+
+    def __init__(self, module, parameters, clusters=None, size=2):
+        self.module = module
+        self.parameters = parameters
+        self.clusters = clusters
+        self.size = size
+        self._statements = {}
+        self._lock = threading.Lock()
+        self._reset()
+        atexit.register(self.close)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = Queue.Queue()
+        self._connections = []
+
+    def connect(self):
+        module = __import__(self.module, fromlist=[ "connect" ])
+        logger.debug("Connecting to the slurmdbd database")
+        connection = module.connect(**self.parameters)
+        cursor = connection.cursor()
+        try:
+            cursor.execute("SET SESSION TRANSACTION READ ONLY")
+            cursor.execute("SET SESSION autocommit = 1")
+        finally:
+            cursor.close()
+        return connection
+
+    def acquire(self):
+        self._lock.acquire()
+        try:
+            if self._pid != os.getpid():
+                # connections of our parent process are not ours to use
+                self._reset()
+            try:
+                return self._idle.get_nowait()
+            except Queue.Empty:
+                pass
+            if len(self._connections) < self.size:
+                connection = self.connect()
+                self._connections.append(connection)
+                return connection
+            idle = self._idle
+        finally:
+            self._lock.release()
+        return idle.get()
+
+    def release(self, connection):
+        self._idle.put(connection)
+
+    def discard(self, connection):
+        self._lock.acquire()
+        try:
+            if connection in self._connections:
+                self._connections.remove(connection)
+        finally:
+            self._lock.release()
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            if self._pid == os.getpid():
+                for connection in self._connections:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+            self._reset()
+        finally:
+            self._lock.release()
+
+    def query(self, statement, parameters):
+        """ The rows of one query, retried once if the connection was lost. """
+        logger.debug("Query %s %s" % (statement, parameters))
+        timer = metrics.Timer("slurmdbd", [ "select" ])
+        module = __import__(self.module, fromlist=[ "OperationalError" ])
+        for attempt in (1, 2):
+            connection = self.acquire()
+            try:
+                cursor = connection.cursor()
+                try:
+                    cursor.execute(statement, parameters)
+                    results = cursor.fetchall()
+                finally:
+                    cursor.close()
+            except (module.OperationalError, module.InterfaceError), e:
+                self.discard(connection)
+                if attempt == 1:
+                    logger.warning("slurmdbd database connection lost: %s" % e)
+                    continue
+                timer.stop(1)
+                raise
+            except:
+                self.release(connection)
+                timer.stop(1)
+                raise
+            self.release(connection)
+            timer.stop(0)
+            return results
+
+    def get_clusters(self):
+        if self.clusters is None:
+            self.clusters = [ name for (name,) in self.query(CLUSTERS, ()) ]
+        clusters = [ name for name in self.clusters if CLUSTER_NAME.match(name) ]
+        if len(clusters) != len(self.clusters):
+            logger.warning("Ignoring clusters %s"
+                % sorted(set(self.clusters) - set(clusters)))
+        return clusters
+
+    def statement(self, key, make):
+        """ The statement for key, made once. """
+        statement = self._statements.get(key)
+        if statement is None:
+            statement = self._statements[key] = make()
+        return statement
+
+    def _union(self, template):
+        return " UNION ".join([ template % cluster
+            for cluster in self.get_clusters() ]) + " ORDER BY 1"
+
+    def get_named(self, column, names):
+        """
+        Rows of the users or accounts (column "User" or "Account") with
+        names that exist, like a listing of them with format=column.
+        """
+        if not names:
+            return []
+        statement = self.statement((column, len(names)), lambda: NAMED
+            % (TABLES[column], ", ".join([ "%s" ] * len(names))))
+        row_type = rows.row_class([ column ])
+        return [ rows.make_row(row_type, [ name ]) for (name,)
+            in self.query(statement, [ name.lower() for name in names ]) ]
+
+    def get_users_of_account(self, account):
+        clusters = len(self.get_clusters())
+        if clusters == 0:
+            return []
+        statement = self.statement("users", lambda: self._union(USERS_OF_ACCOUNT))
+        return [ user for (user,)
+            in self.query(statement, [ account.lower() ] * clusters) ]
+
+    def get_accounts_of_user(self, username):
+        clusters = len(self.get_clusters())
+        if clusters == 0:
+            return []
+        statement = self.statement("accounts", lambda: self._union(ACCOUNTS_OF_USER))
+        return [ account for (account,)
+            in self.query(statement, [ username.lower() ] * clusters) ]
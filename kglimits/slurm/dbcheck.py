@@ -0,0 +1,72 @@
+"""
+Check that lookups read from the slurmdbd database give the same answers as
+sacctmgr.
+
+The whole Slurm state is read through sacctmgr once, as sync does, and the
+answer to every lookup for the users and projects given is compared with
+the answer from the database.
+"""
+from karaage.machines.models import UserAccount
+from karaage.projects.models import Project
+
+from kglimits.slurm import chunks, slurm_batch_size
+from kglimits.slurm.sync import get_slurm_state
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Get the usernames of Karaage's accounts and the pids of its projects
+def karaage_names():
+    usernames = UserAccount.objects.filter(date_deleted__isnull=True) \
+            .values_list('username', flat=True)
+    projectnames = Project.objects.values_list('pid', flat=True)
+    return sorted(set([ u.lower() for u in usernames ])), \
+            sorted(set([ p.lower() for p in projectnames ]))
+
+
+def _existing(database, column, names):
+    found = set()
+    for chunk in chunks(names, slurm_batch_size):
+        for v in database.get_named(column, chunk):
+            found.add(v[column].lower())
+    return found
+
+
+# Compare the database's answers for usernames and projectnames with
+# sacctmgr's
+# Returns a list of the differences.
+def check(database, usernames, projectnames):
+    usernames = [ name.lower() for name in usernames ]
+    projectnames = [ name.lower() for name in projectnames ]
+    state = get_slurm_state()
+    differences = []
+
+    def compare(description, database_answer, sacctmgr_answer):
+        if database_answer != sacctmgr_answer:
+            logger.error("%s: database %s, sacctmgr %s"
+                % (description, database_answer, sacctmgr_answer))
+            differences.append("%s: database %s, sacctmgr %s"
+                % (description, database_answer, sacctmgr_answer))
+
+    users = _existing(database, "User", usernames)
+    for name in usernames:
+        compare("user %s exists" % name, name in users, name in state.users)
+
+    accounts = _existing(database, "Account", projectnames)
+    for name in projectnames:
+        compare("account %s exists" % name, name in accounts,
+                name in state.accounts)
+
+    for name in usernames:
+        compare("accounts of user %s" % name,
+                sorted(set([ a.lower() for a in database.get_accounts_of_user(name) ])),
+                sorted([ a for u, a in state.associations if u == name ]))
+
+    for name in projectnames:
+        compare("users of account %s" % name,
+                sorted(set([ u.lower() for u in database.get_users_of_account(name) ])),
+                sorted([ u for u, a in state.associations if a == name ]))
+
+    return differences
@@ -0,0 +1,185 @@
+"""
+Provision Slurm in bulk with one sacctmgr load.
+
+Karaage's active projects and the associations of its accounts are written
+to a file in the sacctmgr dump format, straight from ORM iterators so a
+site of any size is written in constant memory, and applied with one
+"sacctmgr load". Loading adds what is missing and leaves everything else
+alone; use sync to also change or delete. The result is checked with one
+association listing afterwards.
+
+    Cluster - 'tango'
+    Parent - 'root'
+    Account - 'pmelb0001':Description='Project name':Organization='Uni'
+    Parent - 'pmelb0001'
+    User - 'alice':DefaultAccount='pmelb0001'
+"""
+import os
+import time
+import tempfile
+
+from django.db.models import Q, F, Value, CharField
+from django.db.models.functions import Lower
+from karaage.machines.models import UserAccount
+from karaage.projects.models import Project
+
+from kglimits.slurm import call, iter_slurm_output, filter_string, truncate
+from kglimits.slurm import slurm_null_project
+from kglimits.sync import SyncReport, apply_changes
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Quote a value for the flat file, which has no way to escape quotes
+# Raises ValueError for a value with a quote in it.
+def quote(value):
+    if "'" in value or '"' in value:
+        raise ValueError("A sacctmgr flat file can't hold the quote in %r"
+            % value)
+    return "'%s'" % value
+
+
+# Get (account, description, organization) for each active project
+def karaage_accounts():
+    for pid, name, institute in Project.objects.filter(is_active=True) \
+            .order_by('pid').values_list('pid', 'name', 'institute__name') \
+            .iterator():
+        yield (pid.lower(), filter_string(truncate(name, 40)),
+                filter_string(institute))
+
+
+# Get (account, user, default account) for every association Karaage wants,
+# grouped by account
+# The associations come from one query, ordered by the database, so the
+# rows of an account and the duplicates of an association are next to each
+# other in whatever order its collation puts them.
+def karaage_associations():
+    null_project = slurm_null_project.lower()
+
+    def default(pid, is_active):
+        # there is no account to be the default of an inactive project
+        if pid is None or not is_active:
+            return null_project
+        return pid.lower()
+
+    accounts = UserAccount.objects.filter(date_deleted__isnull=True)
+
+    def associations(queryset, account):
+        return queryset.annotate(association_account=account,
+                association_user=Lower('username'),
+                default_pid=F('default_project__pid'),
+                default_active=F('default_project__is_active')) \
+                .values_list('association_account', 'association_user',
+                'default_pid', 'default_active')
+
+    members = associations(accounts.filter(user__project__is_active=True),
+            Lower('user__project__pid'))
+    defaults = associations(accounts.filter(default_project__is_active=True),
+            Lower('default_project__pid'))
+    null_defaults = associations(accounts.filter(
+            Q(default_project__isnull=True)
+            | Q(default_project__is_active=False)),
+            Value(null_project, output_field=CharField()))
+
+    # one user may be both a member of and default to a project
+    last = None
+    for account, user, default_pid, default_active in members \
+            .union(defaults, null_defaults, all=True) \
+            .order_by('association_account', 'association_user') \
+            .iterator():
+        if (account, user) != last:
+            yield (account, user, default(default_pid, default_active))
+        last = (account, user)
+
+
+# Write the Karaage accounts and associations to f in the flat file format
+# Returns the number of accounts and of associations written.
+def write_flatfile(f, cluster):
+    f.write("Cluster - %s\n" % quote(cluster))
+    f.write("Parent - 'root'\n")
+
+    accounts = 0
+    null_project = slurm_null_project.lower()
+    f.write("Account - %s:Description=%s:Organization=%s\n"
+            % (quote(null_project), quote(null_project), quote("root")))
+    for account, description, organization in karaage_accounts():
+        if account == null_project:
+            continue
+        f.write("Account - %s:Description=%s:Organization=%s:GrpCPUMins=0\n"
+                % (quote(account), quote(description), quote(organization)))
+        accounts = accounts + 1
+
+    associations = 0
+    parent = None
+    for account, user, default in karaage_associations():
+        if account != parent:
+            f.write("Parent - %s\n" % quote(account))
+            parent = account
+        f.write("User - %s:DefaultAccount=%s\n" % (quote(user), quote(default)))
+        associations = associations + 1
+
+    return accounts, associations
+
+
+# Check the associations Karaage wants are in Slurm, with one listing
+# Returns a list of what is missing.
+def verify(cluster):
+    found = set()
+    for v in iter_slurm_output([ "list", "assoc", "cluster=%s" % cluster ],
+            [ "Account", "User" ]):
+        found.add((v["Account"].lower(), v["User"].lower()))
+
+    missing = []
+    for account, description, organization in karaage_accounts():
+        if (account, "") not in found:
+            missing.append("account %s" % account)
+    for account, user, default in karaage_associations():
+        if (account, user) not in found:
+            missing.append("user %s in account %s" % (user, account))
+    return missing
+
+
+# Load Karaage's accounts and associations into a cluster
+# The file is written to directory, or the system's temporary directory,
+# and removed afterwards unless keep is set or this is a dry run.
+def load(cluster, directory=None, keep=False, dry_run=False):
+    report = SyncReport()
+
+    start = time.time()
+    fd, path = tempfile.mkstemp(prefix="kglimits-", suffix=".cfg",
+            dir=directory)
+    f = os.fdopen(fd, "w")
+    try:
+        accounts, associations = write_flatfile(f, cluster)
+    except ValueError, e:
+        # nothing is loaded rather than a value changed
+        f.close()
+        os.unlink(path)
+        logger.error("load: %s" % e)
+        report.errors.append(("write", "%s" % e))
+        return report
+    finally:
+        if not f.closed:
+            f.close()
+    # sacctmgr may run as another user
+    os.chmod(path, 0644)
+    report.time("write %d accounts, %d associations" % (accounts, associations), start)
+
+    try:
+        apply_changes([ ("load %s into %s" % (path, cluster),
+                [ "load", "file=%s" % path ]) ],
+                call, report, dry_run=dry_run)
+
+        if not dry_run and not report.errors:
+            start = time.time()
+            for description in verify(cluster):
+                logger.error("load: %s is missing" % description)
+                report.errors.append(("verify", "%s is missing" % description))
+            report.time("verify", start)
+    finally:
+        if not keep and not dry_run:
+            os.unlink(path)
+
+    return report
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from kglimits import broker
+from kglimits.slurm import make_transport, make_sacct_transport, get_commands
+from kglimits.slurm import slurm_clusters, slurm_batch_size
+
+
+class Command(BaseCommand):
+    help = "Run sacctmgr and sacct commands for the Karaage processes on this host"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket',
+            help="Unix socket to listen on, SLURM_BROKER by default")
+        parser.add_argument('--mode', default="0660",
+            help="Permissions of the socket, in octal")
+        parser.add_argument('--window', type=float, default=0.005,
+            help="Seconds to wait for more commands to run with the first")
+        parser.add_argument('--keep-prefix', action='store_true', default=False,
+            help="Run commands with SLURM_PREFIX, if not run as the slurm user")
+        parser.add_argument('--cluster',
+            help="Cluster of SLURM_CLUSTERS to run commands for, if there are several")
+
+    def handle(self, *args, **options):
+        try:
+            cluster = slurm_clusters.get(options['cluster'])
+        except RuntimeError, e:
+            raise CommandError("%s" % e)
+        cluster.bind(self.serve)(**options)
+
+    def serve(self, **options):
+        cluster = slurm_clusters.current()
+        socket = options['socket']
+        if socket is None:
+            socket = cluster.setting("BROKER")
+        if socket is None:
+            raise CommandError("SLURM_BROKER is not set")
+
+        prefix = []
+        if options['keep_prefix']:
+            prefix = cluster.setting("PREFIX")
+        sacctmgr = make_transport(prefix)
+        sacct = make_sacct_transport(prefix)
+
+        def transport_for(args):
+            if args and args[0] == "sacct":
+                return sacct
+            return sacctmgr
+
+        commands = get_commands()
+        merge = lambda batch: commands.merge(batch, slurm_batch_size)
+        broker.serve(socket,
+                broker.Broker(transport_for, merge, options['window']),
+                int(options['mode'], 8))
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from kglimits.slurm import get_database, slurm_clusters
+from kglimits.slurm import dbcheck
+
+
+class Command(BaseCommand):
+    help = "Compare lookups from the slurmdbd database with sacctmgr"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users',
+            help="Comma separated usernames to check, instead of every account in Karaage")
+        parser.add_argument('--projects',
+            help="Comma separated projects to check, instead of every project in Karaage")
+        parser.add_argument('--cluster',
+            help="Cluster of SLURM_CLUSTERS to check, if there are several")
+
+    def handle(self, *args, **options):
+        try:
+            cluster = slurm_clusters.get(options['cluster'])
+        except RuntimeError, e:
+            raise CommandError("%s" % e)
+        cluster.bind(self.check)(**options)
+
+    def check(self, **options):
+        database = get_database()
+        if database is None:
+            raise CommandError("SLURM_DB is not set")
+
+        usernames, projectnames = dbcheck.karaage_names()
+        if options['users'] is not None:
+            usernames = [ u for u in options['users'].split(",") if u != "" ]
+        if options['projects'] is not None:
+            projectnames = [ p for p in options['projects'].split(",") if p != "" ]
+
+        differences = dbcheck.check(database, usernames, projectnames)
+        for difference in differences:
+            self.stdout.write("%s\n" % difference)
+        self.stdout.write("%d users and %d projects checked, %d differences\n"
+                % (len(usernames), len(projectnames), len(differences)))
+        if differences:
+            raise CommandError("The slurmdbd database and sacctmgr differ")
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from kglimits.slurm import flatfile, slurm_clusters
+
+
+class Command(BaseCommand):
+    help = "Add every Karaage account, user and association to a Slurm cluster with one sacctmgr load"
+
+    def add_arguments(self, parser):
+        parser.add_argument('cluster',
+            help="Slurm cluster to load into, one of SLURM_CLUSTERS if set")
+        parser.add_argument('--directory',
+            help="Directory to write the flat file in, readable by sacctmgr")
+        parser.add_argument('--keep', action='store_true', default=False,
+            help="Keep the flat file after loading it")
+        parser.add_argument('--dry-run', action='store_true', default=False,
+            help="Write and keep the flat file without loading it")
+
+    def handle(self, *args, **options):
+        try:
+            if slurm_clusters.names():
+                target = slurm_clusters.get(options['cluster'])
+            else:
+                target = slurm_clusters.get()
+        except RuntimeError, e:
+            raise CommandError("%s" % e)
+        report = target.bind(flatfile.load)(options['cluster'],
+                directory=options['directory'], keep=options['keep'],
+                dry_run=options['dry_run'])
+        self.stdout.write("%s\n" % report)
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from kglimits.slurm import slurm_queue
+
+
+class Command(BaseCommand):
+    help = "Replay Slurm signals queued by Karaage"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', default=False,
+            help="Stop when no queued signals are due")
+        parser.add_argument('--stats', action='store_true', default=False,
+            help="Show the depth and lag of the queue and stop")
+        parser.add_argument('--batch-size', type=int, default=100,
+            help="Number of signals to read from the queue at a time")
+
+    def handle(self, *args, **options):
+        if slurm_queue.path is None:
+            raise CommandError("SLURM_QUEUE is not set")
+
+        if options['stats']:
+            stats = slurm_queue.stats()
+            for key in sorted(stats.keys()):
+                self.stdout.write("%s %s\n" % (key, stats[key]))
+            return
+
+        slurm_queue.run(once=options['once'], batch_size=options['batch_size'])
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from kglimits.slurm import sync
+from kglimits.slurm import slurm_clusters
+
+
+class Command(BaseCommand):
+    help = "Bring Slurm accounts, users and associations into line with Karaage"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', default=False,
+            help="Show the changes without making them")
+        parser.add_argument('--delete-unmanaged', action='store_true',
+            default=False,
+            help="Also delete accounts and users that Karaage doesn't know about")
+        parser.add_argument('--cluster',
+            help="Only sync this cluster of SLURM_CLUSTERS, instead of all of them")
+
+    def handle(self, *args, **options):
+        kwargs = { "dry_run": options['dry_run'],
+                "delete_unmanaged": options['delete_unmanaged'] }
+
+        if options['cluster'] is not None:
+            try:
+                cluster = slurm_clusters.get(options['cluster'])
+            except RuntimeError, e:
+                raise CommandError("%s" % e)
+            report = cluster.bind(sync.sync)(**kwargs)
+            self.stdout.write("%s\n" % report)
+            return
+
+        # every cluster wants the same from Karaage, so read it once
+        kwargs["karaage"] = sync.get_karaage_state()
+        outcomes = slurm_clusters.map(sync.sync, **kwargs)
+        failed = []
+        for outcome in outcomes:
+            if outcome.cluster.name is not None:
+                self.stdout.write("== %s (%.2fs)\n"
+                        % (outcome.cluster.name, outcome.seconds))
+            if outcome.error is not None:
+                self.stdout.write("FAILED %s\n" % outcome.error[1])
+                failed.append(outcome.cluster.backend)
+            else:
+                self.stdout.write("%s\n" % outcome.result)
+        if failed:
+            raise CommandError("Sync failed on %s" % ", ".join(failed))
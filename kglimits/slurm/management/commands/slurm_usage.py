@@ -0,0 +1,38 @@
+import time
+import calendar
+
+from django.core.management.base import BaseCommand, CommandError
+
+from kglimits.slurm import usage, slurm_clusters
+
+
+class Command(BaseCommand):
+    help = "Import the CPU usage of Slurm jobs that ended since the last import"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since',
+            help="UTC date to start from, as YYYY-MM-DD, if nothing has been imported yet")
+        parser.add_argument('--cluster',
+            help="Cluster of SLURM_CLUSTERS to import from, if there are several")
+
+    def handle(self, *args, **options):
+        try:
+            cluster = slurm_clusters.get(options['cluster'])
+        except RuntimeError, e:
+            raise CommandError("%s" % e)
+        cluster.bind(self.import_usage)(**options)
+
+    def import_usage(self, **options):
+        store = usage.get_usage_store()
+        if store is None:
+            raise CommandError("SLURM_USAGE is not set")
+
+        since = None
+        if options['since'] is not None:
+            try:
+                since = calendar.timegm(time.strptime(options['since'], "%Y-%m-%d"))
+            except ValueError:
+                raise CommandError("--since must be YYYY-MM-DD")
+
+        windows, jobs = usage.import_usage(store, since=since)
+        self.stdout.write("%d jobs imported in %d windows\n" % (jobs, windows))
@@ -0,0 +1,548 @@
+"""
+Transport for running sacctmgr commands through slurmrestd.
+
+Instead of starting sudo sacctmgr, RestTransport turns each command kglimits
+gives sacctmgr into requests to the slurmdbd part of the slurmrestd REST
+API, and turns the answers back into sacctmgr's parsable output, so they
+are read the same way as before. Requests go over a small pool of
+persistent HTTP/1.1 connections shared between threads. Changes to many
+associations at once are sent as one request:
+
+    list accounts where name=a              GET /account/a
+    list users where name=u,v               GET /user/u, GET /user/v
+    list assoc where account=a              GET /associations?account=a
+    add account name=a grpcpumins=0         POST /accounts, POST /associations
+    add user name=u defaultaccount=a ...    POST /users, POST /associations
+    add user name=u,v accounts=a,b          POST /associations
+    modify user set ... where name=u        GET /user/u, POST /users
+    delete user where name=u,v account=a,b  DELETE /associations?...
+    delete account name=a                   DELETE /account/a
+    load file=...                           GET and POST /accounts, /users
+                                            and /associations
+
+Commands it can't do, and errors slurmrestd reports, return 1 like a failed
+sacctmgr command. sacct commands still run sacct.
+"""
+import os
+import re
+import time
+import json
+import socket
+import atexit
+import urllib
+import httplib
+import urlparse
+import threading
+import Queue
+
+from kglimits.timeouts import CommandTimeout
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Up to this many accounts or users are fetched one by one, more by listing
+# all of them
+NAMED_LIMIT = 20
+
+
+class RestError(Exception):
+    """ slurmrestd reported an error, or couldn't be asked. """
+    pass
+
+
+class NotFound(RestError):
+    pass
+
+
+class ConnectionPool(object):
+    """ Up to size persistent HTTP connections to url, shared between threads. """
+
+    def __init__(self, url, size, headers={}):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme == "https":
+            self.connection_class = httplib.HTTPSConnection
+        elif parts.scheme == "http":
+            self.connection_class = httplib.HTTPConnection
+        else:
+            raise ValueError("Unsupported slurmrestd URL %s" % url)
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path.rstrip("/")
+        self.size = size
+        self.headers = headers
+        self._lock = threading.Lock()
+        self._reset()
+        atexit.register(self.close)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = Queue.Queue()
+        self._connections = []
+
+    def acquire(self, timeout=None):
+        """
+        A connection, waiting at most timeout seconds for one to be free.
+        Raises socket.timeout if none is.
+        """
+        self._lock.acquire()
+        try:
+            if self._pid != os.getpid():
+                # connections of our parent process are not ours to use
+                self._reset()
+            try:
+                return self._idle.get_nowait()
+            except Queue.Empty:
+                pass
+            if len(self._connections) < self.size:
+                connection = self.connection_class(self.host, self.port)
+                self._connections.append(connection)
+                return connection
+            idle = self._idle
+        finally:
+            self._lock.release()
+        if timeout is None:
+            return idle.get()
+        try:
+            return idle.get(True, timeout)
+        except Queue.Empty:
+            raise socket.timeout("no free connection to %s" % self.host)
+
+    def release(self, connection):
+        self._idle.put(connection)
+
+    def request(self, method, path, body=None, timeout=None):
+        """
+        Make one request, returning the status and body of the response.
+        Raises socket.timeout if there is no answer within timeout seconds.
+        """
+        for attempt in (1, 2):
+            connection = self.acquire(timeout)
+            reused = connection.sock is not None
+            try:
+                # a closed connection opens again on the next request
+                connection.timeout = timeout
+                if connection.sock is not None:
+                    connection.sock.settimeout(timeout)
+                try:
+                    connection.request(method, self.path + path, body,
+                        self.headers)
+                    response = connection.getresponse()
+                    return response.status, response.read()
+                except socket.timeout:
+                    connection.close()
+                    raise
+                except (httplib.HTTPException, socket.error), e:
+                    connection.close()
+                    # the server closed a kept alive connection, so never
+                    # saw the request
+                    if reused and attempt == 1:
+                        logger.debug("%s %s on a closed connection: %s"
+                            % (method, path, e))
+                        continue
+                    raise RestError("%s %s failed: %s" % (method, path, e))
+            finally:
+                self.release(connection)
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            if self._pid == os.getpid():
+                for connection in self._connections:
+                    connection.close()
+            self._reset()
+        finally:
+            self._lock.release()
+
+
+ENTITIES = {
+    "account": "account", "accounts": "account",
+    "user": "user", "users": "user",
+    "assoc": "association", "association": "association",
+    "associations": "association",
+}
+
+# Columns of listings without format=
+FORMATS = {
+    "account": [ "Account", "Description", "Organization" ],
+    "user": [ "User", "DefaultAccount", "Admin" ],
+    "association": [ "Cluster", "Account", "User" ],
+}
+
+# Headers sacctmgr prints for columns, where they differ
+HEADERS = {
+    "defaultaccount": "Def Acct",
+    "description": "Descr",
+    "organization": "Org",
+}
+
+# A flat file line: Kind - 'name':Key='value':...
+LINE = re.compile(r"^(\w+) - '([^']*)'(.*)$")
+OPTION = re.compile(r":(\w+)='([^']*)'")
+
+
+def _split(words):
+    """ Lower case keys of key=value words, as (values, conditions) around where. """
+    values = {}
+    conditions = {}
+    target = values
+    for word in words:
+        lower = word.lower()
+        if lower == "set":
+            target = values
+        elif lower == "where":
+            target = conditions
+        elif "=" in word:
+            key, value = word.split("=", 1)
+            target[key.lower()] = value
+    return values, conditions
+
+
+def _names(value):
+    return [ name.lower() for name in value.split(",") if name != "" ]
+
+
+def _account_row(account):
+    return {
+        "account": account.get("name", ""),
+        "description": account.get("description", ""),
+        "organization": account.get("organization", ""),
+    }
+
+
+def _user_row(user):
+    return {
+        "user": user.get("name", ""),
+        "defaultaccount": (user.get("default") or {}).get("account", ""),
+        "admin": ",".join(user.get("administrator_level") or [ "None" ]),
+    }
+
+
+def _association_row(association):
+    return {
+        "cluster": association.get("cluster", ""),
+        "account": association.get("account", ""),
+        "user": association.get("user") or "",
+    }
+
+
+def _format(fields, rows):
+    """ Lines of sacctmgr's parsable output of rows, for fields. """
+    lines = [ "".join([ "%s|" % HEADERS.get(field.lower(), field)
+        for field in fields ]) ]
+    for row in rows:
+        lines.append("".join([ "%s|" % row.get(field.lower(), "")
+            for field in fields ]))
+    return lines
+
+
+class RestTransport(object):
+    """ Run sacctmgr commands as requests to slurmrestd. """
+
+    def __init__(self, url, cluster, user=None, token=None,
+            version="v0.0.39", connections=4):
+        headers = {
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+        }
+        if user is not None:
+            headers["X-SLURM-USER-NAME"] = user
+        if token is not None:
+            headers["X-SLURM-USER-TOKEN"] = token
+        self.pool = ConnectionPool(url, connections, headers)
+        self.prefix = "/slurmdb/%s" % version
+        self.cluster = cluster
+
+    def popen(self, args, timeout=None):
+        return RestProcess(self, args, timeout)
+
+    def close(self):
+        self.pool.close()
+
+    def request(self, method, path, body=None, query=None, deadline=None):
+        """ Decoded answer of one request, made before deadline. """
+        path = self.prefix + path
+        if query:
+            path = "%s?%s" % (path, urllib.urlencode(sorted(query.items())))
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                raise socket.timeout("timed out")
+        if body is not None:
+            body = json.dumps(body)
+        logger.debug("--> %s %s" % (method, path))
+
+        status, data = self.pool.request(method, path, body, timeout)
+        try:
+            data = json.loads(data or "{}")
+        except ValueError:
+            raise RestError("%s %s returned %d and not JSON"
+                % (method, path, status))
+        errors = [ e.get("description") or e.get("error") or "%s" % e
+            for e in data.get("errors") or [] ]
+        if status == 404:
+            raise NotFound("%s %s: %s" % (method, path, "; ".join(errors)))
+        if status >= 300 or errors:
+            raise RestError("%s %s returned %d: %s"
+                % (method, path, status, "; ".join(errors)))
+        logger.debug("<-- %d" % status)
+        return data
+
+    def run(self, args, deadline=None):
+        """ Run one sacctmgr command, returning its output lines. """
+        if len(args) < 2:
+            raise RestError("Unknown command %s" % args)
+        verb = args[0].lower()
+        if verb == "load":
+            values, conditions = _split(args[1:])
+            self.load(values["file"], deadline)
+            return []
+        entity = ENTITIES.get(args[1].lower())
+        values, conditions = _split(args[2:])
+        if verb == "list" and entity is not None:
+            # a listing's conditions may come without "where"
+            conditions.update(values)
+            return self.list(entity, conditions, deadline)
+        method = getattr(self, "%s_%s" % (verb, entity), None)
+        if method is None:
+            raise RestError("slurmrestd can't run %s" % " ".join(args))
+        method(values, conditions, deadline)
+        return []
+
+    def get_named(self, kind, names, deadline):
+        """ Accounts or users with names, or all of them. """
+        if names and len(names) <= NAMED_LIMIT:
+            # slurmrestd can't filter the listing by name
+            found = []
+            for name in names:
+                try:
+                    found.extend(self.request("GET", "/%s/%s" % (kind,
+                        urllib.quote(name, "")),
+                        deadline=deadline).get(kind + "s", []))
+                except NotFound:
+                    pass
+            return found
+        found = self.request("GET", "/%ss" % kind,
+            deadline=deadline).get(kind + "s", [])
+        if names:
+            found = [ f for f in found if f.get("name", "").lower() in names ]
+        return found
+
+    def get_associations(self, conditions, deadline):
+        query = { "cluster": conditions.get("cluster", self.cluster) }
+        for key in ("account", "user"):
+            if key in conditions:
+                query[key] = ",".join(_names(conditions[key]))
+        return self.request("GET", "/associations", query=query,
+            deadline=deadline).get("associations", [])
+
+    def list(self, entity, conditions, deadline):
+        fields = FORMATS[entity]
+        if "format" in conditions:
+            fields = conditions["format"].split(",")
+        names = _names(conditions.get("name", ""))
+        if entity == "account":
+            rows = [ _account_row(a)
+                for a in self.get_named("account", names, deadline) ]
+        elif entity == "user":
+            rows = [ _user_row(u)
+                for u in self.get_named("user", names, deadline) ]
+        else:
+            rows = [ _association_row(a)
+                for a in self.get_associations(conditions, deadline) ]
+        return _format(fields, rows)
+
+    def association(self, account, user=None, values={}, cluster=None):
+        """ An association, with the limits of values. """
+        association = {
+            "account": account,
+            "cluster": cluster or self.cluster,
+        }
+        if user is not None:
+            association["user"] = user
+        if "grpcpumins" in values:
+            association["max"] = { "tres": { "group": { "minutes": [
+                { "type": "cpu", "count": int(values["grpcpumins"]) } ] } } }
+        return association
+
+    def add_account(self, values, conditions, deadline):
+        accounts = _names(values.get("name", ""))
+        self.request("POST", "/accounts", { "accounts": [ {
+            "name": name,
+            "description": values.get("description", name),
+            "organization": values.get("organization", "root"),
+            } for name in accounts ] }, deadline=deadline)
+        self.request("POST", "/associations", { "associations": [
+            self.association(name, values=values) for name in accounts ] },
+            deadline=deadline)
+
+    def add_user(self, values, conditions, deadline):
+        users = _names(values.get("name", ""))
+        accounts = _names(values.get("accounts", values.get("account", "")))
+        default = values.get("defaultaccount")
+        if default is None and not accounts:
+            raise RestError("Need a default account for %s" % ",".join(users))
+        if default is not None:
+            self.request("POST", "/users", { "users": [ {
+                "name": user,
+                "default": { "account": default.lower() },
+                } for user in users ] }, deadline=deadline)
+        if accounts:
+            self.request("POST", "/associations", { "associations": [
+                self.association(account, user)
+                for user in users for account in accounts ] },
+                deadline=deadline)
+
+    def modify_account(self, values, conditions, deadline):
+        for key in values:
+            if key not in ("description", "organization"):
+                raise RestError("slurmrestd can't set %s of accounts" % key)
+        accounts = []
+        for account in self.get_named("account",
+                _names(conditions.get("name", "")), deadline):
+            row = _account_row(account)
+            row.update(values)
+            accounts.append({
+                "name": account["name"],
+                "description": row["description"],
+                "organization": row["organization"],
+            })
+        if accounts:
+            self.request("POST", "/accounts", { "accounts": accounts },
+                deadline=deadline)
+
+    def modify_user(self, values, conditions, deadline):
+        for key in values:
+            if key != "defaultaccount":
+                raise RestError("slurmrestd can't set %s of users" % key)
+        users = []
+        for user in self.get_named("user",
+                _names(conditions.get("name", "")), deadline):
+            users.append({
+                "name": user["name"],
+                "default": { "account": values["defaultaccount"].lower() },
+            })
+        if users:
+            self.request("POST", "/users", { "users": users },
+                deadline=deadline)
+
+    def delete_account(self, values, conditions, deadline):
+        conditions.update(values)
+        for name in _names(conditions.get("name", "")):
+            try:
+                self.request("DELETE", "/account/%s" % urllib.quote(name, ""),
+                    deadline=deadline)
+            except NotFound:
+                pass
+
+    def delete_user(self, values, conditions, deadline):
+        conditions.update(values)
+        if "account" in conditions:
+            self.request("DELETE", "/associations", query={
+                "cluster": conditions.get("cluster", self.cluster),
+                "user": ",".join(_names(conditions.get("name", ""))),
+                "account": ",".join(_names(conditions["account"])),
+                }, deadline=deadline)
+            return
+        for name in _names(conditions.get("name", "")):
+            try:
+                self.request("DELETE", "/user/%s" % urllib.quote(name, ""),
+                    deadline=deadline)
+            except NotFound:
+                pass
+
+    def load(self, path, deadline):
+        """
+        Add the accounts, users and associations of a flat file that are
+        missing, like sacctmgr load, with one request of each kind.
+        """
+        cluster = self.cluster
+        accounts = []
+        users = {}
+        associations = []
+        parent = "root"
+        f = open(path)
+        try:
+            for line in f:
+                match = LINE.match(line.strip())
+                if match is None:
+                    continue
+                kind, name, rest = match.groups()
+                name = name.lower()
+                values = dict([ (k.lower(), v) for k, v in OPTION.findall(rest) ])
+                if kind == "Cluster":
+                    cluster = name
+                elif kind == "Parent":
+                    parent = name
+                elif kind == "Account":
+                    accounts.append((name, values))
+                elif kind == "User":
+                    users.setdefault(name,
+                        values.get("defaultaccount", parent).lower())
+                    associations.append((parent, name))
+        finally:
+            f.close()
+
+        existing = set([ a["name"].lower()
+            for a in self.get_named("account", [], deadline) ])
+        new = [ (name, values) for name, values in accounts
+            if name not in existing ]
+        if new:
+            self.request("POST", "/accounts", { "accounts": [ {
+                "name": name,
+                "description": values.get("description", name),
+                "organization": values.get("organization", "root"),
+                } for name, values in new ] }, deadline=deadline)
+
+        existing = set([ u["name"].lower()
+            for u in self.get_named("user", [], deadline) ])
+        new_users = [ (name, default) for name, default in sorted(users.items())
+            if name not in existing ]
+        if new_users:
+            self.request("POST", "/users", { "users": [ {
+                "name": name,
+                "default": { "account": default },
+                } for name, default in new_users ] }, deadline=deadline)
+
+        existing = set([ ((a.get("user") or "").lower(), a["account"].lower())
+            for a in self.get_associations({ "cluster": cluster }, deadline) ])
+        wanted = [ self.association(name, values=values, cluster=cluster)
+            for name, values in accounts if ("", name) not in existing ]
+        wanted.extend([ self.association(account, user, cluster=cluster)
+            for account, user in associations
+            if (user, account) not in existing ])
+        if wanted:
+            self.request("POST", "/associations", { "associations": wanted },
+                deadline=deadline)
+
+
+class RestProcess(object):
+    """ Looks like subprocess.Popen for one command run through slurmrestd. """
+
+    def __init__(self, transport, args, timeout=None):
+        self.returncode = None
+        self.stdout = self._lines(transport, args, timeout)
+
+    def _lines(self, transport, args, timeout):
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        try:
+            lines = transport.run(args, deadline)
+        except socket.timeout:
+            logger.error("Cmd %s timed out after %.1fs" % (args, timeout))
+            self.returncode = -1
+            raise CommandTimeout(args, timeout)
+        except RestError, e:
+            logger.error("Cmd %s failed: %s" % (args, e))
+            self.returncode = 1
+            return
+        self.returncode = 0
+        for line in lines:
+            yield line.encode("utf-8") + "\n"
+
+    def wait(self):
+        for line in self.stdout:
+            pass
+        return self.returncode
@@ -0,0 +1,52 @@
+"""
+Interactive sacctmgr sessions, and the transport for sacct.
+
+sacctmgr reads commands from stdin when it is started without one, printing
+a "sacctmgr: " prompt before reading each line. sacct has no interactive
+mode, and is run for each command.
+"""
+from kglimits.session import Session, CommandTransport
+
+
+def quote(arg):
+    """
+    Quote an argument so sacctmgr reads it as one word. sacctmgr has no
+    escapes, so a value with double quotes goes in single ones. Raises
+    ValueError for values it can't be given: with a line break, which would
+    end the command early, or with both kinds of quote.
+    """
+    if "\n" in arg or "\r" in arg:
+        raise ValueError("Can't give sacctmgr a line break in %r" % arg)
+    if arg != "" and not [c for c in arg if c in " \t'\""]:
+        return arg
+    key = ""
+    if "=" in arg:
+        key, value = arg.split("=", 1)
+        key = key + "="
+    else:
+        value = arg
+    if '"' not in value:
+        return '%s"%s"' % (key, value)
+    if "'" not in value:
+        return "%s'%s'" % (key, value)
+    raise ValueError("Can't give sacctmgr both kinds of quote in %r" % arg)
+
+
+class SacctmgrSession(Session):
+    prompt = "sacctmgr: "
+    # We never list QOS, so an empty QOS listing marks the end of output.
+    sentinel_command = "list qos where name=kglimits-end-of-output format=Name,Description"
+    sentinel_line = "Name|Descr|"
+
+    def format_command(self, args):
+        return " ".join([ quote(arg) for arg in args ])
+
+
+class SacctTransport(CommandTransport):
+    """
+    Run sacct commands, given as [ "sacct", args... ] like sacctmgr ones are
+    given with their verb, in a new process each.
+    """
+
+    def popen(self, args, timeout=None):
+        return CommandTransport.popen(self, args[1:], timeout)
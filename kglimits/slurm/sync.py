@@ -0,0 +1,236 @@
+"""
+Bring Slurm into line with Karaage in bulk.
+
+The whole Slurm state is read with three sacctmgr list commands, the whole
+Karaage state with a few ORM queries, and only the differences are written
+back to Slurm.
+"""
+import time
+
+from karaage.machines.models import UserAccount
+from karaage.projects.models import Project
+
+from kglimits.slurm import call, iter_slurm_output, filter_string, truncate
+from kglimits.slurm import slurm_null_project, slurm_batch_size, slurm_executor
+from kglimits.slurm.commands import association_command, group_associations
+from kglimits.sync import SyncReport, apply_changes
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Never deleted, even if Karaage doesn't know about them
+PROTECTED_ACCOUNTS = [ "root" ]
+PROTECTED_USERS = [ "root" ]
+
+
+class SlurmState(object):
+    """ Accounts, users and associations, with lower case names. """
+
+    def __init__(self):
+        # account -> (description, organization)
+        self.accounts = {}
+        # user -> default account
+        self.users = {}
+        # set of (user, account)
+        self.associations = set()
+
+
+# Read the current state from Slurm
+def get_slurm_state():
+    state = SlurmState()
+
+    def read_accounts():
+        fields = [ "Account", "Description", "Organization" ]
+        for v in iter_slurm_output([ "list", "accounts" ], fields):
+            state.accounts[v["Account"].lower()] = (v["Description"], v["Organization"])
+
+    def read_users():
+        fields = [ "User", "DefaultAccount" ]
+        for v in iter_slurm_output([ "list", "users" ], fields):
+            state.users[v["User"].lower()] = v["DefaultAccount"].lower()
+
+    def read_associations():
+        for v in iter_slurm_output([ "list", "assoc" ], [ "Account", "User" ]):
+            if v["User"] != "":
+                state.associations.add((v["User"].lower(), v["Account"].lower()))
+
+    # the lists are independent, so read them at the same time
+    slurm_executor.map(lambda read: read(),
+        [ read_accounts, read_users, read_associations ])
+
+    return state
+
+
+# Work out what Slurm should look like from Karaage
+# Returns the desired state, and the projects and accounts Karaage knows
+# about but that shouldn't exist.
+def get_karaage_state():
+    state = SlurmState()
+
+    for pid, name, institute in Project.objects.filter(is_active=True) \
+            .values_list('pid', 'name', 'institute__name'):
+        state.accounts[pid.lower()] = (
+                filter_string(truncate(name, 40)), filter_string(institute))
+
+    members = {}
+    for person_id, pid in Project.users.through.objects \
+            .filter(project__is_active=True) \
+            .values_list('person_id', 'project__pid'):
+        members.setdefault(person_id, []).append(pid.lower())
+
+    for username, default_project, person_id in UserAccount.objects \
+            .filter(date_deleted__isnull=True) \
+            .values_list('username', 'default_project__pid', 'user_id'):
+        username = username.lower()
+        if default_project is None:
+            default_project = slurm_null_project
+        default_project = default_project.lower()
+        state.users[username] = default_project
+        state.associations.add((username, default_project))
+        for pid in members.get(person_id, []):
+            state.associations.add((username, pid))
+
+    retired_accounts = set([ pid.lower() for pid in
+            Project.objects.filter(is_active=False)
+            .values_list('pid', flat=True) ])
+    retired_users = set([ username.lower() for username in
+            UserAccount.objects.filter(date_deleted__isnull=False)
+            .values_list('username', flat=True) ])
+    retired_users = retired_users - set(state.users.keys())
+
+    return state, retired_accounts, retired_users
+
+
+def _same(a, b):
+    # sacctmgr may change the case of descriptions and organizations
+    return a.lower() == b.lower()
+
+
+# Work out the commands needed to turn current into desired
+# Returns a list of (description, command) in the order they must be run.
+def diff_state(current, desired, retired_accounts, retired_users,
+        report, delete_unmanaged=False):
+    protected_accounts = set(PROTECTED_ACCOUNTS + [ slurm_null_project.lower() ])
+
+    def deletable_account(name):
+        if name in desired.accounts or name in protected_accounts:
+            return False
+        if name in retired_accounts or delete_unmanaged:
+            return True
+        report.unmanaged.append("account %s" % name)
+        return False
+
+    def deletable_user(name):
+        if name in desired.users or name in PROTECTED_USERS:
+            return False
+        if name in retired_users or delete_unmanaged:
+            return True
+        report.unmanaged.append("user %s" % name)
+        return False
+
+    add_accounts = []
+    modify_accounts = []
+    for name, (description, organization) in sorted(desired.accounts.items()):
+        if name not in current.accounts:
+            add_accounts.append(("add account %s" % name,
+                [ "add", "account", "name=%s" % name, "grpcpumins=0",
+                "Description=%s" % description,
+                "Organization=%s" % organization ]))
+            continue
+        old_description, old_organization = current.accounts[name]
+        changes = []
+        if not _same(old_description, description):
+            changes.append("Description=%s" % description)
+        if not _same(old_organization, organization):
+            changes.append("Organization=%s" % organization)
+        if changes:
+            command = [ "modify", "account", "set" ]
+            command.extend(changes)
+            command.extend([ "where", "name=%s" % name ])
+            modify_accounts.append(("modify account %s" % name, command))
+
+    delete_accounts = []
+    for name in sorted(current.accounts.keys()):
+        if deletable_account(name):
+            delete_accounts.append(("delete account %s" % name,
+                [ "delete", "account", "name=%s" % name ]))
+
+    # adding a user also adds the association with its default account
+    add_users = []
+    modify_users = []
+    created = set()
+    for name, default in sorted(desired.users.items()):
+        if name not in current.users:
+            add_users.append(("add user %s" % name,
+                [ "add", "user", "name=%s" % name,
+                "defaultaccount=%s" % default, "accounts=%s" % default ]))
+            created.add((name, default))
+        elif current.users[name] != default:
+            modify_users.append(("modify user %s defaultaccount=%s"
+                % (name, default),
+                [ "modify", "user", "set", "defaultaccount=%s" % default,
+                "where", "name=%s" % name ]))
+
+    delete_users = []
+    for name in sorted(current.users.keys()):
+        if deletable_user(name):
+            delete_users.append(("delete user %s" % name,
+                [ "delete", "user", "name=%s" % name ]))
+
+    add_associations = []
+    missing = desired.associations - current.associations - created
+    for users, accounts in group_associations(missing, slurm_batch_size):
+        add_associations.append(("add %s to %s"
+            % (",".join(users), ",".join(accounts)),
+            association_command("add", users, accounts)))
+
+    # associations of deleted users and accounts go with them, and unmanaged
+    # users and accounts are left alone
+    extra = [ (user, account)
+        for user, account in current.associations - desired.associations
+        if user in desired.users and account in desired.accounts ]
+    delete_associations = []
+    for users, accounts in group_associations(extra, slurm_batch_size):
+        delete_associations.append(("delete %s from %s"
+            % (",".join(users), ",".join(accounts)),
+            association_command("delete", users, accounts)))
+
+    # the order matters: accounts before their users, and associations before
+    # they become a user's default
+    changes = []
+    changes.extend(add_accounts)
+    changes.extend(modify_accounts)
+    changes.extend(add_users)
+    changes.extend(add_associations)
+    changes.extend(modify_users)
+    changes.extend(delete_associations)
+    changes.extend(delete_users)
+    changes.extend(delete_accounts)
+    return changes
+
+
+# Bring the current Slurm cluster into line with Karaage
+# karaage is what get_karaage_state() returned, if it has been read already
+# for another cluster.
+def sync(dry_run=False, delete_unmanaged=False, karaage=None):
+    report = SyncReport()
+
+    start = time.time()
+    current = get_slurm_state()
+    report.time("read slurm", start)
+
+    if karaage is None:
+        start = time.time()
+        karaage = get_karaage_state()
+        report.time("read karaage", start)
+    desired, retired_accounts, retired_users = karaage
+
+    start = time.time()
+    changes = diff_state(current, desired, retired_accounts, retired_users,
+            report, delete_unmanaged=delete_unmanaged)
+    report.time("diff", start)
+
+    apply_changes(changes, call, report, dry_run=dry_run)
+
+    return report
@@ -0,0 +1,252 @@
+"""
+Incremental import of CPU usage from sacct.
+
+Jobs are read from sacct a time window at a time (SLURM_USAGE_WINDOW
+seconds), and their CPU time is added up per account, user and day as the
+output streams past, so memory use depends on the number of accounts and
+users, not jobs. Each window's totals are added to a local SQLite table
+(SLURM_USAGE) in one transaction with the high-water mark, the end of the
+last window read, and the ids of the jobs counted. The next run starts from
+the mark, so hourly runs only read the last hour.
+
+Jobs are counted by the UTC day they ended on. Windows stop
+SLURM_USAGE_LAG seconds before now, to give slurmdbd time to record jobs
+that just ended. Each window also reads the SLURM_USAGE_OVERLAP seconds
+before it again, counting the jobs slurmdbd recorded late and skipping the
+ones already counted, whose ids are kept for as long as they can be read
+again.
+
+Totals and the mark are kept per cluster, so every cluster of
+SLURM_CLUSTERS can import into the same store.
+"""
+import os
+import time
+import calendar
+import sqlite3
+
+from kglimits.slurm import iter_slurm_output, get_sacct_transport
+from kglimits.slurm import slurm_clusters, slurm_usage_window, slurm_usage_lag
+from kglimits.slurm import slurm_usage_overlap
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    cluster TEXT NOT NULL DEFAULT '',
+    account TEXT NOT NULL,
+    username TEXT NOT NULL,
+    day TEXT NOT NULL,
+    cpu_seconds INTEGER NOT NULL DEFAULT 0,
+    jobs INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (cluster, account, username, day)
+);
+CREATE INDEX IF NOT EXISTS usage_day ON usage (day);
+CREATE TABLE IF NOT EXISTS mark (
+    cluster TEXT NOT NULL DEFAULT '' PRIMARY KEY,
+    end_time INTEGER NOT NULL,
+    counted_from INTEGER
+);
+CREATE TABLE IF NOT EXISTS counted (
+    cluster TEXT NOT NULL DEFAULT '',
+    job_id TEXT NOT NULL,
+    end_time INTEGER NOT NULL,
+    PRIMARY KEY (cluster, job_id)
+);
+"""
+
+# Stores made before usage was kept per cluster have it all under ''
+UPGRADE = """
+DROP INDEX IF EXISTS usage_day;
+ALTER TABLE usage RENAME TO usage_old;
+ALTER TABLE mark RENAME TO mark_old;
+""" + SCHEMA + """
+INSERT INTO usage (account, username, day, cpu_seconds, jobs)
+    SELECT account, username, day, cpu_seconds, jobs FROM usage_old;
+INSERT INTO mark (end_time) SELECT end_time FROM mark_old;
+DROP TABLE usage_old;
+DROP TABLE mark_old;
+"""
+
+FIELDS = [ "JobIDRaw", "Account", "User", "End", "CPUTimeRAW" ]
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+def format_time(t):
+    return time.strftime(TIME_FORMAT, time.gmtime(t))
+
+
+def parse_time(value):
+    """ Seconds since the epoch of a sacct time, or None if there is none. """
+    try:
+        return calendar.timegm(time.strptime(value, TIME_FORMAT))
+    except ValueError:
+        # Unknown, None or empty for jobs that haven't ended
+        return None
+
+
+class UsageStore(object):
+    """ Usage of one cluster, in a file that may hold other clusters' too. """
+
+    def __init__(self, path, cluster=None):
+        self.path = path
+        self.cluster = cluster or ""
+
+    def connect(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        db = sqlite3.connect(self.path, timeout=60)
+        columns = [ row[1] for row in db.execute("PRAGMA table_info(usage)") ]
+        if columns and "cluster" not in columns:
+            db.executescript(UPGRADE)
+        db.executescript(SCHEMA)
+        # Marks made before counted jobs were kept have no counted_from
+        columns = [ row[1] for row in db.execute("PRAGMA table_info(mark)") ]
+        if "counted_from" not in columns:
+            db.execute("ALTER TABLE mark ADD COLUMN counted_from INTEGER")
+        return db
+
+    def get_mark(self):
+        """
+        (end time, counted from) of the last window imported, or None. The
+        ids of the jobs counted that ended from counted from on are kept.
+        """
+        db = self.connect()
+        try:
+            mark = db.execute("SELECT end_time, counted_from FROM mark "
+                "WHERE cluster = ?", (self.cluster,)).fetchone()
+        finally:
+            db.close()
+        if mark is not None and mark[1] is None:
+            # No ids were kept before the mark
+            mark = (mark[0], mark[0])
+        return mark
+
+    def get_counted(self, start):
+        """ Ids of the jobs counted that ended from start on. """
+        db = self.connect()
+        try:
+            return set([ row[0] for row in db.execute("SELECT job_id "
+                "FROM counted WHERE cluster = ? AND end_time >= ?",
+                (self.cluster, start)) ])
+        finally:
+            db.close()
+
+    def add(self, totals, end_time, counted, counted_from):
+        """
+        Add totals, a dict of (account, user, day) to [ cpu seconds, jobs ],
+        and counted, a list of (job id, end time) of the jobs in them, move
+        the mark to end_time and forget jobs that ended before counted_from,
+        in one transaction.
+        """
+        db = self.connect()
+        try:
+            db.executemany("INSERT OR IGNORE INTO usage "
+                "(cluster, account, username, day) VALUES (?, ?, ?, ?)",
+                [ (self.cluster,) + key for key in totals.keys() ])
+            db.executemany("UPDATE usage SET cpu_seconds = cpu_seconds + ?, "
+                "jobs = jobs + ? WHERE cluster = ? AND account = ? "
+                "AND username = ? AND day = ?",
+                [ (cpu, jobs, self.cluster) + key
+                    for key, (cpu, jobs) in totals.items() ])
+            db.executemany("INSERT OR REPLACE INTO counted "
+                "(cluster, job_id, end_time) VALUES (?, ?, ?)",
+                [ (self.cluster,) + job for job in counted ])
+            db.execute("DELETE FROM counted WHERE cluster = ? AND end_time < ?",
+                (self.cluster, counted_from))
+            db.execute("INSERT OR REPLACE INTO mark "
+                "(cluster, end_time, counted_from) VALUES (?, ?, ?)",
+                (self.cluster, end_time, counted_from))
+            db.commit()
+        finally:
+            db.close()
+
+    def get_project_usage(self, account, start_day, end_day):
+        """
+        CPU seconds and jobs of each user of an account, from start_day to
+        end_day inclusive, as YYYY-MM-DD.
+        """
+        db = self.connect()
+        try:
+            return db.execute("SELECT username, SUM(cpu_seconds), SUM(jobs) "
+                "FROM usage WHERE cluster = ? AND account = ? AND day >= ? "
+                "AND day <= ? GROUP BY username ORDER BY username",
+                (self.cluster, account.lower(), start_day, end_day)).fetchall()
+        finally:
+            db.close()
+
+
+# Read the jobs that ended in [start, end) from sacct, adding up CPU time
+# per account, user and day as they arrive, except those in skip
+# Returns the totals and a list of (job id, end time) of the jobs counted.
+def read_usage(start, end, skip=()):
+    totals = {}
+    counted = []
+    command = [ "sacct", "--allusers", "--allocations",
+        "--starttime=%s" % format_time(start),
+        "--endtime=%s" % format_time(end) ]
+    for v in iter_slurm_output(command, FIELDS, get_sacct_transport()):
+        # sacct also lists jobs that were running in the window
+        ended = parse_time(v["End"])
+        if ended is None or ended < start or ended >= end:
+            continue
+        if v["JobIDRaw"] in skip:
+            continue
+        key = (v["Account"].lower(), v["User"].lower(),
+            time.strftime("%Y-%m-%d", time.gmtime(ended)))
+        total = totals.get(key)
+        if total is None:
+            total = totals[key] = [ 0, 0 ]
+        total[0] = total[0] + int(v["CPUTimeRAW"] or 0)
+        total[1] = total[1] + 1
+        counted.append((v["JobIDRaw"], ended))
+    return totals, counted
+
+
+# Import the usage of jobs that ended since the last import, or since since
+# the first time
+# Returns the number of windows and jobs read.
+def import_usage(store, since=None, until=None):
+    if until is None:
+        until = time.time() - slurm_usage_lag
+    until = int(until)
+
+    mark = store.get_mark()
+    if mark is not None:
+        start, counted_from = mark
+    else:
+        if since is not None:
+            start = int(since)
+        else:
+            start = until - slurm_usage_window
+        counted_from = start
+
+    windows = 0
+    jobs = 0
+    while start < until:
+        end = min(start + slurm_usage_window, until)
+        begun = time.time()
+        # Read again as far back as the jobs counted are known
+        overlap = max(start - slurm_usage_overlap, counted_from)
+        totals, counted = read_usage(overlap, end, store.get_counted(overlap))
+        counted_from = max(counted_from, end - slurm_usage_overlap)
+        store.add(totals, end, counted, counted_from)
+        logger.debug("usage %s to %s: %d jobs, %d totals in %.2fs"
+            % (format_time(overlap), format_time(end), len(counted),
+            len(totals), time.time() - begun))
+        windows = windows + 1
+        jobs = jobs + len(counted)
+        start = end
+    return windows, jobs
+
+
+# Get the usage store of the current cluster, if SLURM_USAGE is set
+def get_usage_store():
+    cluster = slurm_clusters.current()
+    path = cluster.setting("USAGE")
+    if path is None:
+        return None
+    return UsageStore(path, cluster.name)
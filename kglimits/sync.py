@@ -0,0 +1,52 @@
+"""
+Shared pieces of the bulk reconciliation of backends with Karaage.
+"""
+import time
+import subprocess
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SyncReport(object):
+
+    def __init__(self):
+        self.changes = []
+        self.errors = []
+        self.unmanaged = []
+        self.timings = []
+
+    def time(self, phase, start):
+        self.timings.append((phase, time.time() - start))
+
+    def __str__(self):
+        lines = []
+        for description, command in self.changes:
+            lines.append("%s" % description)
+        for description, error in self.errors:
+            lines.append("FAILED %s: %s" % (description, error))
+        for description in self.unmanaged:
+            lines.append("unmanaged %s" % description)
+        lines.append("%d changes, %d errors, %d unmanaged"
+                % (len(self.changes), len(self.errors), len(self.unmanaged)))
+        for phase, seconds in self.timings:
+            lines.append("%s: %.2fs" % (phase, seconds))
+        return "\n".join(lines)
+
+
+# Run a list of (description, command) changes, carrying on after failures
+def apply_changes(changes, call, report, dry_run=False):
+    start = time.time()
+    for description, command in changes:
+        if dry_run:
+            report.changes.append((description, command))
+            continue
+        try:
+            call(command)
+        except subprocess.CalledProcessError, e:
+            logger.error("sync: %s failed: %s" % (description, e))
+            report.errors.append((description, e))
+        else:
+            report.changes.append((description, command))
+    report.time("apply", start)
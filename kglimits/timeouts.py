@@ -0,0 +1,215 @@
+"""
+Time limits on backend commands.
+
+Every command has a timeout (SLURM_TIMEOUT or GOLD_TIMEOUT seconds, with
+exceptions per verb in SLURM_TIMEOUTS and GOLD_TIMEOUTS). A command that
+runs past it is killed with its process group and raises CommandTimeout,
+so a hung slurmdbd or Gold server can't hold a Django worker forever.
+
+Each signal handler also has a budget for all of its commands
+(SLURM_DEADLINE or GOLD_DEADLINE seconds). Commands get at most what is
+left of it, and once it is spent the rest fail straight away with
+DeadlineExceeded. Under a work queue the handler is then retried later.
+
+After repeated timeouts a backend's circuit breaker opens, and commands
+fail straight away with CircuitOpen for a cool down period instead of each
+waiting for its own timeout. After the cool down one command is let
+through to try the backend again; if nothing is heard of it within another
+cool down (its output was never read to the end), another one is.
+
+All three are CalledProcessErrors, so they are reported like any other
+failed command.
+"""
+import time
+import threading
+import subprocess
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class Unavailable(subprocess.CalledProcessError):
+    """ A command was stopped, or not started, for taking too long. """
+
+    def __init__(self, cmd, reason):
+        subprocess.CalledProcessError.__init__(self, -1, cmd)
+        self.reason = reason
+
+    def __str__(self):
+        return "Cmd %s %s" % (self.cmd, self.reason)
+
+
+class CommandTimeout(Unavailable):
+
+    def __init__(self, cmd, seconds):
+        Unavailable.__init__(self, cmd,
+            "timed out after %.1fs and was killed" % seconds)
+
+
+class DeadlineExceeded(Unavailable):
+
+    def __init__(self, cmd):
+        Unavailable.__init__(self, cmd,
+            "not run, the signal handler ran out of time")
+
+
+class CircuitOpen(Unavailable):
+
+    def __init__(self, cmd, name, seconds):
+        Unavailable.__init__(self, cmd,
+            "not run, %s has been timing out; trying again in %.0fs"
+            % (name, seconds))
+
+
+def current_deadline():
+    """ When the commands of the current handler must be done by, or None. """
+    return getattr(_local, "deadline", None)
+
+
+def set_deadline(deadline):
+    _local.deadline = deadline
+
+
+def deadline(seconds):
+    """
+    Decorator for signal handlers, giving their commands seconds in total.
+    A handler run by another keeps the sooner deadline. None is no limit.
+    """
+    def decorator(func):
+        def handler(*args, **kwargs):
+            outer = current_deadline()
+            if seconds is not None:
+                mine = time.time() + seconds
+                if outer is None or mine < outer:
+                    set_deadline(mine)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                set_deadline(outer)
+        handler.__name__ = func.__name__
+        handler.__doc__ = func.__doc__
+        return handler
+    return decorator
+
+
+def timeout(seconds, command):
+    """
+    Seconds command may run for: seconds, or less if the deadline is
+    sooner. Raises DeadlineExceeded if the deadline has passed.
+    """
+    d = current_deadline()
+    if d is None:
+        return seconds
+    remaining = d - time.time()
+    if remaining <= 0:
+        logger.error("Cmd %s not run, deadline passed" % command)
+        raise DeadlineExceeded(command)
+    if seconds is None or remaining < seconds:
+        return remaining
+    return seconds
+
+
+class CircuitBreaker(object):
+    """
+    Stops commands for cooldown seconds after threshold timeouts in a row.
+    A threshold of 0 never stops them.
+    """
+
+    def __init__(self, name, threshold, cooldown):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self.trying = False
+        self.tried = None
+        self._lock = threading.Lock()
+
+    def check(self, command):
+        """ Raises CircuitOpen if command may not run now. """
+        self._lock.acquire()
+        try:
+            if self.opened is None:
+                return
+            now = time.time()
+            waited = now - self.opened
+            if waited < self.cooldown:
+                raise CircuitOpen(command, self.name, self.cooldown - waited)
+            if self.trying and now - self.tried < self.cooldown:
+                raise CircuitOpen(command, self.name,
+                    self.cooldown - (now - self.tried))
+            # half open: this command finds out if the backend is back
+            logger.info("%s circuit breaker letting one command through"
+                % self.name)
+            self.trying = True
+            self.tried = now
+        finally:
+            self._lock.release()
+
+    def success(self):
+        self._lock.acquire()
+        try:
+            if self.opened is not None:
+                logger.info("%s circuit breaker closed" % self.name)
+            self.failures = 0
+            self.opened = None
+            self.trying = False
+        finally:
+            self._lock.release()
+
+    def failure(self):
+        self._lock.acquire()
+        try:
+            self.failures = self.failures + 1
+            self.trying = False
+            if self.threshold > 0 and self.failures >= self.threshold:
+                if self.opened is None:
+                    logger.error("%s circuit breaker opened after %d timeouts"
+                        % (self.name, self.failures))
+                self.opened = time.time()
+        finally:
+            self._lock.release()
+
+    def watch(self, process):
+        """ Record whether a started command times out. """
+        return Watched(self, process)
+
+
+class Watched(object):
+    """ Looks like subprocess.Popen, telling a breaker about timeouts. """
+
+    def __init__(self, breaker, process):
+        self.breaker = breaker
+        self.process = process
+        self.timed_out = False
+        self.stdout = self._lines()
+
+    @property
+    def returncode(self):
+        return self.process.returncode
+
+    def _lines(self):
+        try:
+            for line in self.process.stdout:
+                yield line
+        except CommandTimeout:
+            self.timed_out = True
+            self.breaker.failure()
+            raise
+
+    def wait(self):
+        for line in self.stdout:
+            pass
+        try:
+            returncode = self.process.wait()
+        except CommandTimeout:
+            if not self.timed_out:
+                self.timed_out = True
+                self.breaker.failure()
+            raise
+        if not self.timed_out:
+            self.breaker.success()
+        return returncode
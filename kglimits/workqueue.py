@@ -0,0 +1,298 @@
+"""
+Durable queue of signal handler calls.
+
+When a queue is configured, signal handlers don't talk to the backend in
+the web request. The signal is written to a local SQLite database when the
+transaction commits, and a worker process (kg-manage slurm_queue or
+gold_queue) replays it later against the current state of Karaage.
+
+Saved objects are fetched again when the signal is replayed, so repeated
+saves of one object are only replayed once, for handlers queued with
+coalesce=True. Other signals, such as membership changes that carry what
+changed, are each replayed. Deleted objects are rebuilt
+from the fields saved with the signal. Signals for one object are replayed
+in order; a failure is retried with exponential backoff and holds back
+later signals for the same object, but not for others. Each batch is read
+from the signals that are due, of objects not held back. A signal that
+fails max_attempts times is given up on: it is kept, marked failed, and no
+longer holds anything back.
+"""
+import os
+import time
+import json
+import sqlite3
+import traceback
+
+from django.db import transaction
+
+from kglimits import buffer
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS queue (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    backend TEXT NOT NULL,
+    entity TEXT NOT NULL,
+    handler TEXT NOT NULL,
+    signal TEXT NOT NULL,
+    created REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    last_error TEXT,
+    failed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS queue_backend ON queue (backend, id);
+CREATE INDEX IF NOT EXISTS queue_entity ON queue (backend, entity, next_attempt);
+"""
+
+
+def model_label(model):
+    return "%s.%s" % (model._meta.app_label, model._meta.object_name)
+
+
+def get_model(label):
+    from django.apps import apps
+    app_label, name = label.split(".")
+    return apps.get_model(app_label, name)
+
+
+# Add what an earlier save changed to a later signal for the same object
+def merge_changed(signal, earlier):
+    kwargs = signal["kwargs"]
+    if "changed" not in kwargs:
+        return
+    changed = earlier["kwargs"].get("changed")
+    if changed is None or kwargs["changed"] is None:
+        kwargs["changed"] = None
+    else:
+        kwargs["changed"] = sorted(set(kwargs["changed"]) | set(changed))
+
+
+class WorkQueue(object):
+
+    def __init__(self, backend, path, backoff=30, max_backoff=3600,
+            max_attempts=20):
+        self.backend = backend
+        self.path = path
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.handlers = {}
+        # handlers that only look at the current state of the object
+        self.coalesced = set()
+
+    def connect(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        db = sqlite3.connect(self.path, timeout=60)
+        columns = [ row[1] for row in db.execute("PRAGMA table_info(queue)") ]
+        if columns and "failed" not in columns:
+            db.execute("ALTER TABLE queue ADD COLUMN "
+                "failed INTEGER NOT NULL DEFAULT 0")
+        db.executescript(SCHEMA)
+        return db
+
+    def deferred(self, deleted=False, fields=[], coalesce=False):
+        """
+        Decorator for signal handlers that queues the signal instead of
+        handling it, if the queue is enabled.
+
+        fields are saved so the instance can be rebuilt by the worker after
+        it has been deleted. With coalesce, a queued signal is dropped when
+        a later one for the same object and handler is queued behind it, so
+        the handler must only depend on the object's current state.
+        """
+        def decorator(func):
+            self.handlers[func.__name__] = func
+            if coalesce:
+                self.coalesced.add(func.__name__)
+
+            def handler(sender, instance, **kwargs):
+                # a plan wants to see the commands straight away
+                if self.path is None or buffer.planning():
+                    return func(sender, instance, **kwargs)
+                signal = self.serialize(instance, kwargs, deleted, fields)
+                entity = "%s:%s" % (signal["model"], signal["pk"])
+                transaction.on_commit(
+                    lambda: self.put(entity, func.__name__, signal))
+            handler.__name__ = func.__name__
+            handler.__doc__ = func.__doc__
+            handler.handler = func
+            return handler
+        return decorator
+
+    def serialize(self, instance, kwargs, deleted, fields):
+        signal = {
+            "model": model_label(instance.__class__),
+            "pk": instance.pk,
+            "deleted": deleted,
+            "fields": dict([ (f, getattr(instance, f)) for f in fields ]),
+            "kwargs": {},
+        }
+        for key in ("created", "changed", "action", "reverse"):
+            if key in kwargs:
+                signal["kwargs"][key] = kwargs[key]
+        if "model" in kwargs:
+            signal["kwargs"]["model"] = model_label(kwargs["model"])
+        if "pk_set" in kwargs:
+            pk_set = kwargs["pk_set"]
+            if pk_set is not None:
+                pk_set = list(pk_set)
+            signal["kwargs"]["pk_set"] = pk_set
+        return signal
+
+    def put(self, entity, handler, signal):
+        now = time.time()
+        db = self.connect()
+        try:
+            db.execute("INSERT INTO queue "
+                "(backend, entity, handler, signal, created, next_attempt) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (self.backend, entity, handler, json.dumps(signal), now, now))
+            db.commit()
+        finally:
+            db.close()
+        logger.debug("Queued %s %s" % (handler, entity))
+
+    def replay(self, handler, signal):
+        model = get_model(signal["model"])
+        instance = None
+        if not signal["deleted"]:
+            try:
+                instance = model.objects.get(pk=signal["pk"])
+            except model.DoesNotExist:
+                # a queued delete will tidy up after it
+                logger.debug("%s %s no longer exists"
+                    % (signal["model"], signal["pk"]))
+                return
+        else:
+            instance = model(pk=signal["pk"])
+            for key, value in signal["fields"].items():
+                setattr(instance, key, value)
+
+        kwargs = dict([ (str(k), v) for k, v in signal["kwargs"].items() ])
+        if "model" in kwargs:
+            kwargs["model"] = get_model(kwargs["model"])
+        if kwargs.get("pk_set") is not None:
+            kwargs["pk_set"] = set(kwargs["pk_set"])
+        self.handlers[handler](model, instance, **kwargs)
+
+    def process(self, batch_size=100):
+        """
+        Replay one batch of queued signals, the oldest that are due.
+
+        Returns the number of signals replayed, successfully or not.
+        """
+        db = self.connect()
+        try:
+            # an object with a signal waiting to be retried is held back
+            now = time.time()
+            rows = db.execute("SELECT id, entity, handler, signal, attempts, "
+                "next_attempt FROM queue WHERE backend = ? AND failed = 0 "
+                "AND entity NOT IN (SELECT entity FROM queue WHERE "
+                "backend = ? AND failed = 0 AND next_attempt > ?) "
+                "ORDER BY id LIMIT ?",
+                (self.backend, self.backend, now, batch_size)).fetchall()
+
+            # a save replayed later in the batch makes an earlier one
+            # redundant, as long as nothing else happens to the object between
+            # and the later one also sends what the earlier one changed
+            skip = set()
+            merged = {}
+            following = {}
+            signals = dict([ (row[0], json.loads(row[3])) for row in rows ])
+            for row in reversed(rows):
+                id, entity, handler, signal, attempts, next_attempt = row
+                signal = signals[id]
+                later = following.get(entity)
+                if later is not None and later[1] == handler \
+                        and handler in self.coalesced \
+                        and not signal["deleted"] and attempts == 0:
+                    skip.add(id)
+                    merge_changed(signals[later[0]], signal)
+                    merged[later[0]] = signals[later[0]]
+                    continue
+                following[entity] = (id, handler)
+            if skip:
+                db.executemany("DELETE FROM queue WHERE id = ?",
+                    [ (id,) for id in skip ])
+                db.executemany("UPDATE queue SET signal = ? WHERE id = ?",
+                    [ (json.dumps(signal), id) for id, signal in merged.items() ])
+                db.commit()
+
+            done = 0
+            blocked = set()
+            now = time.time()
+            for id, entity, handler, signal, attempts, next_attempt in rows:
+                if id in skip or entity in blocked:
+                    continue
+                if next_attempt > now:
+                    blocked.add(entity)
+                    continue
+                try:
+                    self.replay(handler, signals[id])
+                except Exception, e:
+                    attempts = attempts + 1
+                    if attempts >= self.max_attempts:
+                        logger.error("%s %s failed (attempt %d, giving up): %s"
+                            % (handler, entity, attempts, e))
+                        db.execute("UPDATE queue SET attempts = ?, "
+                            "failed = 1, last_error = ? WHERE id = ?",
+                            (attempts, traceback.format_exc(), id))
+                        db.commit()
+                        done = done + 1
+                        continue
+                    delay = min(self.backoff * 2 ** (attempts - 1),
+                            self.max_backoff)
+                    logger.error("%s %s failed (attempt %d, retry in %ds): %s"
+                        % (handler, entity, attempts, delay, e))
+                    db.execute("UPDATE queue SET attempts = ?, "
+                        "next_attempt = ?, last_error = ? WHERE id = ?",
+                        (attempts, time.time() + delay,
+                        traceback.format_exc(), id))
+                    blocked.add(entity)
+                else:
+                    db.execute("DELETE FROM queue WHERE id = ?", (id,))
+                db.commit()
+                done = done + 1
+            return done
+        finally:
+            db.close()
+
+    def run(self, once=False, batch_size=100, poll=5):
+        """ Replay signals until stopped, or until none are due. """
+        while True:
+            done = self.process(batch_size)
+            if once and done == 0:
+                return
+            if done == 0:
+                time.sleep(poll)
+
+    def stats(self):
+        """ Depth and lag of the queue, and how many signals were given up on. """
+        now = time.time()
+        db = self.connect()
+        try:
+            depth, oldest, retrying, attempts = db.execute(
+                "SELECT COUNT(*), MIN(created), "
+                "SUM(CASE WHEN attempts > 0 THEN 1 ELSE 0 END), MAX(attempts) "
+                "FROM queue WHERE backend = ? AND failed = 0",
+                (self.backend,)).fetchone()
+            failed = db.execute("SELECT COUNT(*) FROM queue "
+                "WHERE backend = ? AND failed = 1", (self.backend,)).fetchone()[0]
+        finally:
+            db.close()
+        lag = 0
+        if oldest is not None:
+            lag = now - oldest
+        return {
+            "depth": depth,
+            "lag": lag,
+            "retrying": retrying or 0,
+            "max_attempts": attempts or 0,
+            "failed": failed,
+        }